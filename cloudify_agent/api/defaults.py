@@ -17,6 +17,7 @@ START_TIMEOUT = 60
 START_INTERVAL = 1
 STOP_TIMEOUT = 60
 STOP_INTERVAL = 1
+READY_POLL_INTERVAL = 0.05
 BROKER_PORT = 5672
 REST_PORT = 80
 REST_PROTOCOL = 'http'
@@ -29,6 +30,19 @@ MAX_WORKERS = 5
 BROKER_URL = 'amqp://{username}:{password}@{host}:{port}//'
 DELETE_AMQP_QUEUE_BEFORE_START = True
 DAEMON_FORCE_DELETE = False
+DAEMONS_CONCURRENCY = 4
+QUEUE_DELETE_BATCH_SIZE = 100
 CLOUDIFY_AGENT_PREFIX = 'cfy-agent'
 LOG_LEVEL = 'debug'
 CELERY_TASK_RESULT_EXPIRES = 600
+WAGON_CACHE_MAX_SIZE = 512 * 1024 * 1024
+WHEELHOUSE_MAX_SIZE = 1024 * 1024 * 1024
+SOURCE_CACHE_MAX_SIZE = 512 * 1024 * 1024
+SOURCE_CACHE_TTL = 600
+PLUGINS_INSTALL_CONCURRENCY = 4
+PLUGINS_DEDUP_MODE = 'off'
+PLUGINS_TRASH_REAP_RATE = 2000
+MANAGED_PLUGINS_CACHE_TTL = 30
+PLUGINS_DISK_QUOTA = 5 * 1024 * 1024 * 1024
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_TIMEOUT = 30
@@ -15,12 +15,17 @@
 
 import os
 import json
+import errno
 
 from cloudify.utils import setup_logger
 
 from cloudify_agent.api import exceptions
 from cloudify_agent.api import utils
 
+# the names of the stored daemons, and their process management. the
+# name must not end with 'json', so it is not mistaken for a daemon.
+INDEX_FILE = '.index'
+
 
 class DaemonFactory(object):
 
@@ -103,51 +108,61 @@ class DaemonFactory(object):
         :rtype: cloudify_agent.api.pm.base.Daemon
         """
         name = attributes.get('name')
-        if name:
-            # an explicit name was passed, make sure we don't already
-            # have a daemon with that name
-            try:
-                self.load(name, logger=logger)
-                # this means we do have one, raise an error
-                raise exceptions.DaemonAlreadyExistsError(name)
-            except exceptions.DaemonNotFoundError:
-                pass
+        if name and self.exists(name):
+            # an explicit name was passed, and we already have a daemon
+            # with that name
+            raise exceptions.DaemonAlreadyExistsError(name)
 
         process_management = attributes['process_management']
         daemon = DaemonFactory._find_implementation(process_management)
         return daemon(logger=logger, **attributes)
 
-    def load_all(self, logger=None):
+    def load_all(self, logger=None, lazy=False):
 
         """
         Loads all daemons from local storage.
 
         :param logger: a logger to be used by the daemons to log various
                        operations.
+        :param lazy: whether to defer loading each daemon until it is used
+                     (see `LazyDaemon`).
 
         :return: all daemons instances.
         :rtype: list
 
         """
-        if not os.path.exists(self.storage):
-            return []
-
+        if lazy:
+            return [LazyDaemon(self, name, logger=logger)
+                    for name in self.names()]
         daemons = []
-        daemon_files = os.listdir(self.storage)
-        for daemon_file in daemon_files:
-            full_path = os.path.join(
-                self.storage,
-                daemon_file
-            )
-            if full_path.endswith('json'):
-                self.logger.debug('Loading daemon from: {0}'.format(full_path))
-                daemon_as_json = utils.json_load(full_path)
-                process_management = daemon_as_json.pop('process_management')
-                daemon = DaemonFactory._find_implementation(process_management)
-                daemons.append(daemon(logger=logger, **daemon_as_json))
-
+        for name in self.names():
+            try:
+                daemons.append(self.load(name, logger=logger))
+            except exceptions.DaemonNotFoundError:
+                # deleted since listed
+                pass
         return daemons
 
+    def names(self):
+
+        """
+        List the names of the daemons in local storage, without loading
+        them.
+
+        :return: the sorted names.
+        :rtype: list
+        """
+
+        return sorted(self._read_index())
+
+    def exists(self, name):
+
+        """
+        Check whether a daemon exists in local storage, without loading it.
+        """
+
+        return name in self._read_index()
+
     def load(self, name, logger=None):
 
         """
@@ -170,9 +185,12 @@ class DaemonFactory(object):
             self.storage,
             '{0}.json'.format(name)
         )
-        if not os.path.exists(daemon_path):
-            raise exceptions.DaemonNotFoundError(name)
-        daemon_as_json = utils.json_load(daemon_path)
+        try:
+            daemon_as_json = utils.json_load(daemon_path)
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                raise exceptions.DaemonNotFoundError(name)
+            raise
         self.logger.debug('Daemon {0} loaded: {1}'.format(name, json.dumps(
             daemon_as_json, indent=2)))
         process_management = daemon_as_json.pop('process_management')
@@ -189,8 +207,7 @@ class DaemonFactory(object):
         :type daemon: cloudify_agent.api.daemon.base.Daemon
 
         """
-        if not os.path.exists(self.storage):
-            os.makedirs(self.storage)
+        utils.safe_create_dir(self.storage)
 
         daemon_path = os.path.join(
             self.storage, '{0}.json'.format(
@@ -198,10 +215,18 @@ class DaemonFactory(object):
         )
         self.logger.debug('Saving daemon configuration at: {0}'
                           .format(daemon_path))
-        with open(daemon_path, 'w') as f:
-            props = utils.internal.daemon_to_dict(daemon)
-            json.dump(props, f, indent=2)
-            f.write(os.linesep)
+        props = utils.internal.daemon_to_dict(daemon)
+        content = json.dumps(props, indent=2) + os.linesep
+
+        def add(index):
+            index[daemon.name] = {
+                'process_management': daemon.PROCESS_MANAGEMENT
+            }
+        # readers never see a partially written file, and concurrent
+        # writers are serialized along with the index update
+        with self._lock():
+            utils.write_file_atomically(daemon_path, content)
+            self._update_index(add, locked=True)
 
     def delete(self, name):
 
@@ -211,7 +236,114 @@ class DaemonFactory(object):
         :param name: The name of the daemon to delete.
 
         """
+        if not os.path.isdir(self.storage):
+            return
         daemon_path = os.path.join(
             self.storage, '{0}.json'.format(name))
-        if os.path.exists(daemon_path):
-            os.remove(daemon_path)
+        with self._lock():
+            if os.path.exists(daemon_path):
+                os.remove(daemon_path)
+            self._update_index(lambda index: index.pop(name, None),
+                               locked=True)
+
+    def _lock(self):
+        return utils.PathLock(os.path.join(self.storage,
+                                           '{0}.lock'.format(INDEX_FILE)))
+
+    def _read_index(self):
+
+        """
+        Read the daemons index, reconciling it with the stored daemons if
+        they are not the indexed ones (e.g. daemons were stored by an agent
+        version that did not maintain the index).
+
+        :return: a dict of daemon names to their indexed properties.
+        """
+
+        if not os.path.isdir(self.storage):
+            return {}
+        index_path = os.path.join(self.storage, INDEX_FILE)
+        try:
+            index = utils.json_load(index_path)
+        except (OSError, IOError, ValueError):
+            index = {}
+        if set(index) == self._stored_names():
+            return index
+        try:
+            return self._update_index(lambda index: None)
+        except (OSError, IOError) as e:
+            # e.g. listing daemons without write access to the storage
+            self.logger.debug('Failed updating the daemons index, using '
+                              'the stored daemons instead: {0}'.format(e))
+            self._reconcile_index(index)
+            return index
+
+    def _update_index(self, update, locked=False):
+
+        """
+        Atomically update the daemons index.
+
+        :param update: a function modifying the index dict in place.
+        :param locked: whether the storage lock is already held.
+
+        :return: the updated index.
+        """
+
+        if not locked:
+            utils.safe_create_dir(self.storage)
+            with self._lock():
+                return self._update_index(update, locked=True)
+        index_path = os.path.join(self.storage, INDEX_FILE)
+        try:
+            index = utils.json_load(index_path)
+        except (OSError, IOError, ValueError):
+            index = {}
+        self._reconcile_index(index)
+        update(index)
+        utils.write_file_atomically(index_path, json.dumps(index, indent=2))
+        return index
+
+    def _stored_names(self):
+        return set(daemon_file[:-len('.json')]
+                   for daemon_file in os.listdir(self.storage)
+                   if daemon_file.endswith('.json'))
+
+    def _reconcile_index(self, index):
+        stored = self._stored_names()
+        for name in set(index) - stored:
+            del index[name]
+        for name in stored - set(index):
+            daemon_path = os.path.join(self.storage, '{0}.json'.format(name))
+            try:
+                process_management = utils.json_load(
+                    daemon_path)['process_management']
+            except (OSError, IOError, ValueError, KeyError):
+                # deleted meanwhile, or not a daemon
+                continue
+            index[name] = {'process_management': process_management}
+
+
+class LazyDaemon(object):
+
+    """
+    A stored daemon that is only loaded (and constructed) once any of its
+    attributes other than its name is used.
+    """
+
+    def __init__(self, factory, name, logger=None):
+        self.__dict__.update(name=name,
+                             _factory=factory,
+                             _logger=logger,
+                             _daemon=None)
+
+    def _load(self):
+        if self._daemon is None:
+            self.__dict__['_daemon'] = self._factory.load(
+                self.name, logger=self._logger)
+        return self._daemon
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
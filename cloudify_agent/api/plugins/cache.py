@@ -0,0 +1,640 @@
+#########
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import os
+import re
+import sys
+import json
+import time
+import errno
+import shutil
+import hashlib
+import tempfile
+
+from wagon import utils as wagon_utils
+
+from cloudify.utils import setup_logger
+
+from cloudify_agent.api import utils
+from cloudify_agent.api import defaults
+from cloudify_agent.api.plugins import download
+
+HASH_CHUNK_SIZE = 64 * 1024
+
+
+class LRUDiskCache(object):
+
+    """
+    A size bounded on-disk cache.
+
+    Every file or directory directly under the cache root is an entry.
+    The modification time of an entry serves as its last access time, so
+    once the cache grows beyond its size budget, the least recently used
+    entries are evicted first. Names starting with a '.' are reserved for
+    the cache own bookkeeping (locks, temporary files, etc...) and are
+    never considered entries.
+    """
+
+    def __init__(self, root, max_size, logger=None):
+
+        """
+        :param root: the directory the cache is stored in.
+        :param max_size: the size budget of the cache in bytes. A value of
+                         0 disables the cache.
+        :param logger: a logger to use.
+        """
+
+        self.root = root
+        self.max_size = max_size
+        self.logger = logger or setup_logger(self.__class__.__name__)
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    @property
+    def tmp_dir(self):
+        return self._internal_dir('.tmp')
+
+    def lock(self, name='cache'):
+
+        """
+        Returns an inter-process (and inter-thread) lock. By default, the
+        cache wide lock is returned, which guards eviction.
+
+        :param name: the name of the lock.
+        """
+
+        return utils.PathLock(os.path.join(
+            self._internal_dir('.locks'), '{0}.lock'.format(name)))
+
+    def entries(self):
+
+        """
+        List the cache entries, least recently used first.
+
+        :return: a list of (path, size, last_used) tuples.
+        """
+
+        if not os.path.isdir(self.root):
+            return []
+        result = []
+        for name in os.listdir(self.root):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(self.root, name)
+            try:
+                last_used = os.path.getmtime(path)
+                size = path_size(path)
+            except OSError as e:
+                # removed concurrently
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            result.append((path, size, last_used))
+        return sorted(result, key=lambda entry: entry[2])
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def touch(self, path):
+
+        """
+        Mark an entry as recently used.
+        """
+
+        try:
+            os.utime(path, None)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def evict(self, max_size=None, keep=()):
+
+        """
+        Remove least recently used entries until the cache fits in
+        `max_size`.
+
+        :param max_size: the size to shrink the cache to, defaults to the
+                         cache size budget.
+        :param keep: paths of entries that must not be evicted.
+
+        :return: the number of bytes reclaimed.
+        """
+
+        if max_size is None:
+            max_size = self.max_size
+        reclaimed = 0
+        with self.lock():
+            entries = self.entries()
+            total = sum(size for _, size, _ in entries)
+            for path, size, _ in entries:
+                if total <= max_size:
+                    break
+                if path in keep:
+                    continue
+                self.logger.debug('Evicting cache entry: {0} [{1} bytes]'
+                                  .format(path, size))
+                self._remove(path)
+                total -= size
+                reclaimed += size
+        return reclaimed
+
+    def clear(self):
+        return self.evict(max_size=0)
+
+    def stats(self):
+        entries = self.entries()
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(entries),
+            'size': sum(size for _, size, _ in entries),
+            'max_size': self.max_size
+        }
+
+    def _internal_dir(self, name):
+        path = os.path.join(self.root, name)
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        return path
+
+    @staticmethod
+    def _remove(path):
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+
+class WagonCache(LRUDiskCache):
+
+    """
+    A content addressed cache of managed plugin wagons.
+
+    Wagon archives are stored under their sha256 digest, and a reference
+    from the plugin ID to the digest is kept in the `.refs` directory.
+    A plugin ID on the manager always refers to the same archive, so a
+    reference that points to an existing archive of the recorded size
+    is a cache hit.
+    """
+
+    def __init__(self, root=None, max_size=None, logger=None):
+        if root is None:
+            root = os.path.join(utils.internal.get_plugins_cache_dir(),
+                                'wagons')
+        if max_size is None:
+            max_size = utils.internal.get_wagon_cache_max_size()
+        super(WagonCache, self).__init__(root=root,
+                                         max_size=max_size,
+                                         logger=logger)
+
+    def get(self, plugin_id):
+
+        """
+        Lookup the cached wagon of a plugin.
+
+        :param plugin_id: the manager plugin ID.
+
+        :return: path to the cached wagon, or None on cache miss.
+        """
+
+        path = self._lookup(plugin_id)
+        if path:
+            self.hits += 1
+            self.touch(path)
+            self.logger.debug('Wagon cache hit: {0} [{1}]'
+                              .format(plugin_id, path))
+        else:
+            self.misses += 1
+            self.logger.debug('Wagon cache miss: {0}'.format(plugin_id))
+        return path
+
+    def put(self, plugin_id, wagon_path):
+
+        """
+        Move a wagon into the cache.
+
+        :param plugin_id: the manager plugin ID.
+        :param wagon_path: path to the wagon. The file is moved, so it
+                           should reside on the same file system as the
+                           cache (e.g. under `tmp_dir`).
+
+        :return: path to the cached wagon.
+        """
+
+        digest = file_digest(wagon_path)
+        size = os.path.getsize(wagon_path)
+        path = os.path.join(self.root, digest)
+        if os.path.exists(path):
+            os.remove(wagon_path)
+            self.touch(path)
+        else:
+            os.rename(wagon_path, path)
+        self._write_ref(plugin_id, {'digest': digest, 'size': size})
+        self.evict(keep=(path,))
+        return path
+
+    def fetch(self, plugin_id, download, output_file=None):
+
+        """
+        Return the cached wagon of a plugin, populating the cache on miss.
+        Concurrent fetches of the same plugin (from any process) download
+        the wagon only once.
+
+        :param plugin_id: the manager plugin ID.
+        :param download: a function accepting an output file path, that
+                         downloads the wagon into it.
+        :param output_file: a path to link (or copy) the wagon to. Unlike
+                            the cached wagon, which may be evicted at any
+                            time, it remains until removed by the caller.
+
+        :return: a tuple of the path to the cached wagon (or `output_file`
+                 if specified), and whether it was a cache hit.
+        """
+
+        with self.lock(_safe_key(plugin_id)):
+            path = self.get(plugin_id)
+            if path and (output_file is None or
+                         self._link(path, output_file)):
+                return output_file or path, True
+            # the rest client refuses to download into an existing file
+            tmp_dir = tempfile.mkdtemp(dir=self.tmp_dir)
+            tmp_path = os.path.join(tmp_dir, 'wagon.tar.gz')
+            try:
+                download(tmp_path)
+                if output_file:
+                    _link_or_copy(tmp_path, output_file)
+                path = self.put(plugin_id, tmp_path)
+                return output_file or path, False
+            finally:
+                self._remove(tmp_dir)
+
+    def _link(self, path, output_file):
+        # entries are evicted under the cache wide lock
+        with self.lock():
+            if not os.path.isfile(path):
+                return False
+            _link_or_copy(path, output_file)
+            return True
+
+    def _lookup(self, plugin_id):
+        ref_path = self._ref_path(plugin_id)
+        try:
+            with open(ref_path) as f:
+                ref = json.load(f)
+        except (IOError, ValueError):
+            return None
+        path = os.path.join(self.root, ref['digest'])
+        try:
+            if os.path.getsize(path) == ref['size']:
+                return path
+        except OSError:
+            pass
+        # the archive was evicted, or is corrupted
+        self._remove(ref_path)
+        return None
+
+    def _write_ref(self, plugin_id, ref):
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(ref, f)
+        os.rename(tmp_path, self._ref_path(plugin_id))
+
+    def _ref_path(self, plugin_id):
+        return os.path.join(self._internal_dir('.refs'), _safe_key(plugin_id))
+
+
+class SourceCache(LRUDiskCache):
+
+    """
+    A cache of source plugin archives downloaded over HTTP.
+
+    Archives are stored under their sha256 digest, and a reference from
+    the archive URL to the digest is kept in the `.refs` directory, along
+    with the HTTP validators (ETag, Last-Modified) of the download. Unlike
+    plugin IDs, URLs may serve different content over time, so entries are
+    only used as is for `ttl` seconds after they were downloaded (or
+    revalidated), and are then revalidated with a conditional request.
+    URLs pinning the archive digest (`#sha256=<hex>`) never go stale.
+    """
+
+    def __init__(self, root=None, max_size=None, ttl=None, logger=None):
+        if root is None:
+            root = os.path.join(utils.internal.get_plugins_cache_dir(),
+                                'sources')
+        if max_size is None:
+            max_size = utils.internal.get_source_cache_max_size()
+        super(SourceCache, self).__init__(root=root,
+                                          max_size=max_size,
+                                          logger=logger)
+        self.ttl = defaults.SOURCE_CACHE_TTL if ttl is None else ttl
+
+    @staticmethod
+    def cacheable(url):
+
+        """
+        Whether archives of a URL are cached. Local files are not.
+        """
+
+        return url.split('://', 1)[0] in ['http', 'https']
+
+    def fetch(self, url):
+
+        """
+        Return the cached archive of a URL, downloading it if it is not
+        cached, or if it is stale and was modified. Concurrent fetches of
+        the same URL (from any process) download the archive only once.
+
+        :param url: the archive URL.
+
+        :return: a tuple of the path to the cached archive, and whether it
+                 was a cache hit.
+        """
+
+        key = hashlib.sha256(url).hexdigest()
+        with self.lock(key):
+            ref = self._read_ref(key)
+            path = self._archive(key, ref)
+            if path and self._fresh(url, ref):
+                return self._hit(url, path), True
+            tmp_dir = tempfile.mkdtemp(dir=self.tmp_dir)
+            try:
+                tmp_path = os.path.join(tmp_dir, 'archive')
+                result = download.download_to_file(
+                    url,
+                    tmp_path,
+                    etag=ref.get('etag') if path else None,
+                    last_modified=ref.get('last_modified') if path else None,
+                    logger=self.logger)
+                if result is None:
+                    ref['validated_at'] = time.time()
+                    self._write_ref(key, ref)
+                    return self._hit(url, path), True
+                self.misses += 1
+                self.logger.debug('Source cache miss: {0}'.format(url))
+                return self._put(key, url, tmp_path, result), False
+            finally:
+                self._remove(tmp_dir)
+
+    def _hit(self, url, path):
+        self.hits += 1
+        self.touch(path)
+        self.logger.debug('Source cache hit: {0} [{1}]'.format(url, path))
+        return path
+
+    def _put(self, key, url, archive_path, result):
+        path = os.path.join(self.root, result.digest)
+        if os.path.exists(path):
+            self.touch(path)
+        else:
+            os.rename(archive_path, path)
+        self._write_ref(key, {
+            'url': url,
+            'digest': result.digest,
+            'size': result.size,
+            'etag': result.etag,
+            'last_modified': result.last_modified,
+            'validated_at': time.time()
+        })
+        self.evict(keep=(path,))
+        return path
+
+    def _fresh(self, url, ref):
+        _, _, fragment = url.partition('#')
+        if 'sha256={0}'.format(ref['digest']) in fragment:
+            return True
+        return time.time() - ref.get('validated_at', 0) < self.ttl
+
+    def _archive(self, key, ref):
+        if not ref:
+            return None
+        path = os.path.join(self.root, ref['digest'])
+        try:
+            if os.path.getsize(path) == ref['size']:
+                return path
+        except OSError:
+            pass
+        # the archive was evicted, or is corrupted
+        self._remove(self._ref_path(key))
+        return None
+
+    def _read_ref(self, key):
+        try:
+            with open(self._ref_path(key)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _write_ref(self, key, ref):
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(ref, f)
+        os.rename(tmp_path, self._ref_path(key))
+
+    def _ref_path(self, key):
+        return os.path.join(self._internal_dir('.refs'), key)
+
+
+class Wheelhouse(LRUDiskCache):
+
+    """
+    A host wide wheelhouse of source plugin builds.
+
+    Every entry is a directory holding the wheels of a source plugin and
+    of the dependencies it installed, built for a specific source archive
+    on a specific platform. Installing from an entry requires no
+    compilation, and no access to the package index.
+    """
+
+    METADATA_FILE = 'wheelhouse.json'
+
+    def __init__(self, root=None, max_size=None, logger=None):
+        if root is None:
+            root = os.path.join(utils.internal.get_plugins_cache_dir(),
+                                'wheelhouse')
+        if max_size is None:
+            max_size = utils.internal.get_wheelhouse_max_size()
+        super(Wheelhouse, self).__init__(root=root,
+                                         max_size=max_size,
+                                         logger=logger)
+
+    @staticmethod
+    def key(source, digest, install_args=''):
+
+        """
+        The wheelhouse key of a source plugin build.
+
+        :param source: the plugin source URL.
+        :param digest: the plugin source archive digest.
+        :param install_args: the plugin install arguments, which may
+                             affect what gets installed.
+        """
+
+        if source.startswith('file://'):
+            # local files are temporary copies of blueprint resources
+            source = os.path.basename(source)
+        return hashlib.sha256(json.dumps([
+            source,
+            digest,
+            wagon_utils.get_platform(),
+            'py{0}{1}'.format(*sys.version_info[:2]),
+            install_args or ''])).hexdigest()
+
+    def get(self, key):
+
+        """
+        Lookup a wheelhouse entry.
+
+        :return: path to the entry wheels directory, or None on miss.
+        """
+
+        path = self._lookup(key)
+        if path:
+            self.hits += 1
+            self.touch(path)
+            self.logger.debug('Wheelhouse hit: {0}'.format(key))
+            return path
+        self.misses += 1
+        self.logger.debug('Wheelhouse miss: {0}'.format(key))
+        return None
+
+    def build(self, key, build, metadata=None):
+
+        """
+        Return a wheelhouse entry, building it on miss. Concurrent builds
+        of the same entry (from any process) run only once.
+
+        :param key: the entry key (see `key`).
+        :param build: a function accepting a directory path, that builds
+                      the entry wheels into it.
+        :param metadata: a dict describing the entry, shown when listing
+                         the wheelhouse.
+
+        :return: path to the entry wheels directory.
+        """
+
+        with self.lock(key):
+            # built concurrently while waiting for the lock?
+            path = self._lookup(key)
+            if path:
+                return path
+            tmp_path = tempfile.mkdtemp(dir=self.tmp_dir)
+            try:
+                build(tmp_path)
+                metadata = dict(metadata or {})
+                metadata.update({
+                    'created_at': time.time(),
+                    'platform': wagon_utils.get_platform(),
+                    'wheels': sorted(name for name in os.listdir(tmp_path)
+                                     if name.endswith('.whl'))
+                })
+                with open(os.path.join(tmp_path, self.METADATA_FILE),
+                          'w') as f:
+                    json.dump(metadata, f)
+                path = os.path.join(self.root, key)
+                # an incomplete entry (e.g. left by a crash) is rebuilt
+                self._remove(path)
+                os.rename(tmp_path, path)
+            finally:
+                self._remove(tmp_path)
+            self.evict(keep=(path,))
+            return path
+
+    def _lookup(self, key):
+        path = os.path.join(self.root, key)
+        if os.path.isfile(os.path.join(path, self.METADATA_FILE)):
+            return path
+        return None
+
+    def list(self):
+
+        """
+        Describe the wheelhouse entries, least recently used first.
+
+        :return: a list of dicts, the entries metadata along with their
+                 `key`, `path`, `size` and `last_used` time.
+        """
+
+        result = []
+        for path, size, last_used in self.entries():
+            try:
+                with open(os.path.join(path, self.METADATA_FILE)) as f:
+                    metadata = json.load(f)
+            except (IOError, ValueError):
+                metadata = {}
+            metadata.update({
+                'key': os.path.basename(path),
+                'path': path,
+                'size': size,
+                'last_used': last_used
+            })
+            result.append(metadata)
+        return result
+
+
+def file_digest(path):
+
+    """
+    Calculate the sha256 hex digest of a file.
+
+    :param path: path to the file.
+    """
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def path_size(path):
+
+    """
+    The size of a file, or the total size of the files under a directory.
+    """
+
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    size = 0
+    for dir_path, _, file_names in os.walk(path):
+        for file_name in file_names:
+            file_path = os.path.join(dir_path, file_name)
+            if not os.path.islink(file_path):
+                size += os.path.getsize(file_path)
+    return size
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except (AttributeError, OSError):
+        # hard links are not supported by python 2 on windows, nor across
+        # file systems
+        shutil.copyfile(src, dst)
+
+
+def _safe_key(key):
+    return re.sub(r'[^\w.-]', '_', str(key))
@@ -0,0 +1,154 @@
+#########
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+In-process replacement for running `pip freeze` in the agent virtualenv.
+
+Plugins are installed with a constraint file pinning every package already
+installed in the agent virtualenv. Building it from the installed
+distributions metadata is much cheaper than spawning pip, and the result
+is memoized until the site-packages or plugins directories change.
+"""
+
+import os
+import sys
+import threading
+from distutils import sysconfig
+
+import pkg_resources
+
+from cloudify_agent import VIRTUALENV
+
+# pip freeze does not list these by default (the last three are part of
+# the standard library)
+EXCLUDED_PACKAGES = ('pip', 'setuptools', 'distribute', 'wheel',
+                     'python', 'wsgiref', 'argparse')
+
+_lock = threading.Lock()
+_snapshot = None
+_snapshot_key = None
+_generation = 0
+
+
+class ConstraintsSnapshot(object):
+
+    """
+    The installed distributions of the agent virtualenv, indexed by their
+    normalized project name.
+    """
+
+    def __init__(self, distributions):
+        self._index = {}
+        for dist in distributions:
+            key = normalize(dist.project_name)
+            if key in EXCLUDED_PACKAGES or key in self._index:
+                # first one on the path wins, as it does on import
+                continue
+            self._index[key] = (dist.project_name, dist.version)
+
+    def __contains__(self, package_name):
+        return normalize(package_name) in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def get_version(self, package_name):
+
+        """
+        Returns the installed version of a package, or None if the package
+        is not installed.
+
+        :param package_name: the package name. any of the names pip
+                             considers equivalent may be used.
+        """
+
+        installed = self._index.get(normalize(package_name))
+        return installed[1] if installed else None
+
+    def render(self):
+
+        """
+        Render the snapshot in the `pip freeze` (and constraint file)
+        format.
+        """
+
+        lines = sorted('{0}=={1}'.format(name, version)
+                       for name, version in self._index.itervalues())
+        return '\n'.join(lines) + '\n'
+
+
+def normalize(package_name):
+    return pkg_resources.safe_name(package_name).lower()
+
+
+def get_snapshot():
+
+    """
+    Returns a (memoized) snapshot of the agent virtualenv installed
+    packages.
+    """
+
+    global _snapshot, _snapshot_key
+    with _lock:
+        key = (_generation, _stat_key())
+        if _snapshot is None or key != _snapshot_key:
+            _snapshot = ConstraintsSnapshot(
+                pkg_resources.WorkingSet(_search_path()))
+            _snapshot_key = key
+        return _snapshot
+
+
+def invalidate():
+
+    """
+    Invalidate the memoized snapshot. Call this after installing packages
+    into the agent virtualenv in ways that may not change the
+    site-packages directories modification time.
+    """
+
+    global _generation
+    with _lock:
+        _generation += 1
+
+
+def _site_packages_dirs():
+    return sorted(set([sysconfig.get_python_lib(),
+                       sysconfig.get_python_lib(plat_specific=True)]))
+
+
+def _plugins_dir():
+    return os.path.join(VIRTUALENV, 'plugins')
+
+
+def _stat_key():
+    key = []
+    for path in _site_packages_dirs() + [_plugins_dir()]:
+        try:
+            key.append((path, os.stat(path).st_mtime))
+        except OSError:
+            key.append((path, None))
+    return tuple(key)
+
+
+def _search_path():
+    # sys.path includes the site-packages directories as well as
+    # directories added by .pth files (i.e. develop installations) which
+    # pip freeze also lists. Plugins prefixes are never part of the agent
+    # virtualenv.
+    plugins_dir = os.path.join(_plugins_dir(), '')
+    return [path for path in sys.path
+            if path and
+            os.path.isdir(path) and
+            not os.path.abspath(path).startswith(plugins_dir)]
@@ -0,0 +1,429 @@
+#########
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+Deduplication of plugin installation prefixes.
+
+Source plugins are installed into a private prefix per deployment, so
+many deployments of the same blueprint result in many identical trees.
+The dedup store keeps the content of every file once, under its digest,
+and the files of a prefix are (hard or ref) links to the stored objects.
+
+Every deduplicated prefix holds a manifest of the objects it links to,
+and the store counts the prefixes referencing every object, so removing a
+prefix only drops its links and references, after which objects no
+longer referenced by any prefix are garbage collected. Manifests are also
+kept in the store by build key, which allows materializing an identical
+prefix out of the stored objects without installing anything.
+"""
+
+import os
+import json
+import stat
+import errno
+import shutil
+import tempfile
+
+from cloudify.utils import setup_logger
+
+from cloudify_agent import VIRTUALENV
+from cloudify_agent.api import utils
+from cloudify_agent.api.plugins import cache
+
+OFF = 'off'
+HARDLINK = 'hardlink'
+REFLINK = 'reflink'
+MODES = (OFF, HARDLINK, REFLINK)
+
+MANIFEST_FILE = '.dedup.json'
+
+# files of a prefix that are specific to a single installation
+EXCLUDED_FILES = (MANIFEST_FILE, 'constraint.txt', 'plugin.id')
+
+# linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+
+class DedupStore(object):
+
+    """
+    A content addressed store of plugin prefix files.
+    """
+
+    def __init__(self, root=None, mode=None, logger=None):
+
+        """
+        :param root: the directory the store is kept in. Must be on the same
+                     file system as the deduplicated prefixes.
+        :param mode: one of `MODES`, defaults to the configured mode.
+        :param logger: a logger to use.
+        """
+
+        if root is None:
+            root = os.path.join(VIRTUALENV, 'plugins', '.dedup')
+        if mode is None:
+            mode = utils.internal.get_plugins_dedup_mode()
+        if mode not in MODES:
+            raise ValueError('Invalid plugins dedup mode: {0} (expected one '
+                             'of: {1})'.format(mode, ', '.join(MODES)))
+        self.root = root
+        self.mode = mode
+        self.logger = logger or setup_logger(self.__class__.__name__)
+        self._reflink_supported = True
+
+    @property
+    def enabled(self):
+        # hard links are not supported by python 2 on windows
+        return self.mode != OFF and hasattr(os, 'link')
+
+    @property
+    def objects_dir(self):
+        return os.path.join(self.root, 'objects')
+
+    @property
+    def trees_dir(self):
+        return os.path.join(self.root, 'trees')
+
+    @property
+    def references_path(self):
+        return os.path.join(self.root, 'references.json')
+
+    @property
+    def tmp_dir(self):
+        path = os.path.join(self.root, 'tmp')
+        utils.safe_create_dir(path)
+        return path
+
+    def lock(self):
+
+        """
+        The store wide lock, which guards linking against garbage
+        collection.
+        """
+
+        utils.safe_create_dir(self.root)
+        return utils.PathLock(os.path.join(self.root, '.lock'))
+
+    def ingest(self, prefix, key=None):
+
+        """
+        Replace the files of a prefix with links to stored objects, adding
+        objects for content that is not stored yet.
+
+        :param prefix: the installation prefix.
+        :param key: a key identifying the build of the prefix (see
+                    `Wheelhouse.key`). If specified, the prefix can later
+                    be materialized by that key.
+
+        :return: the prefix manifest.
+        """
+
+        manifest = read_manifest(prefix)
+        if manifest is not None:
+            # already deduplicated (e.g. materialized)
+            return manifest
+        manifest = {'key': key, 'dirs': [], 'symlinks': [], 'files': []}
+        # the prefix is not shared yet, so its files are hashed without
+        # holding the store lock
+        files = []
+        for dir_path, dir_names, file_names in os.walk(prefix):
+            rel_dir = os.path.relpath(dir_path, prefix)
+            for name in list(dir_names):
+                path = os.path.join(dir_path, name)
+                rel_path = os.path.normpath(os.path.join(rel_dir, name))
+                if os.path.islink(path):
+                    # os.walk does not follow links to directories
+                    manifest['symlinks'].append(
+                        [rel_path, os.readlink(path)])
+                else:
+                    manifest['dirs'].append(rel_path)
+            for name in file_names:
+                path = os.path.join(dir_path, name)
+                rel_path = os.path.normpath(os.path.join(rel_dir, name))
+                if rel_dir == '.' and name in EXCLUDED_FILES:
+                    continue
+                if os.path.islink(path):
+                    manifest['symlinks'].append(
+                        [rel_path, os.readlink(path)])
+                    continue
+                if not os.path.isfile(path):
+                    continue
+                files.append((rel_path, path, _object_name(path)))
+        linked = 0
+        with self.lock():
+            for rel_path, path, object_name in files:
+                linked += self._store(path, object_name)
+                manifest['files'].append([rel_path, object_name])
+            self._add_references(manifest)
+            _write_json(os.path.join(prefix, MANIFEST_FILE), manifest)
+            if key:
+                utils.safe_create_dir(self.trees_dir)
+                _write_json(os.path.join(self.trees_dir, key), manifest)
+        self.logger.debug('Deduplicated {0}: {1} files, {2} already stored'
+                          .format(prefix, len(manifest['files']), linked))
+        return manifest
+
+    def materialize(self, key, prefix):
+
+        """
+        Populate a prefix with links to the objects of a previously
+        ingested build.
+
+        :param key: the build key.
+        :param prefix: an existing installation prefix directory.
+
+        :return: whether the prefix was materialized. False if the build
+                 is unknown, or some of its objects were garbage collected.
+        """
+
+        tree_path = os.path.join(self.trees_dir, key)
+        with self.lock():
+            try:
+                with open(tree_path) as f:
+                    manifest = json.load(f)
+            except (IOError, ValueError):
+                return False
+            for _, object_name in manifest['files']:
+                if not os.path.isfile(self._object_path(object_name)):
+                    self.logger.debug('Dedup build {0} is incomplete, '
+                                      'removing it'.format(key))
+                    os.remove(tree_path)
+                    return False
+            for rel_path in manifest['dirs']:
+                utils.safe_create_dir(os.path.join(prefix, rel_path))
+            for rel_path, target in manifest['symlinks']:
+                os.symlink(target, os.path.join(prefix, rel_path))
+            for rel_path, object_name in manifest['files']:
+                self._link(self._object_path(object_name),
+                           os.path.join(prefix, rel_path))
+            self._add_references(manifest)
+            _write_json(os.path.join(prefix, MANIFEST_FILE), manifest)
+        self.logger.debug('Materialized {0} from dedup build {1}'
+                          .format(prefix, key))
+        return True
+
+    def release(self, prefix):
+
+        """
+        Remove a deduplicated prefix, and garbage collect the objects it
+        referenced, if no other prefix references them.
+
+        :return: the number of bytes reclaimed from the store.
+        """
+
+        manifest = read_manifest(prefix)
+        shutil.rmtree(prefix, ignore_errors=True)
+        return self.forget(manifest) if manifest else 0
+
+    def forget(self, manifest):
+
+        """
+        Drop the references of a removed prefix, and garbage collect the
+        objects no other prefix references.
+
+        :param manifest: the manifest of the removed prefix (see
+                         `read_manifest`).
+
+        :return: the number of bytes reclaimed.
+        """
+
+        object_names = set(object_name for _, object_name
+                           in manifest['files'])
+        with self.lock():
+            references = self._load_references()
+            for object_name in object_names:
+                count = references.pop(object_name, 0) - 1
+                if count > 0:
+                    references[object_name] = count
+            _write_json(self.references_path, references)
+            return self._collect(object_names, references)
+
+    def gc(self, candidates=None):
+
+        """
+        Remove unreferenced objects.
+
+        An object is referenced if some prefix links to it, which shows
+        in its link count for hard links, or if the manifest of some
+        prefix lists it, which shows in its reference count (e.g. for
+        objects that were reflinked, or copied because linking failed).
+
+        :param candidates: names of objects to consider, defaults to all.
+
+        :return: the number of bytes reclaimed.
+        """
+
+        with self.lock():
+            if candidates is None:
+                candidates = self._all_objects()
+            return self._collect(candidates, self._load_references())
+
+    def _collect(self, candidates, references):
+        reclaimed = 0
+        for object_name in candidates:
+            if references.get(object_name):
+                continue
+            object_path = self._object_path(object_name)
+            try:
+                st = os.stat(object_path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            if st.st_nlink > 1:
+                continue
+            os.remove(object_path)
+            reclaimed += st.st_size
+        if reclaimed:
+            self.logger.debug('Reclaimed {0} bytes from the dedup store'
+                              .format(reclaimed))
+        return reclaimed
+
+    def _add_references(self, manifest):
+        references = self._load_references()
+        for object_name in set(object_name for _, object_name
+                               in manifest['files']):
+            references[object_name] = references.get(object_name, 0) + 1
+        _write_json(self.references_path, references)
+
+    def _load_references(self):
+        try:
+            with open(self.references_path) as f:
+                return json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        except ValueError:
+            pass
+        # lost, or created before references were counted
+        return self._count_references()
+
+    def _store(self, path, object_name):
+        # returns 1 if the content was already stored, 0 otherwise
+        object_path = self._object_path(object_name)
+        if os.path.isfile(object_path):
+            if not os.path.samefile(object_path, path):
+                self._replace(object_path, path)
+            return 1
+        utils.safe_create_dir(os.path.dirname(object_path))
+        # stored objects are shared, make sure they are not modified
+        # in place through one of their links
+        os.chmod(path, stat.S_IMODE(os.stat(path).st_mode) &
+                 ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+        tmp_path = _tmp_path(object_path)
+        os.link(path, tmp_path)
+        os.rename(tmp_path, object_path)
+        return 0
+
+    def _replace(self, object_path, path):
+        tmp_path = _tmp_path(path)
+        self._link(object_path, tmp_path)
+        os.rename(tmp_path, path)
+
+    def _link(self, object_path, path):
+        if self.mode == REFLINK and self._reflink_supported:
+            try:
+                _reflink(object_path, path)
+                return
+            except (IOError, OSError) as e:
+                self.logger.debug('Reflinks are not supported ({0}), '
+                                  'falling back to hard links'.format(e))
+                self._reflink_supported = False
+                _silent_remove(path)
+        try:
+            os.link(object_path, path)
+        except OSError as e:
+            # different file systems, or too many links
+            if e.errno not in (errno.EXDEV, errno.EMLINK):
+                raise
+            shutil.copy2(object_path, path)
+
+    def _object_path(self, object_name):
+        return os.path.join(self.objects_dir, object_name[:2], object_name)
+
+    def _all_objects(self):
+        if not os.path.isdir(self.objects_dir):
+            return []
+        return [name
+                for sub_dir in os.listdir(self.objects_dir)
+                for name in os.listdir(os.path.join(self.objects_dir,
+                                                    sub_dir))
+                if not name.startswith('.')]
+
+    def _count_references(self):
+        references = {}
+        plugins_dir = os.path.dirname(os.path.abspath(self.root))
+        for name in os.listdir(plugins_dir):
+            manifest = read_manifest(os.path.join(plugins_dir, name))
+            if not manifest:
+                continue
+            for object_name in set(object_name for _, object_name
+                                   in manifest['files']):
+                references[object_name] = references.get(object_name, 0) + 1
+        return references
+
+
+def read_manifest(prefix):
+
+    """
+    Read the dedup manifest of a prefix.
+
+    :return: the manifest, or None if the prefix is not deduplicated.
+    """
+
+    try:
+        with open(os.path.join(prefix, MANIFEST_FILE)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def _object_name(path):
+    object_name = cache.file_digest(path)
+    if os.stat(path).st_mode & stat.S_IXUSR:
+        object_name = '{0}-x'.format(object_name)
+    return object_name
+
+
+def _reflink(src, dst):
+    import fcntl
+    with open(src, 'rb') as src_file:
+        with open(dst, 'wb') as dst_file:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+    shutil.copystat(src, dst)
+
+
+def _write_json(path, content):
+    tmp_path = _tmp_path(path)
+    with open(tmp_path, 'w') as f:
+        json.dump(content, f)
+    os.rename(tmp_path, path)
+
+
+def _tmp_path(path):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                    prefix='.{0}.'.format(
+                                        os.path.basename(path)))
+    os.close(fd)
+    os.remove(tmp_path)
+    return tmp_path
+
+
+def _silent_remove(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
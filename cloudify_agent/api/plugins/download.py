@@ -0,0 +1,526 @@
+#########
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+Streaming download and extraction of plugin source archives.
+
+Tar archives (optionally gzip or bzip2 compressed) are extracted while
+they are being downloaded. Zip archives cannot be read without seeking
+to their central directory at the end, so they are spooled to a
+temporary file first. Either way, the archive digest is calculated on the
+fly, and HTTP downloads are resumed using range requests if the
+connection drops. If the archive cannot be resumed (e.g. it changed
+since the download started), whatever was downloaded is discarded and
+the download restarts.
+
+Archives may also be downloaded as is (e.g. into a cache), conditionally
+on having changed since a previous download.
+"""
+
+import os
+import time
+import shutil
+import socket
+import httplib
+import hashlib
+import tarfile
+import zipfile
+import tempfile
+import urlparse
+import urllib
+
+import requests
+from requests.packages.urllib3 import exceptions as urllib3_exceptions
+
+from cloudify.utils import setup_logger
+
+from cloudify_agent.api import defaults
+from cloudify_agent.api import exceptions
+
+CHUNK_SIZE = 64 * 1024
+
+_CONNECTION_ERRORS = (socket.error,
+                      httplib.HTTPException,
+                      requests.exceptions.RequestException,
+                      urllib3_exceptions.HTTPError)
+
+
+class _DownloadRestarted(Exception):
+
+    """
+    Raised while reading a stream that restarted from its beginning, after
+    which whatever was read from it so far must be discarded.
+    """
+
+    pass
+
+
+class DownloadResult(object):
+
+    def __init__(self,
+                 url,
+                 digest,
+                 size,
+                 elapsed,
+                 resumes,
+                 etag=None,
+                 last_modified=None):
+        self.url = url
+        self.digest = digest
+        self.size = size
+        self.elapsed = elapsed
+        self.resumes = resumes
+        self.etag = etag
+        self.last_modified = last_modified
+
+    @property
+    def throughput(self):
+
+        """
+        Download throughput in bytes per second.
+        """
+
+        return self.size / self.elapsed if self.elapsed else float(self.size)
+
+    def __str__(self):
+        return ('{0} [{1} bytes in {2:.2f} seconds, {3:.1f} KB/s, '
+                'resumed {4} times, sha256: {5}]'
+                .format(self.url, self.size, self.elapsed,
+                        self.throughput / 1024, self.resumes, self.digest))
+
+
+def download_and_extract(url,
+                         target_dir,
+                         expected_digest=None,
+                         logger=None,
+                         retries=defaults.DOWNLOAD_RETRIES,
+                         timeout=defaults.DOWNLOAD_TIMEOUT):
+
+    """
+    Download an archive and extract it into `target_dir`. If all of the
+    archive content is under a single top level directory, the content of
+    that directory is extracted instead (similarly to pip).
+
+    :param url: http, https or file URL of the archive. a `#sha256=<hex>`
+                fragment, is verified like `expected_digest`.
+    :param target_dir: an existing (empty) directory to extract to.
+    :param expected_digest: the expected sha256 hex digest of the archive.
+    :param logger: a logger to report the download throughput to.
+    :param retries: the number of times to resume a dropped connection.
+    :param timeout: socket timeout in seconds.
+
+    :return: the download result.
+    :rtype: DownloadResult
+    """
+
+    logger = logger or setup_logger('cloudify_agent.api.plugins.download')
+    url, fragment_digest = _split_digest(url)
+    expected_digest = expected_digest or fragment_digest
+    start = time.time()
+    stream = _open(url, retries=retries, timeout=timeout, logger=logger)
+    try:
+        while True:
+            try:
+                if stream.peek(4) == b'PK\x03\x04':
+                    _extract_zip(stream, target_dir)
+                else:
+                    _extract_tar(stream, target_dir)
+                # drain any trailing bytes (e.g. tar padding), so that the
+                # digest covers the whole archive
+                while stream.read(CHUNK_SIZE):
+                    pass
+                break
+            except _DownloadRestarted:
+                _clear_dir(target_dir)
+    finally:
+        stream.close()
+    result = DownloadResult(url=url,
+                            digest=stream.hexdigest(),
+                            size=stream.offset,
+                            elapsed=time.time() - start,
+                            resumes=stream.resumes)
+    if expected_digest and expected_digest.lower() != result.digest:
+        raise exceptions.PluginInstallationError(
+            'Digest mismatch for {0}: expected sha256 {1} but got {2}'
+            .format(url, expected_digest, result.digest))
+    _strip_leading_dir(target_dir)
+    logger.info('Downloaded {0}'.format(result))
+    return result
+
+
+def download_to_file(url,
+                     output_path,
+                     etag=None,
+                     last_modified=None,
+                     expected_digest=None,
+                     logger=None,
+                     retries=defaults.DOWNLOAD_RETRIES,
+                     timeout=defaults.DOWNLOAD_TIMEOUT):
+
+    """
+    Download an archive into a file, unless it was not modified since a
+    previous download.
+
+    :param url: http, https or file URL of the archive. a `#sha256=<hex>`
+                fragment, is verified like `expected_digest`.
+    :param output_path: the file to write the archive to.
+    :param etag: the ETag of a previous download of the archive.
+    :param last_modified: the Last-Modified header of a previous download
+                          of the archive.
+    :param expected_digest: the expected sha256 hex digest of the archive.
+    :param logger: a logger to report the download throughput to.
+    :param retries: the number of times to resume a dropped connection.
+    :param timeout: socket timeout in seconds.
+
+    :return: the download result, or None if the archive was not modified
+             (as reported by the server).
+    :rtype: DownloadResult
+    """
+
+    logger = logger or setup_logger('cloudify_agent.api.plugins.download')
+    url, fragment_digest = _split_digest(url)
+    expected_digest = expected_digest or fragment_digest
+    start = time.time()
+    stream = _open(url,
+                   retries=retries,
+                   timeout=timeout,
+                   logger=logger,
+                   etag=etag,
+                   last_modified=last_modified)
+    try:
+        if stream.not_modified:
+            logger.debug('Not modified: {0}'.format(url))
+            return None
+        with open(output_path, 'wb') as f:
+            while True:
+                try:
+                    for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                        f.write(chunk)
+                    break
+                except _DownloadRestarted:
+                    f.seek(0)
+                    f.truncate()
+    finally:
+        stream.close()
+    result = DownloadResult(url=url,
+                            digest=stream.hexdigest(),
+                            size=stream.offset,
+                            elapsed=time.time() - start,
+                            resumes=stream.resumes,
+                            etag=stream.etag,
+                            last_modified=stream.last_modified)
+    if expected_digest and expected_digest.lower() != result.digest:
+        raise exceptions.PluginInstallationError(
+            'Digest mismatch for {0}: expected sha256 {1} but got {2}'
+            .format(url, expected_digest, result.digest))
+    logger.info('Downloaded {0}'.format(result))
+    return result
+
+
+class _HashingStream(object):
+
+    """
+    A read-only file-like object that hashes whatever is read through it,
+    with a small peek buffer used for detecting the archive format.
+    """
+
+    not_modified = False
+    etag = None
+    last_modified = None
+
+    def __init__(self):
+        self.offset = 0
+        self.resumes = 0
+        self._hash = hashlib.sha256()
+        self._buffer = b''
+
+    def peek(self, size):
+        while len(self._buffer) < size:
+            data = self._read_hashed(size - len(self._buffer))
+            if not data:
+                break
+            self._buffer += data
+        return self._buffer[:size]
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = []
+            while True:
+                data = self.read(CHUNK_SIZE)
+                if not data:
+                    return b''.join(chunks)
+                chunks.append(data)
+        if self._buffer:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+            return data
+        return self._read_hashed(size)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+    def close(self):
+        pass
+
+    def _read_hashed(self, size):
+        data = self._read(size)
+        if data:
+            self.offset += len(data)
+            self._hash.update(data)
+        return data
+
+    def _read(self, size):
+        raise NotImplementedError('Must be implemented by subclasses')
+
+
+class _FileStream(_HashingStream):
+
+    def __init__(self, path):
+        super(_FileStream, self).__init__()
+        self._file = open(path, 'rb')
+
+    def _read(self, size):
+        return self._file.read(size)
+
+    def close(self):
+        self._file.close()
+
+
+class _HTTPStream(_HashingStream):
+
+    """
+    An HTTP response body, that is transparently resumed with a range
+    request when the connection drops before the whole body was read.
+
+    The range request is conditional on the archive not having changed
+    since the download started (using If-Range). If it did change, or if
+    the server does not support range requests, the whole archive is
+    served again, and the stream restarts from its beginning.
+    """
+
+    def __init__(self,
+                 url,
+                 retries,
+                 timeout,
+                 logger,
+                 etag=None,
+                 last_modified=None):
+        super(_HTTPStream, self).__init__()
+        self.url = url
+        self.retries = retries
+        self.timeout = timeout
+        self.logger = logger
+        self.length = None
+        self._response = None
+        self._connect(etag=etag, last_modified=last_modified)
+
+    def _connect(self, etag=None, last_modified=None):
+        headers = {}
+        if self.offset:
+            headers['Range'] = 'bytes={0}-'.format(self.offset)
+            validator = self._range_validator()
+            if validator:
+                headers['If-Range'] = validator
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        response = requests.get(self.url,
+                                headers=headers,
+                                stream=True,
+                                timeout=self.timeout)
+        response.raise_for_status()
+        if response.status_code == httplib.NOT_MODIFIED:
+            self.not_modified = True
+            self._response = response
+            return
+        # the digest is of the archive as served, not of its decoded form
+        response.raw.decode_content = False
+        self._response = response
+        content_length = response.headers.get('content-length')
+        if response.status_code != httplib.PARTIAL_CONTENT:
+            self.etag = response.headers.get('etag')
+            self.last_modified = response.headers.get('last-modified')
+        if response.status_code == httplib.PARTIAL_CONTENT:
+            expected_range = 'bytes {0}-'.format(self.offset)
+            if not response.headers.get('content-range', '').startswith(
+                    expected_range):
+                raise exceptions.PluginInstallationError(
+                    'Unexpected content range when resuming download of '
+                    '{0}: {1}'.format(self.url,
+                                      response.headers.get('content-range')))
+            if content_length is not None:
+                self.length = self.offset + int(content_length)
+        else:
+            if content_length is not None:
+                self.length = int(content_length)
+            if self.offset:
+                # the archive changed, or range requests are not supported,
+                # so what we already have may not be a prefix of it
+                self.logger.debug('Could not resume download of {0} from '
+                                  'byte {1}, restarting it'
+                                  .format(self.url, self.offset))
+                self.offset = 0
+                self._hash = hashlib.sha256()
+                self._buffer = b''
+                raise _DownloadRestarted(self.url)
+
+    def _range_validator(self):
+        # If-Range requires a strong entity tag
+        if self.etag and not self.etag.startswith('W/'):
+            return self.etag
+        return self.last_modified
+
+    def _read(self, size):
+        while True:
+            error = None
+            try:
+                data = self._response.raw.read(size)
+            except _CONNECTION_ERRORS as e:
+                data = None
+                error = e
+            if data:
+                return data
+            if error is None and (self.length is None or
+                                  self.offset >= self.length):
+                return b''
+            # connection dropped before the whole body was read
+            if self.resumes >= self.retries:
+                raise exceptions.PluginInstallationError(
+                    'Failed downloading {0} after {1} attempts, {2} bytes '
+                    'were downloaded. ({3})'.format(self.url,
+                                                    self.resumes + 1,
+                                                    self.offset,
+                                                    error or 'connection '
+                                                             'closed'))
+            self.resumes += 1
+            self.logger.debug('Resuming download of {0} from byte {1} '
+                              '({2})'.format(self.url, self.offset,
+                                             error or 'connection closed'))
+            self.close()
+            self._connect_with_retries()
+
+    def _connect_with_retries(self):
+        while True:
+            try:
+                self._connect()
+                return
+            except _CONNECTION_ERRORS as e:
+                if self.resumes >= self.retries:
+                    raise
+                self.resumes += 1
+                self.logger.debug('Failed reconnecting to {0} ({1})'
+                                  .format(self.url, e))
+
+    def close(self):
+        if self._response is not None:
+            self._response.close()
+
+
+def _open(url, retries, timeout, logger, etag=None, last_modified=None):
+    scheme = urlparse.urlparse(url).scheme
+    if scheme == 'file':
+        return _FileStream(urllib.url2pathname(urlparse.urlparse(url).path))
+    elif scheme in ['http', 'https']:
+        return _HTTPStream(url,
+                           retries=retries,
+                           timeout=timeout,
+                           logger=logger,
+                           etag=etag,
+                           last_modified=last_modified)
+    raise exceptions.PluginInstallationError(
+        'Unsupported URL scheme: {0}'.format(url))
+
+
+def _split_digest(url):
+    url, _, fragment = url.partition('#')
+    digest = None
+    for param in fragment.split('&'):
+        name, _, value = param.partition('=')
+        if name == 'sha256':
+            digest = value
+    return url, digest
+
+
+def _extract_tar(stream, target_dir):
+    try:
+        tar = tarfile.open(fileobj=stream, mode='r|*')
+    except tarfile.TarError as e:
+        raise exceptions.PluginInstallationError(
+            'Unsupported archive format: {0}'.format(e))
+    try:
+        for member in tar:
+            _verify_member_path(target_dir, member.name)
+            if member.issym():
+                _verify_member_path(target_dir, os.path.join(
+                    os.path.dirname(member.name), member.linkname))
+            elif member.islnk():
+                _verify_member_path(target_dir, member.linkname)
+            elif not (member.isfile() or member.isdir()):
+                # devices, fifos, etc... have no place in a plugin
+                continue
+            tar.extract(member, target_dir)
+    finally:
+        tar.close()
+
+
+def _extract_zip(stream, target_dir):
+    with tempfile.TemporaryFile() as spool:
+        shutil.copyfileobj(stream, spool, CHUNK_SIZE)
+        spool.seek(0)
+        archive = zipfile.ZipFile(spool)
+        try:
+            for info in archive.infolist():
+                _verify_member_path(target_dir, info.filename)
+                path = archive.extract(info, target_dir)
+                mode = info.external_attr >> 16
+                if mode & 0o111 and os.path.isfile(path):
+                    os.chmod(path, os.stat(path).st_mode | 0o111)
+        finally:
+            archive.close()
+
+
+def _verify_member_path(target_dir, name):
+    target_dir = os.path.realpath(target_dir)
+    path = os.path.realpath(os.path.join(target_dir, name))
+    if path != target_dir and not path.startswith(target_dir + os.sep):
+        raise exceptions.PluginInstallationError(
+            'Archive member {0} would be extracted outside of {1}'
+            .format(name, target_dir))
+
+
+def _clear_dir(target_dir):
+    for name in os.listdir(target_dir):
+        path = os.path.join(target_dir, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+
+def _strip_leading_dir(target_dir):
+    entries = os.listdir(target_dir)
+    if len(entries) != 1:
+        return
+    leading_dir = os.path.join(target_dir, entries[0])
+    if not os.path.isdir(leading_dir) or os.path.islink(leading_dir):
+        return
+    # rename first, in case the leading dir contains an entry by the
+    # same name
+    tmp_dir = tempfile.mkdtemp(dir=target_dir)
+    os.rmdir(tmp_dir)
+    os.rename(leading_dir, tmp_dir)
+    for name in os.listdir(tmp_dir):
+        os.rename(os.path.join(tmp_dir, name), os.path.join(target_dir, name))
+    os.rmdir(tmp_dir)
@@ -0,0 +1,230 @@
+#########
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+Resolution of plugin imports through the installed plugins index.
+
+Every plugin is installed into a prefix of its own, and the site-packages
+directories of the prefixes in use are added to sys.path. Rather than
+having the import machinery look for every top level module in each of
+these directories in turn, a meta path finder looks the module up in the
+modules recorded by the plugins index when the plugin was installed, and
+loads it directly from the directory providing it. Modules that are not
+provided by a plugin prefix on sys.path (e.g. the standard library, or
+the agent virtualenv packages), or that are also provided by an earlier
+sys.path entry, are left to the regular import machinery.
+
+With fewer than two plugin prefixes on sys.path, which is the case of the
+subprocesses operations are dispatched to, there is nothing to skip, so
+the finder does not consult the index at all.
+"""
+
+import os
+import imp
+import sys
+import pkgutil
+import threading
+
+from cloudify_agent import VIRTUALENV
+
+_finder = None
+_finder_lock = threading.Lock()
+
+
+class PluginModuleFinder(object):
+
+    """
+    A PEP 302 finder of top level modules provided by plugin prefixes.
+    """
+
+    def __init__(self, plugin_index=None):
+        self._plugin_index = plugin_index
+        self.plugins_dir = _normalize(
+            plugin_index.plugins_dir if plugin_index else
+            os.path.join(VIRTUALENV, 'plugins'))
+        self._modules = {}
+        self._plugin_dirs = set()
+        self._lookup_key = None
+        self._path_key = None
+        self._path = None
+        self._lock = threading.Lock()
+
+    @property
+    def plugin_index(self):
+        if self._plugin_index is None:
+            # imported lazily, as most processes never need the index
+            from cloudify_agent.api.plugins import index
+            self._plugin_index = index.PluginIndex()
+        return self._plugin_index
+
+    def find_module(self, fullname, path=None):
+        # submodules are found through their package __path__
+        if path is not None or '.' in fullname:
+            return None
+        entries, positions, dir_names = self._sys_path()
+        if len(dir_names) < 2:
+            return None
+        if imp.is_builtin(fullname):
+            return None
+        candidates, plugin_dirs = self._lookup(fullname, dir_names)
+        if not candidates:
+            return None
+        # preserve the sys.path precedence
+        on_path = sorted((site_packages for site_packages in candidates
+                          if site_packages in positions),
+                         key=positions.get)
+        for site_packages in on_path:
+            try:
+                found = imp.find_module(fullname, [site_packages])
+            except ImportError:
+                # removed since it was indexed
+                continue
+            if _provided_by_any(fullname,
+                                entries[:positions[site_packages]],
+                                plugin_dirs):
+                # shadowed by a module earlier on sys.path, which the
+                # regular import machinery finds
+                if found[0]:
+                    found[0].close()
+                return None
+            return _Loader(found)
+        return None
+
+    def invalidate(self):
+        with self._lock:
+            self._lookup_key = None
+
+    def _lookup(self, fullname, dir_names):
+        # the index is reloaded when modified, e.g. by an installation in
+        # another process
+        try:
+            mtime = os.stat(self.plugin_index.path).st_mtime
+        except OSError:
+            mtime = None
+        with self._lock:
+            key = (mtime, dir_names)
+            if key != self._lookup_key:
+                modules = self.plugin_index.modules(dir_names) \
+                    if mtime is not None else {}
+                self._modules = dict(
+                    (name, [_normalize(path) for path in paths])
+                    for name, paths in modules.items())
+                self._plugin_dirs = set(
+                    path for paths in self._modules.values()
+                    for path in paths)
+                self._lookup_key = key
+            return self._modules.get(fullname, []), self._plugin_dirs
+
+    def _sys_path(self):
+        # sys.path is rarely modified once plugins are in use, so it is
+        # only normalized again when it is replaced or resized
+        key = (id(sys.path), len(sys.path))
+        with self._lock:
+            if key != self._path_key:
+                entries = [(entry, _normalize(entry)) for entry in sys.path]
+                positions = {}
+                dir_names = set()
+                for position, (_, normalized) in enumerate(entries):
+                    positions.setdefault(normalized, position)
+                    dir_name = self._plugin_dir_name(normalized)
+                    if dir_name:
+                        dir_names.add(dir_name)
+                self._path = entries, positions, frozenset(dir_names)
+                self._path_key = key
+            return self._path
+
+    def _plugin_dir_name(self, path):
+        # the installation a site-packages directory belongs to, if any
+        if not path.startswith(self.plugins_dir + os.sep):
+            return None
+        return path[len(self.plugins_dir) + 1:].split(os.sep, 1)[0]
+
+
+def _provided_by_any(fullname, entries, plugin_dirs):
+    for entry, normalized in entries:
+        # the index knows which modules plugin prefixes provide
+        if normalized in plugin_dirs:
+            continue
+        # directories, as well as zip files and eggs
+        importer = pkgutil.get_importer(entry)
+        if importer is None:
+            continue
+        loader = importer.find_module(fullname)
+        if loader is not None:
+            module_file = getattr(loader, 'file', None)
+            if module_file:
+                module_file.close()
+            return True
+    return False
+
+
+class _Loader(object):
+
+    def __init__(self, found):
+        self.found = found
+
+    def load_module(self, fullname):
+        if fullname in sys.modules:
+            return sys.modules[fullname]
+        module_file, pathname, description = self.found
+        try:
+            return imp.load_module(fullname, module_file, pathname,
+                                   description)
+        finally:
+            if module_file:
+                module_file.close()
+
+
+def _normalize(path):
+    return os.path.normcase(os.path.abspath(path))
+
+
+def install_finder(plugin_index=None):
+
+    """
+    Install the plugin module finder in sys.meta_path, if not installed
+    already.
+
+    :return: the installed finder.
+    """
+
+    global _finder
+    with _finder_lock:
+        if _finder is None:
+            _finder = PluginModuleFinder(plugin_index)
+        if _finder not in sys.meta_path:
+            sys.meta_path.append(_finder)
+        return _finder
+
+
+def invalidate():
+
+    """
+    Have the installed finder reload the index on the next import. Plugin
+    installations in another process are noticed by the index modification
+    time, this is for ones made by this process within its resolution.
+    """
+
+    with _finder_lock:
+        if _finder is not None:
+            _finder.invalidate()
+
+
+def uninstall_finder():
+    global _finder
+    with _finder_lock:
+        if _finder in sys.meta_path:
+            sys.meta_path.remove(_finder)
+        _finder = None
@@ -0,0 +1,431 @@
+#########
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+An index of the plugins installed in the agent virtualenv.
+
+Every installation directory under `VIRTUALENV/plugins` has a row in a
+SQLite database kept alongside, holding the plugin identity, the
+deployments referencing it, its size, when it was installed and last
+used, and the top level modules it provides (see `imports`). The database
+handles locking and transactions, so the index can be shared by concurrent
+installations in different processes.
+"""
+
+import os
+import sys
+import time
+import sqlite3
+import contextlib
+
+from cloudify_agent import VIRTUALENV
+from cloudify_agent.api import utils
+from cloudify_agent.api.plugins import cache
+
+MANAGED = 'managed'
+SOURCE = 'source'
+
+# the reference recorded for installations whose users are unknown, i.e.
+# ones installed before the index existed
+LEGACY = '__legacy__'
+
+INDEX_FILE = '.index.sqlite'
+
+SCHEMA_VERSION = 2
+
+# seconds to wait for a concurrent transaction to complete
+LOCK_TIMEOUT = 60
+
+_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS plugins ('
+    ' dir TEXT PRIMARY KEY,'
+    ' kind TEXT NOT NULL,'
+    ' plugin_id TEXT,'
+    ' name TEXT,'
+    ' package_name TEXT,'
+    ' package_version TEXT,'
+    ' deployment_id TEXT,'
+    ' installed_at REAL,'
+    ' last_used REAL,'
+    ' size INTEGER)',
+    'CREATE TABLE IF NOT EXISTS refs ('
+    ' dir TEXT NOT NULL REFERENCES plugins (dir) ON DELETE CASCADE,'
+    ' deployment_id TEXT NOT NULL,'
+    ' PRIMARY KEY (dir, deployment_id))',
+    'CREATE INDEX IF NOT EXISTS plugins_plugin_id ON plugins (plugin_id)',
+    'CREATE TABLE IF NOT EXISTS modules ('
+    ' dir TEXT NOT NULL REFERENCES plugins (dir) ON DELETE CASCADE,'
+    ' module TEXT NOT NULL,'
+    ' path TEXT NOT NULL,'
+    ' PRIMARY KEY (dir, module, path))'
+)
+
+# suffixes of top level modules, packages are directories holding an
+# __init__ module
+_MODULE_SUFFIXES = ('.py', '.pyc', '.so', '.pyd')
+
+_FIELDS = ('dir',
+           'kind',
+           'plugin_id',
+           'name',
+           'package_name',
+           'package_version',
+           'deployment_id',
+           'installed_at',
+           'last_used',
+           'size')
+
+
+class PluginIndex(object):
+
+    """
+    The installed plugins index. Installations are identified by their
+    directory name under the plugins directory.
+    """
+
+    def __init__(self, plugins_dir=None):
+
+        """
+        :param plugins_dir: the directory plugins are installed in,
+                            defaults to `VIRTUALENV/plugins`.
+        """
+
+        self.plugins_dir = plugins_dir or os.path.join(VIRTUALENV, 'plugins')
+        self.path = os.path.join(self.plugins_dir, INDEX_FILE)
+        self._initialized = False
+
+    @contextlib.contextmanager
+    def transaction(self):
+
+        """
+        A connection to the index, committed on exit (or rolled back on
+        error). Writes are serialized across processes.
+        """
+
+        self._initialize()
+        connection = self._connect()
+        try:
+            # take the write lock upfront, so that read-modify-write
+            # sequences are atomic
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield connection
+                connection.execute('COMMIT')
+            except BaseException:
+                tpe, value, tb = sys.exc_info()
+                try:
+                    connection.execute('ROLLBACK')
+                except sqlite3.Error:
+                    # e.g. the transaction was already rolled back by
+                    # sqlite, the original error is the interesting one
+                    pass
+                raise tpe, value, tb
+        finally:
+            connection.close()
+
+    def add(self,
+            dir_name,
+            kind,
+            plugin_id=None,
+            name=None,
+            package_name=None,
+            package_version=None,
+            deployment_id=None,
+            size=None):
+
+        """
+        Record an installation, and the top level modules it provides.
+
+        :param dir_name: the installation directory name, relative to the
+                         plugins directory.
+        :param kind: MANAGED or SOURCE.
+        :param deployment_id: the deployment the plugin was installed for,
+                              which is also its first reference.
+        :param size: the installation size in bytes, calculated if not
+                     specified.
+        """
+
+        path = os.path.join(self.plugins_dir, dir_name)
+        if size is None:
+            size = _dir_size(path)
+        modules = list_modules(path)
+        now = time.time()
+        with self.transaction() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO plugins ({0}) VALUES ({1})'
+                .format(', '.join(_FIELDS), ', '.join('?' * len(_FIELDS))),
+                (dir_name, kind, plugin_id, name, package_name,
+                 package_version, deployment_id, now, now, size))
+            connection.execute('DELETE FROM refs WHERE dir = ?', (dir_name,))
+            if deployment_id:
+                connection.execute(
+                    'INSERT INTO refs (dir, deployment_id) VALUES (?, ?)',
+                    (dir_name, deployment_id))
+            _insert_modules(connection, dir_name, modules)
+
+    def get(self, dir_name):
+
+        """
+        Lookup an installation.
+
+        :return: a dict of the installation fields (see `list`), or None
+                 if not installed.
+        """
+
+        entries = self._select('WHERE p.dir = ?', (dir_name,))
+        return entries[0] if entries else None
+
+    def list(self):
+
+        """
+        List all installations, ordered by directory name.
+
+        :return: a list of dicts holding the installation fields, and the
+                 list of `deployments` referencing it.
+        """
+
+        return self._select()
+
+    def remove(self, dir_name):
+        with self.transaction() as connection:
+            connection.execute('DELETE FROM plugins WHERE dir = ?',
+                               (dir_name,))
+
+    def add_reference(self, dir_name, deployment_id):
+
+        """
+        Record the use of an installation by a deployment.
+
+        :return: the number of deployments referencing the installation.
+        """
+
+        with self.transaction() as connection:
+            connection.execute(
+                'INSERT OR IGNORE INTO refs (dir, deployment_id) '
+                'VALUES (?, ?)', (dir_name, deployment_id))
+            connection.execute(
+                'UPDATE plugins SET last_used = ? WHERE dir = ?',
+                (time.time(), dir_name))
+            return _count_references(connection, dir_name)
+
+    def remove_reference(self, dir_name, deployment_id):
+
+        """
+        Drop the reference of a deployment to an installation.
+
+        :return: the number of deployments still referencing the
+                 installation.
+        """
+
+        with self.transaction() as connection:
+            connection.execute(
+                'DELETE FROM refs WHERE dir = ? AND deployment_id = ?',
+                (dir_name, deployment_id))
+            return _count_references(connection, dir_name)
+
+    def modules(self, dir_names=None):
+
+        """
+        Map the top level modules provided by installations to the
+        site-packages directories holding them.
+
+        Unlike other methods, this one never modifies the index, so it is
+        safe to call from processes that only import plugins. A missing or
+        outdated index maps nothing.
+
+        :param dir_names: the installations to map the modules of,
+                          defaults to all.
+
+        :return: a dict of module names to lists of absolute paths.
+        """
+
+        if not os.path.isfile(self.path):
+            return {}
+        where = ''
+        params = ()
+        if dir_names is not None:
+            params = tuple(dir_names)
+            where = 'WHERE dir IN ({0}) '.format(', '.join('?' * len(params)))
+        try:
+            connection = self._connect()
+            try:
+                rows = connection.execute(
+                    'SELECT module, dir, path FROM modules {0}'
+                    'ORDER BY dir, path'.format(where), params).fetchall()
+            finally:
+                connection.close()
+        except sqlite3.Error:
+            return {}
+        result = {}
+        for module, dir_name, path in rows:
+            result.setdefault(module, []).append(
+                os.path.join(self.plugins_dir, dir_name, path))
+        return result
+
+    def backfill(self):
+
+        """
+        Index installations that exist on disk but are not indexed, e.g.
+        ones that were installed by a previous agent version. Managed
+        plugin installations are recognized by their `plugin.id` file,
+        all others are considered source plugins.
+
+        The deployments using such installations are unknown, so they are
+        referenced as LEGACY instead.
+
+        :return: the number of installations added.
+        """
+
+        if not os.path.isdir(self.plugins_dir):
+            return 0
+        indexed = set(entry['dir'] for entry in self.list())
+        added = 0
+        for dir_name in sorted(os.listdir(self.plugins_dir)):
+            path = os.path.join(self.plugins_dir, dir_name)
+            if (dir_name.startswith('.') or dir_name in indexed or
+                    not os.path.isdir(path)):
+                continue
+            plugin_id_path = os.path.join(path, 'plugin.id')
+            if os.path.isfile(plugin_id_path):
+                with open(plugin_id_path) as f:
+                    plugin_id = f.read().strip()
+                self.add(dir_name, MANAGED, plugin_id=plugin_id,
+                         deployment_id=LEGACY)
+            else:
+                self.add(dir_name, SOURCE, deployment_id=LEGACY)
+            added += 1
+        return added
+
+    def _select(self, where='', params=()):
+        self._initialize()
+        connection = self._connect()
+        try:
+            rows = connection.execute(
+                'SELECT {0}, GROUP_CONCAT(r.deployment_id) '
+                'FROM plugins p LEFT JOIN refs r ON p.dir = r.dir '
+                '{1} GROUP BY p.dir ORDER BY p.dir'.format(
+                    ', '.join('p.{0}'.format(field) for field in _FIELDS),
+                    where),
+                params).fetchall()
+        finally:
+            connection.close()
+        result = []
+        for row in rows:
+            entry = dict(zip(_FIELDS, row[:-1]))
+            entry['deployments'] = sorted(row[-1].split(',')) \
+                if row[-1] else []
+            result.append(entry)
+        return result
+
+    def _connect(self):
+        # transactions are managed explicitly
+        connection = sqlite3.connect(self.path,
+                                     timeout=LOCK_TIMEOUT,
+                                     isolation_level=None)
+        connection.execute('PRAGMA foreign_keys = ON')
+        return connection
+
+    def _initialize(self):
+        if self._initialized:
+            return
+        utils.safe_create_dir(self.plugins_dir)
+        connection = self._connect()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            version = connection.execute('PRAGMA user_version').fetchone()[0]
+            created = version == 0
+            # installations indexed before modules were
+            reindex_modules = 0 < version < 2
+            if version < SCHEMA_VERSION:
+                for statement in _SCHEMA:
+                    connection.execute(statement)
+                connection.execute('PRAGMA user_version = {0}'
+                                   .format(SCHEMA_VERSION))
+            connection.execute('COMMIT')
+        finally:
+            connection.close()
+        self._initialized = True
+        if created:
+            self.backfill()
+        elif reindex_modules:
+            self._reindex_modules()
+
+    def _reindex_modules(self):
+        for entry in self.list():
+            modules = list_modules(os.path.join(self.plugins_dir,
+                                                entry['dir']))
+            with self.transaction() as connection:
+                _insert_modules(connection, entry['dir'], modules)
+
+
+def list_modules(prefix):
+
+    """
+    List the top level modules installed in a plugin prefix.
+
+    :return: a list of (module name, site-packages path) tuples, paths
+             being relative to the prefix.
+    """
+
+    result = []
+    for site_packages in _site_packages_dirs():
+        path = os.path.join(prefix, site_packages)
+        if not os.path.isdir(path):
+            continue
+        names = set()
+        for name in os.listdir(path):
+            module_name, suffix = os.path.splitext(name)
+            if suffix in _MODULE_SUFFIXES:
+                names.add(module_name)
+            elif _is_package(os.path.join(path, name)):
+                names.add(name)
+        result.extend((name, site_packages) for name in sorted(names)
+                      if '.' not in name and '-' not in name)
+    return result
+
+
+def _site_packages_dirs():
+    if os.name == 'nt':
+        return [os.path.join('Lib', 'site-packages')]
+    # compiled dependencies of 64bit plugins may be installed into lib64
+    return [os.path.join('lib{0}'.format(b),
+                         'python{0}.{1}'.format(sys.version_info[0],
+                                                sys.version_info[1]),
+                         'site-packages') for b in ['', '64']]
+
+
+def _is_package(path):
+    return os.path.isdir(path) and any(
+        os.path.isfile(os.path.join(path, '__init__{0}'.format(suffix)))
+        for suffix in _MODULE_SUFFIXES)
+
+
+def _insert_modules(connection, dir_name, modules):
+    connection.execute('DELETE FROM modules WHERE dir = ?', (dir_name,))
+    connection.executemany(
+        'INSERT INTO modules (dir, module, path) VALUES (?, ?, ?)',
+        [(dir_name, module, path) for module, path in modules])
+
+
+def _count_references(connection, dir_name):
+    return connection.execute('SELECT COUNT(*) FROM refs WHERE dir = ?',
+                              (dir_name,)).fetchone()[0]
+
+
+def _dir_size(path):
+    try:
+        return cache.path_size(path)
+    except OSError:
+        return None
@@ -14,14 +14,18 @@
 #  * limitations under the License.
 
 import errno
+import glob
 import os
 import sys
+import time
 import shutil
 import tempfile
 import platform
-import logging
+import threading
+import urllib
+from multiprocessing.pool import ThreadPool
 
-import fasteners
+import pkg_resources
 from wagon import wagon
 from wagon import utils as wagon_utils
 
@@ -34,18 +38,43 @@ from cloudify.manager import get_rest_client
 
 from cloudify_agent import VIRTUALENV
 from cloudify_agent.api import plugins
+from cloudify_agent.api.plugins import cache
+from cloudify_agent.api.plugins import constraints
+from cloudify_agent.api.plugins import dedup
+from cloudify_agent.api.plugins import download
+from cloudify_agent.api.plugins import imports
+from cloudify_agent.api.plugins import index
+from cloudify_agent.api.plugins import instrumentation
+from cloudify_agent.api.plugins import metadata
+from cloudify_agent.api.plugins import trash
+from cloudify_agent.api import utils
+from cloudify_agent.api import defaults
 from cloudify_agent.api.utils import get_pip_path
 from cloudify_agent.api import exceptions
 
 
 SYSTEM_DEPLOYMENT = '__system__'
 
+# managed plugin query parameters -> (expiry time, managed plugin or None)
+_managed_plugins = {}
+_managed_plugins_lock = threading.Lock()
+
+_platform_and_distro_info = None
+
 
 class PluginInstaller(object):
 
-    def __init__(self, logger=None):
+    def __init__(self, logger=None, instrumentation_hook=None):
         self.logger = logger or setup_logger(self.__class__.__name__)
         self.runner = LocalCommandRunner(logger=self.logger)
+        self.instrumentation = (instrumentation_hook or
+                                instrumentation.get_instrumentation())
+        self.wagon_cache = None
+        self.source_cache = None
+        self.wheelhouse = None
+        self.dedup_store = None
+        self.plugin_index = None
+        self.trash = None
 
     def install(self,
                 plugin,
@@ -64,17 +93,38 @@ class PluginInstaller(object):
         """
         # deployment_id may be empty in some tests.
         deployment_id = deployment_id or SYSTEM_DEPLOYMENT
-        managed_plugin = get_managed_plugin(plugin,
-                                            logger=self.logger)
+        with self.instrumentation.install(
+                plugin=plugin['name'],
+                version=plugin.get('package_version'),
+                deployment_id=deployment_id):
+            self._install(plugin=plugin,
+                          deployment_id=deployment_id,
+                          blueprint_id=blueprint_id)
+        imports.invalidate()
+
+    def _install(self, plugin, deployment_id, blueprint_id):
+        with self.instrumentation.phase('rest_lookup'):
+            managed_plugin = get_managed_plugin(plugin,
+                                                logger=self.logger)
         source = get_plugin_source(plugin, blueprint_id)
+        if not managed_plugin and not source:
+            # the plugin might have been uploaded since it was looked up
+            invalidate_managed_plugins()
+            with self.instrumentation.phase('rest_lookup'):
+                managed_plugin = get_managed_plugin(plugin,
+                                                    logger=self.logger)
+        self.instrumentation.update(managed=bool(managed_plugin))
         args = get_plugin_args(plugin)
-        tmp_plugin_dir = tempfile.mkdtemp(prefix='{0}-'.format(plugin['name']))
+        self._create_plugins_dir_if_missing()
+        tmp_plugin_dir = tempfile.mkdtemp(prefix='{0}-'.format(plugin['name']),
+                                          dir=self._tmp_plugins_dir())
         constraint = os.path.join(tmp_plugin_dir, 'constraint.txt')
+        with self.instrumentation.phase('freeze'):
+            frozen = self._pip_freeze()
         with open(constraint, 'w') as f:
-            f.write(self._pip_freeze())
+            f.write(frozen)
         args = '{0} --prefix="{1}" --constraint="{2}"'.format(
                 args, tmp_plugin_dir, constraint).strip()
-        self._create_plugins_dir_if_missing()
 
         (current_platform,
          current_distro,
@@ -103,8 +153,7 @@ class PluginInstaller(object):
                     plugin=plugin,
                     source=source,
                     args=args,
-                    tmp_plugin_dir=tmp_plugin_dir,
-                    constraint=constraint)
+                    tmp_plugin_dir=tmp_plugin_dir)
             else:
                 raise NonRecoverableError(
                     'No source or managed plugin found for {0} '
@@ -125,30 +174,24 @@ class PluginInstaller(object):
                                 args,
                                 tmp_plugin_dir):
         matching_existing_installation = False
-        dst_dir = '{0}-{1}'.format(managed_plugin.package_name,
-                                   managed_plugin.package_version)
-        dst_dir = self._full_dst_dir(dst_dir)
+        dst_name = '{0}-{1}'.format(managed_plugin.package_name,
+                                    managed_plugin.package_version)
+        dst_dir = self._full_dst_dir(dst_name)
         lock = self._lock(dst_dir)
         lock.acquire()
         try:
-            if os.path.exists(dst_dir):
-                plugin_id_path = os.path.join(dst_dir, 'plugin.id')
-                if os.path.exists(plugin_id_path):
-                    with open(plugin_id_path) as f:
-                        existing_plugin_id = f.read().strip()
-                    matching_existing_installation = (
-                        existing_plugin_id == managed_plugin.id)
-                    if not matching_existing_installation:
-                        raise exceptions.PluginInstallationError(
-                            'Managed plugin installation found but its ID '
-                            'does not match the ID of the plugin currently '
-                            'on the manager. [existing: {0}, new: {1}]'
-                            .format(existing_plugin_id,
-                                    managed_plugin.id))
-                else:
+            existing_plugin_id = self._installed_plugin_id(dst_name, dst_dir,
+                                                           managed_plugin)
+            if existing_plugin_id is not None:
+                matching_existing_installation = (
+                    existing_plugin_id == managed_plugin.id)
+                if not matching_existing_installation:
                     raise exceptions.PluginInstallationError(
-                        'Managed plugin installation found but it is '
-                        'in a corrupted state. [{0}]'.format(managed_plugin))
+                        'Managed plugin installation found but its ID '
+                        'does not match the ID of the plugin currently '
+                        'on the manager. [existing: {0}, new: {1}]'
+                        .format(existing_plugin_id,
+                                managed_plugin.id))
 
             fields = ['package_name',
                       'package_version',
@@ -163,6 +206,7 @@ class PluginInstaller(object):
                 self.logger.info(
                     'Using existing installation of managed plugin: {0} [{1}]'
                     .format(managed_plugin.id, description))
+                self._index().add_reference(dst_name, deployment_id)
             elif (deployment_id != SYSTEM_DEPLOYMENT and
                   plugin['executor'] == 'central_deployment_agent'):
                 raise exceptions.PluginInstallationError(
@@ -174,11 +218,23 @@ class PluginInstaller(object):
                                  .format(managed_plugin.id, description))
                 try:
                     self._wagon_install(plugin=managed_plugin, args=args)
-                    shutil.move(tmp_plugin_dir, dst_dir)
+                    with self.instrumentation.phase('move'):
+                        shutil.move(tmp_plugin_dir, dst_dir)
                     with open(os.path.join(dst_dir, 'plugin.id'), 'w') as f:
                         f.write(managed_plugin.id)
+                    self._index().add(
+                        dst_name,
+                        index.MANAGED,
+                        plugin_id=managed_plugin.id,
+                        name=plugin['name'],
+                        package_name=managed_plugin.package_name,
+                        package_version=managed_plugin.package_version,
+                        deployment_id=deployment_id)
                 except Exception as e:
                     tpe, value, tb = sys.exc_info()
+                    # the plugin might have been deleted or replaced on
+                    # the manager, look it up again when retried
+                    invalidate_managed_plugins()
                     raise NonRecoverableError('Failed installing managed '
                                               'plugin: {0} [{1}][{2}]'
                                               .format(managed_plugin.id,
@@ -187,35 +243,182 @@ class PluginInstaller(object):
             if lock:
                 lock.release()
 
+    def _installed_plugin_id(self, dst_name, dst_dir, managed_plugin):
+        """
+        Returns the ID of the managed plugin installed in `dst_dir`, or
+        None if there is no such installation.
+        """
+        plugin_index = self._index()
+        entry = plugin_index.get(dst_name)
+        if not os.path.exists(dst_dir):
+            if entry is not None:
+                # removed without going through the installer
+                plugin_index.remove(dst_name)
+            return None
+        # plugin.id is written last, so its absence marks an installation
+        # that did not complete
+        plugin_id_path = os.path.join(dst_dir, 'plugin.id')
+        if not os.path.exists(plugin_id_path):
+            raise exceptions.PluginInstallationError(
+                'Managed plugin installation found but it is '
+                'in a corrupted state. [{0}]'.format(managed_plugin))
+        if entry is not None and entry['plugin_id']:
+            return entry['plugin_id']
+        # installed before the index existed, possibly used by unknown
+        # deployments
+        with open(plugin_id_path) as f:
+            plugin_id = f.read().strip()
+        plugin_index.add(dst_name,
+                         index.MANAGED,
+                         plugin_id=plugin_id,
+                         package_name=managed_plugin.package_name,
+                         package_version=managed_plugin.package_version,
+                         deployment_id=index.LEGACY)
+        return plugin_id
+
+    def prefetch(self, plugins, concurrency=None):
+        """
+        Download the wagons of managed plugins and the archives of source
+        plugins into the local caches, so that installing the plugins
+        later on does not wait for the downloads. Prefetching is only an
+        optimization, so failures are reported rather than raised.
+
+        :param plugins: plugin structures, as passed to `install`.
+        :param concurrency: the number of concurrent downloads.
+
+        :return: a list of dicts, one per plugin, holding the plugin
+                 `name`, whether it is `managed`, the `path` of the cached
+                 archive, and an `error` message if prefetching failed.
+        """
+        concurrency = int(concurrency or
+                          defaults.PLUGINS_INSTALL_CONCURRENCY)
+        results = []
+        fetches = []
+        for plugin in plugins:
+            result = {'name': plugin.get('name'),
+                      'managed': False,
+                      'path': None,
+                      'error': None}
+            results.append(result)
+            # manager lookups happen here, as they may depend on the
+            # (thread local) operation context
+            try:
+                fetch = self._prefetch_function(plugin, result)
+            except Exception as e:
+                result['error'] = str(e)
+                continue
+            fetches.append((fetch, result))
+
+        def run(fetch_and_result):
+            fetch, result = fetch_and_result
+            try:
+                result['path'] = fetch()
+            except Exception as e:
+                result['error'] = str(e)
+
+        if concurrency > 1 and len(fetches) > 1:
+            pool = ThreadPool(min(concurrency, len(fetches)))
+            try:
+                pool.map(run, fetches)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for fetch_and_result in fetches:
+                run(fetch_and_result)
+        for result in results:
+            if result['error']:
+                self.logger.warn('Failed prefetching plugin {0}: {1}'
+                                 .format(result['name'], result['error']))
+            else:
+                self.logger.info('Prefetched plugin {0} [{1}]'
+                                 .format(result['name'], result['path']))
+        return results
+
+    def _prefetch_function(self, plugin, result):
+        managed_plugin = get_managed_plugin(plugin, logger=self.logger)
+        if managed_plugin:
+            result['managed'] = True
+            wagon_cache = self._wagon_cache()
+            if not wagon_cache.enabled:
+                raise exceptions.PluginInstallationError(
+                    'The wagon cache is disabled')
+            download = self._wagon_downloader(get_rest_client(),
+                                              managed_plugin)
+            return lambda: wagon_cache.fetch(managed_plugin.id, download)[0]
+        source = (plugin.get('source') or '').strip()
+        source_cache = self._source_cache()
+        if not source_cache.cacheable(source):
+            # blueprint resources are downloaded from the manager during
+            # the installation itself
+            raise exceptions.PluginInstallationError(
+                'Neither a managed plugin nor a source URL: {0}'
+                .format(source or None))
+        if not source_cache.enabled:
+            raise exceptions.PluginInstallationError(
+                'The source plugins cache is disabled')
+        return lambda: source_cache.fetch(source)[0]
+
+    def _wagon_downloader(self, client, plugin):
+        def download(output_file):
+            self.logger.debug('Downloading plugin {0} from manager into {1}'
+                              .format(plugin.id, output_file))
+            client.plugins.download(plugin_id=plugin.id,
+                                    output_file=output_file)
+        return download
+
     def _wagon_install(self, plugin, args):
-        client = get_rest_client()
-        wagon_dir = tempfile.mkdtemp(prefix='{0}-'.format(plugin.id))
+        wagon_cache = self._wagon_cache()
+        # on the cache file system, so that cached wagons can be hard
+        # linked rather than copied
+        wagon_dir = tempfile.mkdtemp(
+            prefix='{0}-'.format(plugin.id),
+            dir=wagon_cache.tmp_dir if wagon_cache.enabled else None)
         wagon_path = os.path.join(wagon_dir, 'wagon.tar.gz')
+        download = self._wagon_downloader(get_rest_client(), plugin)
         try:
-            self.logger.debug('Downloading plugin {0} from manager into {1}'
-                              .format(plugin.id, wagon_path))
-            client.plugins.download(plugin_id=plugin.id,
-                                    output_file=wagon_path)
+            with self.instrumentation.phase('download') as event:
+                cache_hit = False
+                if wagon_cache.enabled:
+                    # a private link, as concurrent installations may
+                    # evict the cached wagon while this one installs it
+                    _, cache_hit = wagon_cache.fetch(plugin.id, download,
+                                                     output_file=wagon_path)
+                else:
+                    download(wagon_path)
+                event['cache_hit'] = cache_hit
+                event['bytes'] = (0 if cache_hit else
+                                  os.path.getsize(wagon_path))
             self.logger.debug('Installing plugin {0} using wagon'
                               .format(plugin.id))
-            w = wagon.Wagon(source=wagon_path)
-            w.install(ignore_platform=True,
-                      install_args=args,
-                      virtualenv=VIRTUALENV)
+            with self.instrumentation.phase('pip_install'):
+                w = wagon.Wagon(source=wagon_path)
+                w.install(ignore_platform=True,
+                          install_args=args,
+                          virtualenv=VIRTUALENV)
         finally:
             self.logger.debug('Removing directory: {0}'
                               .format(wagon_dir))
             self._rmtree(wagon_dir)
 
+    def _wagon_cache(self):
+        if self.wagon_cache is None:
+            self.wagon_cache = cache.WagonCache(logger=self.logger)
+        return self.wagon_cache
+
+    def _source_cache(self):
+        if self.source_cache is None:
+            self.source_cache = cache.SourceCache(logger=self.logger)
+        return self.source_cache
+
     def _install_source_plugin(self,
                                deployment_id,
                                plugin,
                                source,
                                args,
-                               tmp_plugin_dir,
-                               constraint):
-        dst_dir = '{0}-{1}'.format(deployment_id, plugin['name'])
-        dst_dir = self._full_dst_dir(dst_dir)
+                               tmp_plugin_dir):
+        dst_name = '{0}-{1}'.format(deployment_id, plugin['name'])
+        dst_dir = self._full_dst_dir(dst_name)
         if os.path.exists(dst_dir):
             raise exceptions.PluginInstallationError(
                 'Source plugin {0} already exists for deployment {1}. '
@@ -223,70 +426,318 @@ class PluginInstaller(object):
                 'same name was not cleaned properly.'
                 .format(plugin['name'], deployment_id))
         self.logger.info('Installing plugin from source')
-        self._pip_install(source=source, args=args, constraint=constraint)
-        shutil.move(tmp_plugin_dir, dst_dir)
+        build_key = self._pip_install(source=source,
+                                      args=args,
+                                      prefix=tmp_plugin_dir,
+                                      plugin_args=get_plugin_args(plugin))
+        # garbage collection must not evict the installation before it
+        # is indexed as referenced by the deployment
+        with self._lock(dst_dir):
+            with self.instrumentation.phase('move'):
+                shutil.move(tmp_plugin_dir, dst_dir)
+            dedup_store = self._dedup_store()
+            if dedup_store.enabled:
+                try:
+                    with self.instrumentation.phase('dedup'):
+                        dedup_store.ingest(dst_dir, key=build_key)
+                except (IOError, OSError) as e:
+                    # the plugin is installed, just not deduplicated
+                    self.logger.warn('Failed deduplicating {0}: {1}'
+                                     .format(dst_dir, e))
+            self._index().add(dst_name,
+                              index.SOURCE,
+                              name=plugin['name'],
+                              package_name=plugin.get('package_name'),
+                              package_version=plugin.get('package_version'),
+                              deployment_id=deployment_id)
 
-    def _pip_freeze(self):
-        try:
-            return self.runner.run('{0} freeze'.format(get_pip_path())).std_out
-        except CommandExecutionException as e:
-            raise exceptions.PluginInstallationError(
-                'Failed running pip freeze. ({0})'.format(e))
+    @staticmethod
+    def _pip_freeze():
+        return constraints.get_snapshot().render()
+
+    def _pip_install(self, source, args, prefix=None, plugin_args=''):
+        """
+        Install a source plugin.
 
-    def _pip_install(self, source, args, constraint):
+        :return: the key of the plugin build when installed into a prefix
+                 from an archive (see `Wheelhouse.key`), None otherwise.
+        """
         plugin_dir = None
+        digest = None
+        build_key = None
         try:
             if os.path.isabs(source):
                 plugin_dir = source
             else:
                 self.logger.debug('Extracting archive: {0}'.format(source))
-                plugin_dir = extract_package_to_dir(source)
-            package_name = extract_package_name(plugin_dir)
-            if self._package_installed_in_agent_env(constraint, package_name):
+                with self.instrumentation.phase('download') as event:
+                    plugin_dir, result, cache_hit = download_package_to_dir(
+                        source,
+                        logger=self.logger,
+                        source_cache=self._source_cache())
+                    event['bytes'] = 0 if cache_hit else result.size
+                    event['cache_hit'] = cache_hit
+                digest = result.digest
+            with self.instrumentation.phase('name_extraction'):
+                package_name = extract_package_name(plugin_dir,
+                                                    digest=digest)
+            if self._package_installed_in_agent_env(package_name):
                 self.logger.warn('Skipping source plugin {0} installation, '
                                  'as the plugin is already installed in the '
                                  'agent virtualenv.'.format(package_name))
-                return
+                return None
+            if digest and prefix:
+                build_key = cache.Wheelhouse.key(source, digest, plugin_args)
+                dedup_store = self._dedup_store()
+                if dedup_store.enabled:
+                    with self.instrumentation.phase('dedup') as event:
+                        materialized = dedup_store.materialize(build_key,
+                                                               prefix)
+                        event['cache_hit'] = materialized
+                else:
+                    materialized = False
+                if materialized:
+                    self.logger.info('Installed {0} from an identical '
+                                     'existing installation'
+                                     .format(package_name))
+                    return build_key
+            wheelhouse = self._wheelhouse()
+            if build_key and wheelhouse.enabled:
+                self._wheelhouse_install(wheelhouse=wheelhouse,
+                                         key=build_key,
+                                         source=source,
+                                         digest=digest,
+                                         plugin_dir=plugin_dir,
+                                         package_name=package_name,
+                                         args=args,
+                                         prefix=prefix,
+                                         plugin_args=plugin_args)
+                return build_key
             self.logger.debug('Installing from directory: {0} '
                               '[args={1}, package_name={2}]'
                               .format(plugin_dir, args, package_name))
             command = '{0} install {1} {2}'.format(
                 get_pip_path(), plugin_dir, args)
-            self.runner.run(command, cwd=plugin_dir)
+            with self.instrumentation.phase('pip_install'):
+                self.runner.run(command, cwd=plugin_dir)
             self.logger.debug('Retrieved package name: {0}'
                               .format(package_name))
+            return build_key
         finally:
             if plugin_dir and not os.path.isabs(source):
                 self.logger.debug('Removing directory: {0}'
                                   .format(plugin_dir))
                 self._rmtree(plugin_dir)
 
+    def _wheelhouse_install(self,
+                            wheelhouse,
+                            key,
+                            source,
+                            digest,
+                            plugin_dir,
+                            package_name,
+                            args,
+                            prefix,
+                            plugin_args):
+        wheels_dir = wheelhouse.get(key)
+        if wheels_dir:
+            self.logger.debug('Installing {0} from wheelhouse: {1} [args={2}]'
+                              .format(package_name, wheels_dir, args))
+            try:
+                with self.instrumentation.phase('pip_install',
+                                                cache_hit=True):
+                    self.runner.run('{0} install --no-index '
+                                    '--find-links="{1}" {2} {3}'
+                                    .format(get_pip_path(), wheels_dir,
+                                            package_name, args),
+                                    cwd=plugin_dir)
+                return
+            except CommandExecutionException as e:
+                self.logger.warn('Failed installing {0} from wheelhouse, '
+                                 'installing from source instead. ({1})'
+                                 .format(package_name, e))
+                self._rmtree(prefix)
+                utils.safe_create_dir(prefix)
+                with open(os.path.join(prefix, 'constraint.txt'), 'w') as f:
+                    f.write(self._pip_freeze())
+
+        self.logger.debug('Installing from directory: {0} '
+                          '[args={1}, package_name={2}]'
+                          .format(plugin_dir, args, package_name))
+        with self.instrumentation.phase('pip_install', cache_hit=False):
+            self.runner.run('{0} install {1} {2}'.format(
+                get_pip_path(), plugin_dir, args), cwd=plugin_dir)
+
+        # build wheels of the plugin, and of whatever got installed into
+        # its prefix (i.e. dependencies missing from the agent virtualenv)
+        requirements = ['{0}=={1}'.format(dist.project_name, dist.version)
+                        for dist in _prefix_distributions(prefix)
+                        if constraints.normalize(dist.project_name) !=
+                        constraints.normalize(package_name)]
+
+        def build(wheels_dir):
+            self.runner.run('{0} wheel --no-deps --wheel-dir="{1}" {2} {3}'
+                            .format(get_pip_path(), wheels_dir, plugin_dir,
+                                    ' '.join(requirements)),
+                            cwd=plugin_dir)
+        try:
+            with self.instrumentation.phase('wheel_build'):
+                wheelhouse.build(key, build, metadata={
+                    'source': source,
+                    'digest': digest,
+                    'package_name': package_name,
+                    'install_args': plugin_args})
+        except CommandExecutionException as e:
+            # the plugin is installed, future installations will just
+            # not be able to use the wheelhouse
+            self.logger.warn('Failed building wheels for {0}: {1}'
+                             .format(package_name, e))
+
+    def _wheelhouse(self):
+        if self.wheelhouse is None:
+            self.wheelhouse = cache.Wheelhouse(logger=self.logger)
+        return self.wheelhouse
+
+    def _dedup_store(self):
+        if self.dedup_store is None:
+            self.dedup_store = dedup.DedupStore(logger=self.logger)
+        return self.dedup_store
+
+    def _index(self):
+        if self.plugin_index is None:
+            self.plugin_index = index.PluginIndex()
+        return self.plugin_index
+
+    def _tmp_plugins_dir(self):
+        dedup_store = self._dedup_store()
+        if not dedup_store.enabled:
+            return None
+        # prefixes are linked to the store while being installed, so they
+        # must be on the same file system
+        return dedup_store.tmp_dir
+
     @staticmethod
-    def _package_installed_in_agent_env(constraint, package_name):
-        package_name = package_name.lower()
-        with open(constraint) as f:
-            constraints = f.read().split(os.linesep)
-        return any(
-            (c.lower().startswith('{0}=='.format(package_name)) or
-             'egg={0}'.format(package_name.replace('-', '_')) in c.lower())
-            for c in constraints)
+    def _package_installed_in_agent_env(package_name):
+        return package_name in constraints.get_snapshot()
 
     def uninstall(self, plugin, deployment_id=None):
         """Uninstall a previously installed plugin (only supports source
         plugins) """
         deployment_id = deployment_id or SYSTEM_DEPLOYMENT
         self.logger.info('Uninstalling plugin from source')
-        dst_dir = '{0}-{1}'.format(deployment_id, plugin['name'])
-        dst_dir = self._full_dst_dir(dst_dir)
-        if os.path.isdir(dst_dir):
-            self._rmtree(dst_dir)
+        dst_name = '{0}-{1}'.format(deployment_id, plugin['name'])
+        self._discard(self._full_dst_dir(dst_name))
+        plugin_index = self._index()
+        plugin_index.remove(dst_name)
+        if plugin.get('package_name') and plugin.get('package_version'):
+            # the deployment may have used a managed plugin installation,
+            # which is left for other deployments or garbage collection
+            plugin_index.remove_reference(
+                '{0}-{1}'.format(plugin['package_name'],
+                                 plugin['package_version']),
+                deployment_id)
+        imports.invalidate()
 
     def uninstall_wagon(self, package_name, package_version):
         """Uninstall a wagon (used by tests and by the plugins REST API)"""
-        dst_dir = '{0}-{1}'.format(package_name, package_version)
-        dst_dir = self._full_dst_dir(dst_dir)
-        if os.path.isdir(dst_dir):
-            self._rmtree(dst_dir)
+        dst_name = '{0}-{1}'.format(package_name, package_version)
+        self._discard(self._full_dst_dir(dst_name))
+        self._index().remove(dst_name)
+        invalidate_managed_plugins()
+        imports.invalidate()
+
+    def collect_garbage(self,
+                        quota=None,
+                        deployment_ids=None,
+                        deployments_listed_at=None):
+        """
+        Remove the least recently used plugin installations that are not
+        referenced by any deployment, until all installations fit in the
+        disk quota. Installations of unknown users, e.g. ones installed
+        before the index existed, are kept, except for source plugins
+        whose deployment (the prefix of their directory name) was deleted.
+
+        :param quota: the quota in bytes, defaults to the configured quota
+                      (see `utils.internal.get_plugins_disk_quota`). If
+                      not specified and no quota is configured, nothing is
+                      removed.
+        :param deployment_ids: the IDs of the deployments that exist on
+                               the manager (see `get_deployment_ids`).
+                               References by other deployments, which were
+                               deleted without uninstalling their plugins,
+                               are ignored. If not specified, all
+                               references are respected.
+        :param deployments_listed_at: the time `deployment_ids` were listed
+                                      at, defaults to now. Installations
+                                      used since then may be referenced by
+                                      deployments created since then, so
+                                      all of their references are
+                                      respected.
+
+        :return: the number of bytes reclaimed.
+        """
+        if deployments_listed_at is None:
+            deployments_listed_at = time.time()
+        if quota is None:
+            quota = utils.internal.get_plugins_disk_quota() or None
+        plugin_index = self._index()
+        entries = []
+        for entry in plugin_index.list():
+            if os.path.isdir(self._full_dst_dir(entry['dir'])):
+                entries.append(entry)
+            else:
+                # removed without going through the installer
+                plugin_index.remove(entry['dir'])
+        if quota is None:
+            return 0
+        total = sum(entry['size'] or 0 for entry in entries)
+        reclaimed = 0
+        for entry in sorted(entries, key=lambda e: e['last_used'] or 0):
+            if total <= quota:
+                break
+            if _referenced(entry, deployment_ids, deployments_listed_at):
+                continue
+            if self._evict(entry['dir'], deployment_ids,
+                           deployments_listed_at):
+                self.logger.info('Removed unused plugin {0} [{1} bytes]'
+                                 .format(entry['dir'], entry['size']))
+                total -= entry['size'] or 0
+                reclaimed += entry['size'] or 0
+        self.logger.info('Plugins garbage collection reclaimed {0} bytes, '
+                         '{1} bytes in use [quota: {2} bytes]'
+                         .format(reclaimed, total, quota))
+        return reclaimed
+
+    def _evict(self, dir_name, deployment_ids, deployments_listed_at):
+        dst_dir = self._full_dst_dir(dir_name)
+        lock = self._lock(dst_dir)
+        # being installed (or reused) right now
+        if not lock.acquire(blocking=False):
+            return False
+        try:
+            # references may have been added since the entry was listed
+            entry = self._index().get(dir_name)
+            if entry is None or _referenced(entry, deployment_ids,
+                                            deployments_listed_at):
+                return False
+            self._discard(dst_dir)
+            self._index().remove(dir_name)
+            return True
+        finally:
+            lock.release()
+
+    def _discard(self, path):
+        # plugin trees are large, so they are deleted in the background.
+        # deduplicated content is kept as long as other installations
+        # reference it
+        if self._trash().discard(path):
+            trash.reap_in_background(logger=self.logger)
+
+    def _trash(self):
+        if self.trash is None:
+            self.trash = trash.Trash(dedup_store=self._dedup_store(),
+                                     logger=self.logger)
+        return self.trash
 
     @staticmethod
     def _create_plugins_dir_if_missing():
@@ -305,99 +756,126 @@ class PluginInstaller(object):
 
     @staticmethod
     def _lock(path):
-        return fasteners.InterProcessLock('{0}.lock'.format(path))
+        return utils.PathLock('{0}.lock'.format(path))
 
     @staticmethod
     def _rmtree(path):
         shutil.rmtree(path, ignore_errors=True)
 
 
-def extract_package_to_dir(package_url):
+def get_deployment_ids(page_size=1000):
+    """
+    Returns the IDs of the deployments that exist on the manager.
+    """
+    client = get_rest_client()
+    deployment_ids = set()
+    while True:
+        deployments = client.deployments.list(_include=['id'],
+                                              _offset=len(deployment_ids),
+                                              _size=page_size)
+        deployment_ids.update(deployment.id for deployment in deployments)
+        if (not deployments.items or len(deployment_ids) >=
+                deployments.metadata.pagination.total):
+            return deployment_ids
+
+
+def _referenced(entry, deployment_ids, deployments_listed_at):
+    if entry['deployment_id'] is None:
+        # never referenced, so its users are unknown
+        return True
+    if (deployment_ids is not None and
+            (entry['last_used'] or 0) >= deployments_listed_at):
+        # possibly by a deployment created after the listing
+        return True
+    for deployment_id in entry['deployments']:
+        if deployment_id == index.LEGACY:
+            if deployment_ids is None or entry['kind'] != index.SOURCE:
+                return True
+            # source plugins are installed into <deployment id>-<name>
+            existing = set(deployment_ids) | set([SYSTEM_DEPLOYMENT])
+            if any(entry['dir'].startswith('{0}-'.format(deployment))
+                   for deployment in existing):
+                return True
+        elif (deployment_ids is None or
+              deployment_id == SYSTEM_DEPLOYMENT or
+              deployment_id in deployment_ids):
+            return True
+    return False
+
+
+def extract_package_to_dir(package_url, logger=None):
     """
     Extracts a pip package to a temporary directory.
 
     :param package_url: the URL to the package source.
+    :param logger: a logger to report the download progress to.
 
     :return: the directory the package was extracted to.
     """
+    return download_package_to_dir(package_url, logger=logger)[0]
 
-    # 1) Plugin installation during deployment creation occurs not in the main
-    # thread, but rather in the local task thread pool.
-    # When installing source based plugins, pip will install an
-    # interrupt handler using signal.signal, this will fail saying something
-    # like "signals are only allowed in the main thread"
-    # from examining the code, I found patching signal in pip.util.ui
-    # is the cleanest form. No "official" way of disabling this was found.
-    # 2) pip.utils logger may be used internally by pip during some
-    # ImportError. This interferes with our ZMQLoggingHandler which during
-    # the first time it is invoked tries importing some stuff. This causes
-    # a deadlock between the handler lock and the global import lock. One side
-    # holds the import lock and tried writing to the logger and is blocked on
-    # the handler lock, while the other side holds the handler lock and is
-    # blocked on the import lock. This is why we patch the logging level
-    # of this logger - by name, before importing pip. (see CFY-4866)
-    _previous_signal = []
-    _previous_level = []
-
-    def _patch_pip_download():
-        pip_utils_logger = logging.getLogger('pip.utils')
-        _previous_level.append(pip_utils_logger.level)
-        pip_utils_logger.setLevel(logging.CRITICAL)
 
-        try:
-            import pip.utils.ui
+def download_package_to_dir(package_url, logger=None, source_cache=None):
+    """
+    Downloads and extracts a pip package to a temporary directory, while
+    calculating the package archive digest and size.
 
-            def _stub_signal(sig, action):
-                return None
-            if hasattr(pip.utils.ui, 'signal'):
-                _previous_signal.append(pip.utils.ui.signal)
-                pip.utils.ui.signal = _stub_signal
-        except ImportError:
-            pass
+    :param package_url: the URL to the package source.
+    :param logger: a logger to report the download progress to.
+    :param source_cache: a `cache.SourceCache` to download the package
+                         archive through, if the URL is cacheable.
 
-    def _restore_pip_download():
-        try:
-            import pip.utils.ui
-            if hasattr(pip.utils.ui, 'signal') and _previous_signal:
-                pip.utils.ui.signal = _previous_signal[0]
-        except ImportError:
-            pass
-        pip_utils_logger = logging.getLogger('pip.utils')
-        pip_utils_logger.setLevel(_previous_level[0])
-
-    plugin_dir = None
+    :return: a tuple of the directory the package was extracted to, the
+             download result (see `download.DownloadResult`), and whether
+             the archive was found in the source cache.
+    """
+    plugin_dir = tempfile.mkdtemp()
+    cache_hit = False
     try:
-        plugin_dir = tempfile.mkdtemp()
-        _patch_pip_download()
-        # Import here, after patch
-        import pip
-        pip.download.unpack_url(link=pip.index.Link(package_url),
-                                location=plugin_dir,
-                                download_dir=None,
-                                only_download=False)
+        url = package_url
+        if (source_cache is not None and source_cache.enabled and
+                source_cache.cacheable(package_url)):
+            archive_path, cache_hit = source_cache.fetch(package_url)
+            url = 'file://{0}'.format(urllib.pathname2url(archive_path))
+        result = download.download_and_extract(url,
+                                               plugin_dir,
+                                               logger=logger)
     except Exception as e:
-        if plugin_dir and os.path.exists(plugin_dir):
-            shutil.rmtree(plugin_dir)
+        shutil.rmtree(plugin_dir, ignore_errors=True)
         raise exceptions.PluginInstallationError(
             'Failed to download and unpack package from {0}: {1}.'
             'You may consider uploading the plugin\'s Wagon archive '
             'to the manager, For more information please refer to '
             'the documentation.'.format(package_url, str(e)))
-    finally:
-        _restore_pip_download()
-
-    return plugin_dir
+    return plugin_dir, result, cache_hit
 
 
-def extract_package_name(package_dir):
+def extract_package_name(package_dir, digest=None):
     """
     Detects the package name of the package located at 'package_dir' as
-    specified in the package setup.py file.
+    specified in the package metadata files. setup.py is only executed if
+    the name cannot be read statically.
 
     :param package_dir: the directory the package was extracted to.
+    :param digest: the digest of the package archive, used as the cache
+                   key for the name. if not specified, a digest of the
+                   package metadata files is used.
 
     :return: the package name
     """
+    digest = digest or metadata.metadata_digest(package_dir)
+    names = metadata.get_package_name_cache()
+    plugin_name = names.get(digest)
+    if plugin_name:
+        return plugin_name
+    plugin_name = metadata.read_package_name(package_dir)
+    if not plugin_name:
+        plugin_name = _run_extract_package_name(package_dir)
+    names.put(digest, plugin_name)
+    return plugin_name
+
+
+def _run_extract_package_name(package_dir):
     runner = LocalCommandRunner()
     plugin_name = runner.run(
         '{0} {1} {2}'.format(
@@ -410,7 +888,27 @@ def extract_package_name(package_dir):
     return plugin_name
 
 
+def _prefix_distributions(prefix):
+    site_packages = (glob.glob(os.path.join(prefix, 'lib*', 'python*',
+                                            'site-packages')) +
+                     glob.glob(os.path.join(prefix, 'Lib', 'site-packages')))
+    for path in site_packages:
+        for dist in pkg_resources.find_distributions(path):
+            yield dist
+
+
 def get_managed_plugin(plugin, logger=None):
+    """
+    Lookup the managed plugin (wagon) on the manager matching a plugin
+    structure and the current platform.
+
+    Lookups are cached by the process for a short while (see
+    `utils.internal.get_managed_plugins_cache_ttl`), so that installing
+    many plugins, or the same plugins for many deployments, does not query
+    the manager every time. Negative results are cached as well.
+
+    :return: the managed plugin, or None if there is no matching one.
+    """
     package_name = plugin.get('package_name')
     package_version = plugin.get('package_version')
     distribution = plugin.get('distribution')
@@ -437,6 +935,36 @@ def get_managed_plugin(plugin, logger=None):
         query_parameters['distribution_release'] = distribution_release
     if supported_platform:
         query_parameters['supported_platform'] = supported_platform
+
+    # the query parameters determine the result, as the current platform
+    # does not change
+    key = tuple(sorted(query_parameters.items()))
+    ttl = utils.internal.get_managed_plugins_cache_ttl()
+    if ttl > 0:
+        with _managed_plugins_lock:
+            expires_at, managed_plugin = _managed_plugins.get(key,
+                                                              (0, None))
+        if expires_at > time.time():
+            return managed_plugin
+    managed_plugin = _query_managed_plugin(query_parameters)
+    if ttl > 0:
+        with _managed_plugins_lock:
+            _managed_plugins[key] = (time.time() + ttl, managed_plugin)
+    return managed_plugin
+
+
+def invalidate_managed_plugins():
+    """
+    Forget the cached managed plugin lookups (see `get_managed_plugin`).
+    """
+    with _managed_plugins_lock:
+        _managed_plugins.clear()
+
+
+def _query_managed_plugin(query_parameters):
+    supported_platform = query_parameters.get('supported_platform')
+    distribution = query_parameters.get('distribution')
+    distribution_release = query_parameters.get('distribution_release')
     client = get_rest_client()
     plugins = client.plugins.list(**query_parameters)
 
@@ -466,10 +994,17 @@ def get_managed_plugin(plugin, logger=None):
 
 
 def _extract_platform_and_distro_info():
-    current_platform = wagon_utils.get_platform()
-    distribution, _, distribution_release = platform.linux_distribution(
-        full_distribution_name=False)
-    return current_platform, distribution.lower(), distribution_release.lower()
+    # does not change during the process lifetime, and is costly to
+    # detect (platform.linux_distribution reads files under /etc)
+    global _platform_and_distro_info
+    if _platform_and_distro_info is None:
+        current_platform = wagon_utils.get_platform()
+        distribution, _, distribution_release = platform.linux_distribution(
+            full_distribution_name=False)
+        _platform_and_distro_info = (current_platform,
+                                     distribution.lower(),
+                                     distribution_release.lower())
+    return _platform_and_distro_info
 
 
 def get_plugin_source(plugin, blueprint_id=None):
@@ -0,0 +1,253 @@
+#########
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+Structured timing events of plugin installations.
+
+The installer reports every phase of an installation (e.g. download, pip
+install) to an instrumentation hook, as an event dict:
+
+    {
+        "timestamp": 1490000000.0,
+        "phase": "download",
+        "duration": 0.42,
+        "plugin": "openstack",
+        "version": "2.0.1",
+        "managed": true,
+        "deployment_id": "dep",
+        "cache_hit": false,
+        "bytes": 1048576,
+        "error": null
+    }
+
+By default, instrumentation is disabled and costs nothing. Setting
+CLOUDIFY_PLUGINS_INSTRUMENTATION to 'true' writes the events as JSON lines
+next to the daemon log, and setting it to a path writes them there.
+Other hooks can be plugged in with `set_instrumentation`.
+"""
+
+import os
+import json
+import time
+import threading
+import contextlib
+
+from cloudify_agent.api import utils
+
+PHASE_FIELDS = ('plugin',
+                'version',
+                'managed',
+                'deployment_id',
+                'cache_hit',
+                'bytes',
+                'error')
+
+_ENABLED_VALUES = ('true', 'yes', '1')
+_DISABLED_VALUES = ('false', 'no', '0')
+
+_instrumentation = None
+_instrumentation_lock = threading.Lock()
+
+
+class _NullEvent(dict):
+
+    """
+    An event that ignores whatever is set on it.
+    """
+
+    def __setitem__(self, key, value):
+        pass
+
+    def update(self, *args, **kwargs):
+        pass
+
+
+class _NullContext(object):
+
+    def __enter__(self):
+        return _NULL_EVENT
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_EVENT = _NullEvent()
+_NULL_CONTEXT = _NullContext()
+
+
+class Instrumentation(object):
+
+    """
+    The instrumentation hook. This implementation discards all events,
+    subclasses implement `emit`.
+    """
+
+    enabled = False
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def install(self, **fields):
+
+        """
+        Mark the installation of a plugin by the current thread. The
+        fields (plugin, version, managed, deployment_id) are added to all
+        of the events of the installation, which is itself reported as the
+        'install' phase.
+        """
+
+        if not self.enabled:
+            return _NULL_CONTEXT
+        return self._install(fields)
+
+    def phase(self, name, **fields):
+
+        """
+        Time a phase of the current installation. The yielded event may be
+        updated with additional fields (e.g. cache_hit, bytes).
+
+        :param name: the phase name.
+        """
+
+        if not self.enabled:
+            return _NULL_CONTEXT
+        return self._phase(name, fields)
+
+    def update(self, **fields):
+
+        """
+        Update the fields of the current installation (e.g. once it is
+        known whether the plugin is managed).
+        """
+
+        if not self.enabled:
+            return
+        current = getattr(self._local, 'fields', None)
+        if current is not None:
+            current.update(fields)
+            self._local.event.update(fields)
+
+    def emit(self, event):
+
+        """
+        Report an event.
+
+        :param event: the event dict.
+        """
+
+        pass
+
+    @contextlib.contextmanager
+    def _install(self, fields):
+        previous = (getattr(self._local, 'fields', None),
+                    getattr(self._local, 'event', None))
+        self._local.fields = dict(fields)
+        try:
+            with self._phase('install', {}) as event:
+                self._local.event = event
+                yield event
+        finally:
+            self._local.fields, self._local.event = previous
+
+    @contextlib.contextmanager
+    def _phase(self, name, fields):
+        event = dict.fromkeys(PHASE_FIELDS)
+        event.update(getattr(self._local, 'fields', None) or {})
+        event.update(fields)
+        event['phase'] = name
+        start = time.time()
+        try:
+            yield event
+        except BaseException as e:
+            event['error'] = '{0}: {1}'.format(type(e).__name__, e)
+            raise
+        finally:
+            event['timestamp'] = start
+            event['duration'] = time.time() - start
+            try:
+                self.emit(event)
+            except Exception:
+                # instrumentation must never fail an installation
+                pass
+
+
+class JSONLinesInstrumentation(Instrumentation):
+
+    """
+    Appends events as JSON lines to a file.
+    """
+
+    enabled = True
+
+    def __init__(self, path):
+        super(JSONLinesInstrumentation, self).__init__()
+        self.path = path
+        self._lock = threading.Lock()
+
+    def emit(self, event):
+        line = json.dumps(event, sort_keys=True)
+        with self._lock:
+            # a single write of a line opened for append, so concurrent
+            # writers (e.g. other workers) do not interleave lines
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+
+
+def default_events_path():
+
+    """
+    The path of the default events file, next to the daemon log.
+    """
+
+    work_dir = os.environ.get('CELERY_WORK_DIR') or \
+        utils.internal.get_storage_directory()
+    name = os.environ.get(utils.internal.CLOUDIFY_DAEMON_NAME_KEY) or \
+        'cfy-agent'
+    return os.path.join(work_dir, '{0}.plugins.jsonl'.format(name))
+
+
+def get_instrumentation():
+
+    """
+    Returns the process wide instrumentation hook, as configured by the
+    CLOUDIFY_PLUGINS_INSTRUMENTATION environment variable.
+    """
+
+    global _instrumentation
+    with _instrumentation_lock:
+        if _instrumentation is None:
+            setting = utils.internal.get_plugins_instrumentation()
+            if not setting or setting.lower() in _DISABLED_VALUES:
+                _instrumentation = Instrumentation()
+            elif setting.lower() in _ENABLED_VALUES:
+                _instrumentation = JSONLinesInstrumentation(
+                    default_events_path())
+            else:
+                _instrumentation = JSONLinesInstrumentation(setting)
+        return _instrumentation
+
+
+def set_instrumentation(instrumentation):
+
+    """
+    Replace the process wide instrumentation hook.
+
+    :param instrumentation: an `Instrumentation` instance, or None to
+                            re-read the configuration.
+    """
+
+    global _instrumentation
+    with _instrumentation_lock:
+        _instrumentation = instrumentation
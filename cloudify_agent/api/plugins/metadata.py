@@ -0,0 +1,207 @@
+#########
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+Static (no code execution) reading of python package metadata.
+"""
+
+import os
+import re
+import ast
+import errno
+import hashlib
+import tempfile
+import threading
+import ConfigParser
+from email.parser import HeaderParser
+
+from cloudify_agent.api import utils
+
+# files a package name may be read from, in order of precedence
+METADATA_FILES = ('PKG-INFO', 'setup.py', 'setup.cfg', 'pyproject.toml')
+
+_PYPROJECT_SECTION = re.compile(r'^\s*\[([^\]]+)\]\s*$')
+_PYPROJECT_NAME = re.compile(r'''^\s*name\s*=\s*(['"])([^'"]+)\1\s*$''')
+
+_name_caches = {}
+_name_caches_lock = threading.Lock()
+
+
+def read_package_name(package_dir):
+
+    """
+    Read the name of the package located at `package_dir` without running
+    its setup.py.
+
+    :param package_dir: the package root directory.
+
+    :return: the package name, or None if it cannot be determined
+             statically (e.g. it is computed by setup.py).
+    """
+
+    readers = (_name_from_pkg_info,
+               _name_from_setup_py,
+               _name_from_setup_cfg,
+               _name_from_pyproject)
+    for file_name, reader in zip(METADATA_FILES, readers):
+        path = os.path.join(package_dir, file_name)
+        if not os.path.isfile(path):
+            continue
+        try:
+            name = reader(path)
+        except (SyntaxError, ConfigParser.Error, IOError):
+            name = None
+        if name and name.strip() != 'UNKNOWN':
+            return name.strip()
+    return None
+
+
+def metadata_digest(package_dir):
+
+    """
+    A digest of the metadata files of a package. Used as a cache key for
+    the package name, when the digest of the package archive is not known.
+    """
+
+    digest = hashlib.sha256()
+    for file_name in METADATA_FILES:
+        path = os.path.join(package_dir, file_name)
+        if os.path.isfile(path):
+            digest.update(file_name)
+            with open(path, 'rb') as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()
+
+
+class PackageNameCache(object):
+
+    """
+    Package names by package digest, kept in memory and on disk.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._names = {}
+        self._lock = threading.Lock()
+
+    def get(self, digest):
+        with self._lock:
+            if digest in self._names:
+                return self._names[digest]
+        try:
+            with open(os.path.join(self.root, digest)) as f:
+                name = f.read().strip()
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        if not name:
+            return None
+        with self._lock:
+            self._names[digest] = name
+        return name
+
+    def put(self, digest, name):
+        with self._lock:
+            self._names[digest] = name
+        try:
+            utils.safe_create_dir(self.root)
+            fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix='.')
+            with os.fdopen(fd, 'w') as f:
+                f.write(name)
+            os.rename(tmp_path, os.path.join(self.root, digest))
+        except (IOError, OSError):
+            # the in memory cache is good enough
+            pass
+
+
+def get_package_name_cache():
+
+    """
+    Returns the package name cache of the current plugins cache directory.
+    """
+
+    root = os.path.join(utils.internal.get_plugins_cache_dir(),
+                        'package-names')
+    with _name_caches_lock:
+        if root not in _name_caches:
+            _name_caches[root] = PackageNameCache(root)
+        return _name_caches[root]
+
+
+def _name_from_pkg_info(path):
+    with open(path) as f:
+        return HeaderParser().parse(f, headersonly=True).get('Name')
+
+
+def _name_from_setup_cfg(path):
+    # setup.cfg [metadata] section is used by both setuptools and pbr
+    config = ConfigParser.RawConfigParser()
+    config.read(path)
+    if config.has_option('metadata', 'name'):
+        return config.get('metadata', 'name')
+    return None
+
+
+def _name_from_pyproject(path):
+    # a minimal reading of the [project] table, which is all that's needed
+    # for the name, without requiring a toml parser
+    section = None
+    with open(path) as f:
+        for line in f:
+            match = _PYPROJECT_SECTION.match(line)
+            if match:
+                section = match.group(1).strip()
+                continue
+            if section == 'project':
+                match = _PYPROJECT_NAME.match(line)
+                if match:
+                    return match.group(2)
+    return None
+
+
+def _name_from_setup_py(path):
+    with open(path) as f:
+        tree = ast.parse(f.read(), path)
+
+    # module level constants, e.g. NAME = 'plugin'; setup(name=NAME)
+    constants = {}
+    for node in tree.body:
+        if (isinstance(node, ast.Assign) and
+                len(node.targets) == 1 and
+                isinstance(node.targets[0], ast.Name) and
+                isinstance(node.value, ast.Str)):
+            constants[node.targets[0].id] = node.value.s
+
+    for node in ast.walk(tree):
+        if not (isinstance(node, ast.Call) and _is_setup(node.func)):
+            continue
+        for keyword in node.keywords:
+            if keyword.arg != 'name':
+                continue
+            if isinstance(keyword.value, ast.Str):
+                return keyword.value.s
+            if isinstance(keyword.value, ast.Name):
+                return constants.get(keyword.value.id)
+            return None
+    return None
+
+
+def _is_setup(func):
+    if isinstance(func, ast.Name):
+        return func.id == 'setup'
+    if isinstance(func, ast.Attribute):
+        return func.attr == 'setup'
+    return False
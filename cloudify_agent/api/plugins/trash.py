@@ -0,0 +1,226 @@
+#########
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+Asynchronous removal of plugin installations.
+
+Plugin installations may hold tens of thousands of files, so rather than
+being removed while an operation waits, they are renamed into a trash
+directory (which is atomic and immediate), and deleted by a background
+reaper thread at a bounded rate, so that the deletion does not starve
+other disk users. Whatever is left in the trash (e.g. by a worker that
+was killed) is deleted the next time the reaper runs, which is also on
+agent start.
+"""
+
+import os
+import time
+import errno
+import uuid
+import threading
+
+from cloudify.utils import setup_logger
+
+from cloudify_agent import VIRTUALENV
+from cloudify_agent.api import utils
+from cloudify_agent.api.plugins import dedup
+
+# seconds to wait before retrying, when another process is reaping
+RETRY_INTERVAL = 5
+
+# files removed between rate checks
+_RATE_CHECK_INTERVAL = 100
+
+_reaper = None
+_reaper_lock = threading.Lock()
+
+
+class Trash(object):
+
+    def __init__(self, root=None, rate=None, dedup_store=None, logger=None):
+
+        """
+        :param root: the trash directory. It must reside on the same file
+                     system as whatever is discarded into it. Defaults to
+                     `VIRTUALENV/plugins/.trash`.
+        :param rate: the maximal number of files (and directories) removed
+                     per second, 0 for unlimited.
+        :param dedup_store: the store to garbage collect when deduplicated
+                            installations are removed.
+        :param logger: a logger to use.
+        """
+
+        self.root = root or os.path.join(VIRTUALENV, 'plugins', '.trash')
+        if rate is None:
+            rate = utils.internal.get_plugins_trash_reap_rate()
+        self.rate = rate
+        self.logger = logger or setup_logger(self.__class__.__name__)
+        self.dedup_store = dedup_store or dedup.DedupStore(
+            logger=self.logger)
+
+    def discard(self, path):
+
+        """
+        Move a directory into the trash.
+
+        :return: the path of the directory in the trash, or None if it did
+                 not exist.
+        """
+
+        utils.safe_create_dir(self.root)
+        trashed = os.path.join(self.root, '{0}-{1}'.format(
+            os.path.basename(path), uuid.uuid4().hex))
+        try:
+            os.rename(path, trashed)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        self.logger.debug('Discarded {0} [{1}]'.format(path, trashed))
+        return trashed
+
+    def entries(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(os.path.join(self.root, name)
+                      for name in os.listdir(self.root)
+                      if not name.startswith('.'))
+
+    def empty(self, blocking=True):
+
+        """
+        Delete everything in the trash, including whatever is discarded
+        while emptying it.
+
+        :param blocking: whether to wait for another process emptying the
+                         trash.
+
+        :return: the number of entries deleted, or None if another
+                 process is emptying the trash and `blocking` is False.
+        """
+
+        utils.safe_create_dir(self.root)
+        lock = utils.PathLock(os.path.join(self.root, '.lock'))
+        if not lock.acquire(blocking=blocking):
+            return None
+        try:
+            removed = 0
+            failed = set()
+            entries = self.entries()
+            while entries:
+                for path in entries:
+                    if self._remove_entry(path):
+                        removed += 1
+                    else:
+                        failed.add(path)
+                entries = [path for path in self.entries()
+                           if path not in failed]
+            return removed
+        finally:
+            lock.release()
+
+    def _remove_entry(self, path):
+        manifest = dedup.read_manifest(path)
+        start = time.time()
+        count = self._remove_tree(path)
+        if os.path.lexists(path):
+            self.logger.warn('Failed deleting {0}, it will be retried '
+                             'later'.format(path))
+            return False
+        self.logger.debug('Deleted {0} [{1} files in {2:.2f} seconds]'
+                          .format(path, count, time.time() - start))
+        if manifest:
+            # the objects linked from the removed tree may now be
+            # unreferenced
+            self.dedup_store.forget(manifest)
+        return True
+
+    def _remove_tree(self, path):
+        start = time.time()
+        count = 0
+        for dir_path, dir_names, file_names in os.walk(path,
+                                                       topdown=False):
+            # symlinks to directories are listed as directories
+            for name in file_names + dir_names:
+                entry_path = os.path.join(dir_path, name)
+                if name in dir_names and not os.path.islink(entry_path):
+                    _remove(os.rmdir, entry_path)
+                else:
+                    _remove(os.remove, entry_path)
+                count += 1
+                if self.rate and count % _RATE_CHECK_INTERVAL == 0:
+                    delay = start + float(count) / self.rate - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+        _remove(os.rmdir, path)
+        return count + 1
+
+
+class Reaper(threading.Thread):
+
+    """
+    A background thread emptying a trash whenever woken up.
+    """
+
+    def __init__(self, trash):
+        super(Reaper, self).__init__(name='plugins-trash-reaper')
+        self.daemon = True
+        self.trash = trash
+        self._wakeup = threading.Event()
+
+    def wake(self):
+        self._wakeup.set()
+
+    def run(self):
+        pending = True
+        while True:
+            if not pending:
+                self._wakeup.wait()
+            else:
+                self._wakeup.wait(RETRY_INTERVAL)
+            self._wakeup.clear()
+            try:
+                # another process emptying the trash might have missed
+                # entries discarded by this one, so keep on retrying
+                # until the trash is emptied here
+                pending = self.trash.empty(blocking=False) is None
+            except Exception as e:
+                # retried on the next wake up
+                self.trash.logger.warn('Failed emptying the plugins trash: '
+                                       '{0}'.format(e))
+                pending = False
+
+
+def _remove(remove, path):
+    try:
+        remove(path)
+    except OSError:
+        # reported once the whole tree is processed
+        pass
+
+
+def reap_in_background(logger=None):
+
+    """
+    Empty the plugins trash in a background thread of the current process,
+    starting the thread if needed.
+    """
+
+    global _reaper
+    with _reaper_lock:
+        if _reaper is None or not _reaper.is_alive():
+            _reaper = Reaper(Trash(logger=logger))
+            _reaper.start()
+        _reaper.wake()
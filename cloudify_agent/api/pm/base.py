@@ -13,14 +13,17 @@
 #  * See the License for the specific language governing permissions and
 #  * limitations under the License.
 
+import errno
+import pipes
+import contextlib
 import getpass
+import functools
 import json
 import os
 import time
 
 from cloudify.utils import (LocalCommandRunner,
                             setup_logger)
-from cloudify import amqp_client
 from cloudify import constants
 
 from cloudify_agent import VIRTUALENV
@@ -31,6 +34,24 @@ from cloudify_agent.api import defaults
 
 AGENT_IS_REGISTERED_TIMEOUT = 1
 
+# node instances listed per request, when looking up the host node instance
+NODE_INSTANCES_PAGE_SIZE = 1000
+
+
+def with_broker_connection(func):
+
+    """
+    Share a single broker connection between all broker operations of a
+    daemon method, including nested calls (e.g. `stop` and `start` within
+    `restart`). The connection is closed when the method returns.
+    """
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self._broker_connection():
+            return func(self, *args, **kwargs)
+    return wrapper
+
 
 class Daemon(object):
 
@@ -66,6 +87,13 @@ class Daemon(object):
         such case, this property must match the 'ip' runtime property given
         to the corresponding Compute node.
 
+    ``host_id``:
+
+        the id of the Compute node instance of the host the agent will be
+        started on. like 'host', this property is used only when the
+        'queue' or 'name' property are omitted, and if given, the node
+        instance is retrieved directly rather than searched for by its ip.
+
     ``deployment_id``:
 
         the deployment id this agent will be a part of. this
@@ -266,6 +294,14 @@ class Daemon(object):
         self._rest_username = params.get('rest_username')
         self._rest_password = params.get('rest_password')
         self._rest_token = params.get('rest_token')
+        self._broker = None
+        self._amqp_queues_deletion_deferred = False
+        self._staging = None
+
+        # needed for retrieving the name and queue from the manager
+        self.host = params.get('host')
+        self.host_id = params.get('host_id')
+        self.deployment_id = params.get('deployment_id')
 
         # Optional parameters
         self.name = params.get(
@@ -279,8 +315,6 @@ class Daemon(object):
         self.broker_port = self._get_broker_port()
         self.broker_user = params.get('broker_user', 'guest')
         self.broker_pass = params.get('broker_pass', 'guest')
-        self.host = params.get('host')
-        self.deployment_id = params.get('deployment_id')
         self.security_enabled = params.get('security_enabled')
         self.verify_rest_certificate = params.get('verify_rest_certificate')
         self.local_rest_cert_file = params.get('local_rest_cert_file', '')
@@ -375,20 +409,69 @@ class Daemon(object):
         else:
             return constants.BROKER_PORT_NO_SSL
 
-    def _is_agent_registered(self):
-        celery_client = utils.get_celery_client(
-            broker_url=self.broker_url,
-            broker_ssl_enabled=self.broker_ssl_enabled,
-            broker_ssl_cert_path=self.broker_ssl_cert_path)
+    def set_broker_connection(self, connection):
+
+        """
+        Use a broker connection shared with other daemons, rather than one
+        of its own. The connection is not closed by the daemon.
+
+        :param connection: the connection to use.
+        :type connection: cloudify_agent.api.utils.BrokerConnection
+        """
+
+        self._broker = connection
+
+    def amqp_queues(self):
+
+        """
+        The AMQP queues consumed by the daemon.
+        """
+
+        return [self.queue, 'celery@{0}.celery.pidbox'.format(self.name)]
+
+    def defer_amqp_queues_deletion(self):
+
+        """
+        Do not delete the daemon AMQP queues once it is stopped, so that
+        whoever stops many daemons can delete all of their queues together
+        (see `cloudify_agent.api.utils.delete_daemons_queues`).
+        """
+
+        self._amqp_queues_deletion_deferred = True
+
+    def _broker_connection(self):
+        if self._broker is None:
+            self._broker = utils.BrokerConnection(
+                broker_url=self.broker_url,
+                broker_ssl_enabled=self.broker_ssl_enabled,
+                broker_ssl_cert_path=self.broker_ssl_cert_path)
+        return self._broker
+
+    @contextlib.contextmanager
+    def _privileged(self):
+
+        """
+        Collect the privileged changes made within the context, and apply
+        them all with a single privileged command once it exits. Nested
+        contexts share the changes of the outermost one.
+        """
+
+        if self._staging is not None:
+            yield self._staging
+            return
+        self._staging = _PrivilegedStaging(self._runner, self._logger)
         try:
-            self._logger.debug('Retrieving daemon registered tasks')
-            return utils.get_agent_registered(
-                    self.name,
-                    celery_client,
-                    timeout=AGENT_IS_REGISTERED_TIMEOUT)
+            yield self._staging
+            self._staging.apply()
         finally:
-            if celery_client:
-                celery_client.close()
+            self._staging.clean()
+            self._staging = None
+
+    def _is_agent_registered(self):
+        self._logger.debug('Retrieving daemon registered tasks')
+        return self._broker_connection().get_agent_registered(
+            self.name,
+            timeout=AGENT_IS_REGISTERED_TIMEOUT)
 
     ########################################################################
     # the following methods must be implemented by the sub-classes as they
@@ -471,6 +554,7 @@ class Daemon(object):
         self.create_config()
         self.create_celery_conf()
 
+    @with_broker_connection
     def start(self,
               interval=defaults.START_INTERVAL,
               timeout=defaults.START_TIMEOUT,
@@ -496,12 +580,24 @@ class Daemon(object):
         if delete_amqp_queue:
             self._logger.debug('Deleting AMQP queues')
             self._delete_amqp_queues()
+        # the worker creates the readiness file once it is ready, so one
+        # left by a previous run must not be mistaken for it
+        ready_path = self._ready_path()
+        if os.path.exists(ready_path):
+            os.remove(ready_path)
         start_command = self.start_command()
         self._logger.info('Starting daemon with command: {0}'
                           .format(start_command))
         self._runner.run(start_command)
         end_time = time.time() + timeout
         while time.time() < end_time:
+            if self._wait_until_ready(
+                    min(interval, max(end_time - time.time(), 0))):
+                self._logger.debug('Daemon {0} has started'
+                                   .format(self.name))
+                return
+            # fall back to querying the daemon, e.g. if it runs an agent
+            # version that does not create the readiness file
             self._logger.debug('Querying daemon {0} registered tasks'.format(
                 self.name))
             if self._is_agent_registered():
@@ -511,15 +607,14 @@ class Daemon(object):
                     self._logger.debug('Daemon {0} has started'
                                        .format(self.name))
                     return
-            self._logger.debug('Daemon {0} has not started yet. '
-                               'Sleeping for {1} seconds...'
-                               .format(self.name, interval))
-            time.sleep(interval)
+            self._logger.debug('Daemon {0} has not started yet'
+                               .format(self.name))
         self._logger.debug('Verifying there were no un-handled '
                            'exception during startup')
         self._verify_no_celery_error()
         raise exceptions.DaemonStartupTimeout(timeout, self.name)
 
+    @with_broker_connection
     def stop(self,
              interval=defaults.STOP_INTERVAL,
              timeout=defaults.STOP_TIMEOUT):
@@ -554,8 +649,9 @@ class Daemon(object):
                 if not status:
                     self._logger.debug('Daemon {0} has shutdown'
                                        .format(self.name, interval))
-                    self._logger.debug('Deleting AMQP queues')
-                    self._delete_amqp_queues()
+                    if not self._amqp_queues_deletion_deferred:
+                        self._logger.debug('Deleting AMQP queues')
+                        self._delete_amqp_queues()
                     return
             self._logger.debug('Daemon {0} is still running. '
                                'Sleeping for {1} seconds...'
@@ -566,6 +662,7 @@ class Daemon(object):
         self._verify_no_celery_error()
         raise exceptions.DaemonShutdownTimeout(timeout, self.name)
 
+    @with_broker_connection
     def restart(self,
                 start_timeout=defaults.START_TIMEOUT,
                 start_interval=defaults.START_INTERVAL,
@@ -646,29 +743,36 @@ class Daemon(object):
             os.remove(error_dump_path)
             raise exceptions.DaemonError(error)
 
-    def _delete_amqp_queues(self):
-        client = amqp_client.create_client(
-            amqp_host=self.broker_ip,
-            amqp_user=self.broker_user,
-            amqp_pass=self.broker_pass,
-            ssl_enabled=self.broker_ssl_enabled,
-            ssl_cert_path=self.broker_ssl_cert_path,
-        )
+    def _ready_path(self):
+        return utils.get_daemon_ready_path(
+            utils.internal.get_storage_directory(self.user), self.name)
 
-        try:
-            channel = client.connection.channel()
-            self._logger.debug('Deleting queue: {0}'.format(self.queue))
+    def _wait_until_ready(self, timeout):
 
-            channel.queue_delete(self.queue)
-            pid_box_queue = 'celery@{0}.celery.pidbox'.format(self.name)
-            self._logger.debug('Deleting queue: {0}'.format(pid_box_queue))
-            channel.queue_delete(pid_box_queue)
-        finally:
-            try:
-                client.close()
-            except Exception as e:
-                self._logger.warning('Failed closing amqp client: {0}'
-                                     .format(e))
+        """
+        Wait for the daemon worker to report it is ready.
+
+        :return: whether the worker is ready.
+        """
+
+        ready_path = self._ready_path()
+        end_time = time.time() + timeout
+        while True:
+            pid = utils.read_daemon_ready(ready_path)
+            if pid is not None and _process_exists(pid):
+                return True
+            remaining = end_time - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(defaults.READY_POLL_INTERVAL, remaining))
+
+    def _delete_amqp_queues(self):
+        queues = self.amqp_queues()
+        self._logger.debug('Deleting queues: {0}'.format(', '.join(queues)))
+        results = self._broker_connection().delete_queues(queues)
+        for error in results.values():
+            if error is not None:
+                raise error
 
     def _validate_autoscale(self):
         min_workers = self._params.get('min_workers')
@@ -698,7 +802,7 @@ class Daemon(object):
 
     def _validate_host(self):
         queue = self._params.get('queue')
-        host = self._params.get('host')
+        host = self._params.get('host') or self._params.get('host_id')
         if not queue and not host:
             raise exceptions.DaemonPropertiesError(
                 'host must be supplied when queue is omitted'
@@ -734,29 +838,39 @@ class Daemon(object):
             verify_rest_certificate=self.verify_rest_certificate,
             ssl_cert_path=self.local_rest_cert_file
         )
-        node_instances = client.node_instances.list(
-            deployment_id=self.deployment_id)
+        if self.host_id:
+            node_instance = client.node_instances.get(
+                self.host_id, _include=['id', 'runtime_properties'])
+            self._runtime_properties = node_instance.runtime_properties
+            return
 
         def match_ip(node_instance):
             host_id = node_instance.host_id
             if host_id == node_instance.id:
                 # compute node instance
-                return self.host == node_instance.runtime_properties['ip']
+                return self.host == node_instance.runtime_properties.get('ip')
             return False
 
-        matched = filter(match_ip, node_instances)
+        # node instances can not be filtered by their runtime properties on
+        # the manager, so only the fields needed here are listed, a page at
+        # a time
+        matched = filter(match_ip, _iter_node_instances(
+            client,
+            deployment_id=self.deployment_id,
+            _include=['id', 'host_id', 'runtime_properties']))
 
         if len(matched) > 1:
             raise exceptions.DaemonConfigurationError(
                 'Found multiple node instances with ip {0}: {1}'.format(
-                    self.host, ','.join(matched))
+                    self.host, ','.join(node_instance.id
+                                        for node_instance in matched))
             )
 
         if len(matched) == 0:
             raise exceptions.DaemonConfigurationError(
                 'No node instances with ip {0} were found'.format(self.host)
             )
-        self._runtime_properties = matched[0].runtime_propreties
+        self._runtime_properties = matched[0].runtime_properties
 
     def _list_plugin_files(self, plugin_name):
 
@@ -798,6 +912,64 @@ class Daemon(object):
         return True
 
 
+class _PrivilegedStaging(object):
+
+    """
+    Privileged changes that are applied together, by running a single
+    script under sudo, rather than running every command under sudo on
+    its own (each of which costs a sudo session).
+    """
+
+    def __init__(self, runner, logger):
+        self._runner = runner
+        self._logger = logger
+        self._commands = []
+        self._staged = []
+        self._installed = set()
+
+    def install(self, source, path, executable=False):
+
+        """
+        Install a file owned by the current user (e.g. a rendered
+        template) as `path`. The source file is removed once applied.
+        """
+
+        self._staged.append(source)
+        self._installed.add(path)
+        self.run('mkdir -p {0}'.format(pipes.quote(os.path.dirname(path))))
+        self.run('cp {0} {1}'.format(pipes.quote(source), pipes.quote(path)))
+        if executable:
+            self.run('chmod +x {0}'.format(pipes.quote(path)))
+
+    def installs(self, path):
+        return path in self._installed
+
+    def remove(self, path):
+        self._installed.discard(path)
+        self.run('rm -f {0}'.format(pipes.quote(path)))
+
+    def run(self, command):
+        self._commands.append(command)
+
+    def apply(self):
+        if not self._commands:
+            return
+        script = utils.content_to_file('\n'.join(
+            ['#!/bin/sh', 'set -e'] + self._commands))
+        self._staged.append(script)
+        self._logger.debug('Running privileged commands: {0}'.format(
+            '; '.join(self._commands)))
+        self._runner.run('sudo /bin/sh {0}'.format(script))
+        self._commands = []
+        self._installed = set()
+
+    def clean(self):
+        for path in self._staged:
+            if os.path.exists(path):
+                os.remove(path)
+        self._staged = []
+
+
 class CronRespawnDaemon(Daemon):
 
     """
@@ -853,7 +1025,9 @@ class CronRespawnDaemon(Daemon):
             template_path='respawn.sh.template',
             file_path=cron_respawn_path,
             start_command=self.start_command(),
-            status_command=self.status_command()
+            status_command=self.status_command(),
+            pid_file=self.pid_file,
+            name=self.name
         )
         self._runner.run('chmod +x {0}'.format(cron_respawn_path))
         self._logger.debug('Rendering enable cron script from template')
@@ -884,3 +1058,30 @@ class CronRespawnDaemon(Daemon):
         )
         self._runner.run('chmod +x {0}'.format(disable_cron_script))
         return disable_cron_script
+
+
+def _process_exists(pid):
+    if os.name == 'nt':
+        # os.kill terminates processes on windows, whatever the signal
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        # the process may belong to another user
+        return e.errno == errno.EPERM
+    return True
+
+
+def _iter_node_instances(client, page_size=None, **params):
+    page_size = page_size or NODE_INSTANCES_PAGE_SIZE
+    offset = 0
+    while True:
+        node_instances = client.node_instances.list(_offset=offset,
+                                                    _size=page_size,
+                                                    **params)
+        for node_instance in node_instances:
+            yield node_instance
+        offset += len(node_instances.items)
+        if (not node_instances.items or
+                offset >= node_instances.metadata.pagination.total):
+            return
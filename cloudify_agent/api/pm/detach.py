@@ -22,6 +22,7 @@ from cloudify_agent.api import defaults
 from cloudify_agent.api import utils
 from cloudify_agent.api import exceptions
 from cloudify_agent.api.pm.base import CronRespawnDaemon
+from cloudify_agent.api.pm.base import with_broker_connection
 
 
 class DetachedDaemon(CronRespawnDaemon):
@@ -63,6 +64,7 @@ class DetachedDaemon(CronRespawnDaemon):
         self._runner.run(self.create_disable_cron_script())
         super(DetachedDaemon, self).stop(interval, timeout)
 
+    @with_broker_connection
     def delete(self, force=defaults.DAEMON_FORCE_DELETE):
         if self._is_agent_registered():
             if not force:
@@ -95,6 +97,10 @@ class DetachedDaemon(CronRespawnDaemon):
         return 'kill -s 0 {0}'.format(pid)
 
     def status(self):
+        running = utils.probe_process(
+            self.pid_file, '--hostname={0}'.format(self.name))
+        if running is not None:
+            return running
         try:
             if not os.path.exists(self.pid_file):
                 return False
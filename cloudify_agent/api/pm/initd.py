@@ -14,6 +14,8 @@
 #  * limitations under the License.
 
 import os
+import threading
+from distutils.spawn import find_executable
 
 from cloudify.exceptions import CommandExecutionException
 
@@ -22,6 +24,10 @@ from cloudify_agent.api import exceptions
 from cloudify_agent import VIRTUALENV
 from cloudify_agent.api import defaults
 from cloudify_agent.api.pm.base import CronRespawnDaemon
+from cloudify_agent.api.pm.base import with_broker_connection
+
+_distro = None
+_distro_lock = threading.Lock()
 
 
 class GenericLinuxDaemon(CronRespawnDaemon):
@@ -56,38 +62,47 @@ class GenericLinuxDaemon(CronRespawnDaemon):
                                                           self._runner)
 
     def configure(self):
-        super(GenericLinuxDaemon, self).configure()
-        if self.start_on_boot:
-            self._logger.info('Creating start-on-boot entry')
-            self._start_on_boot_handler.create()
-
+        # the rendered files are installed, and the start-on-boot entry
+        # created, by a single privileged command
+        with self._privileged():
+            super(GenericLinuxDaemon, self).configure()
+            if self.start_on_boot:
+                self._logger.info('Creating start-on-boot entry')
+                self._start_on_boot_handler.create(self._staging)
+
+    @with_broker_connection
     def delete(self, force=defaults.DAEMON_FORCE_DELETE):
         if self._is_agent_registered():
             if not force:
                 raise exceptions.DaemonStillRunningException(self.name)
             self.stop()
 
-        if self.start_on_boot:
-            self._logger.info('Deleting start-on-boot entry')
-            self._start_on_boot_handler.delete()
+        with self._privileged() as staging:
+            if self.start_on_boot:
+                self._logger.info('Deleting start-on-boot entry')
+                self._start_on_boot_handler.delete(staging)
 
-        if os.path.exists(self.script_path):
-            self._logger.debug('Deleting {0}'.format(self.script_path))
-            self._runner.run('sudo rm {0}'.format(self.script_path))
-        if os.path.exists(self.config_path):
-            self._logger.debug('Deleting {0}'.format(self.config_path))
-            self._runner.run('sudo rm {0}'.format(self.config_path))
+            if os.path.exists(self.script_path):
+                self._logger.debug('Deleting {0}'.format(self.script_path))
+                staging.remove(self.script_path)
+            if os.path.exists(self.config_path):
+                self._logger.debug('Deleting {0}'.format(self.config_path))
+                staging.remove(self.config_path)
 
     def before_self_stop(self):
         if self.start_on_boot:
             self._logger.info('Deleting start-on-boot entry')
-            self._start_on_boot_handler.delete()
+            with self._privileged() as staging:
+                self._start_on_boot_handler.delete(staging)
 
     def stop_command(self):
         return stop_command(self)
 
     def start_command(self):
-        if not os.path.isfile(self.script_path):
+        # the script may be pending installation, while configuring
+        staged = self._staging is not None and \
+            self._staging.installs(self.script_path)
+        if not staged and not os.path.isfile(self.script_path):
             raise exceptions.DaemonNotConfiguredError(self.name)
         return start_command(self)
 
@@ -95,6 +110,10 @@ class GenericLinuxDaemon(CronRespawnDaemon):
         return status_command(self)
 
     def status(self):
+        running = utils.probe_process(
+            self.pid_file, '--hostname={0}'.format(self.name))
+        if running is not None:
+            return running
         try:
             self._runner.run(self.status_command())
             return True
@@ -109,11 +128,8 @@ class GenericLinuxDaemon(CronRespawnDaemon):
             daemon_name=self.name,
             config_path=self.config_path
         )
-        self._runner.run('sudo mkdir -p {0}'.format(
-            os.path.dirname(self.script_path)))
-        self._runner.run('sudo cp {0} {1}'.format(rendered, self.script_path))
-        self._runner.run('sudo rm {0}'.format(rendered))
-        self._runner.run('sudo chmod +x {0}'.format(self.script_path))
+        with self._privileged() as staging:
+            staging.install(rendered, self.script_path, executable=True)
 
     def create_config(self):
         self._logger.debug('Rendering configuration script "{0}" from template'
@@ -147,10 +163,8 @@ class GenericLinuxDaemon(CronRespawnDaemon):
             enable_cron_script=self.create_enable_cron_script(),
             disable_cron_script=self.create_disable_cron_script()
         )
-        self._runner.run('sudo mkdir -p {0}'.format(
-            os.path.dirname(self.config_path)))
-        self._runner.run('sudo cp {0} {1}'.format(rendered, self.config_path))
-        self._runner.run('sudo rm {0}'.format(rendered))
+        with self._privileged() as staging:
+            staging.install(rendered, self.config_path)
 
 
 def start_command(daemon):
@@ -170,40 +184,41 @@ class _StartOnBootHandler(object):
     def __init__(self, service_name, runner):
         self._name = service_name
         self._runner = runner
-        self._distro = None
 
-    def create(self):
+    def create(self, staging):
         if self.distro == 'debian':
-            commands = ['sudo update-rc.d {0} defaults'.format(self._name)]
+            commands = ['update-rc.d {0} defaults'.format(self._name)]
         elif self.distro == 'rpm':
-            commands = ['sudo /sbin/chkconfig --add {0}'.format(self._name),
-                        'sudo /sbin/chkconfig {0} on'.format(self._name)]
+            commands = ['/sbin/chkconfig --add {0}'.format(self._name),
+                        '/sbin/chkconfig {0} on'.format(self._name)]
         else:
             raise RuntimeError('Illegal state')
         for command in commands:
-            self._runner.run(command)
+            staging.run(command)
 
-    def delete(self):
+    def delete(self, staging):
         if self.distro == 'debian':
-            command = 'sudo update-rc.d -f {0} remove'.format(self._name)
+            command = 'update-rc.d -f {0} remove'.format(self._name)
         elif self.distro == 'rpm':
-            command = 'sudo /sbin/chkconfig {0} off'.format(self._name)
+            command = '/sbin/chkconfig {0} off'.format(self._name)
         else:
             raise RuntimeError('Illegal state')
-        self._runner.run(command)
+        staging.run(command)
 
     @property
     def distro(self):
-        if not self._distro:
-            if self._runner.run('which dpkg',
-                                exit_on_failure=False).return_code == 0:
-                self._distro = 'debian'
-            elif self._runner.run('which rpm',
-                                  exit_on_failure=False).return_code == 0:
-                self._distro = 'rpm'
-            else:
-                raise exceptions.DaemonConfigurationError(
-                    "Cannot create a start-on-boot entry. Unknown "
-                    "distribution base. Supported distributions bases are "
-                    "debian and RPM")
-        return self._distro
+        # the distribution does not change, so it is detected once for all
+        # daemons
+        global _distro
+        with _distro_lock:
+            if _distro is None:
+                if find_executable('dpkg'):
+                    _distro = 'debian'
+                elif find_executable('rpm'):
+                    _distro = 'rpm'
+                else:
+                    raise exceptions.DaemonConfigurationError(
+                        "Cannot create a start-on-boot entry. Unknown "
+                        "distribution base. Supported distributions bases "
+                        "are debian and RPM")
+            return _distro
@@ -22,6 +22,7 @@ from cloudify_agent.api import defaults
 from cloudify_agent.api import exceptions
 from cloudify_agent.api import utils
 from cloudify_agent.api.pm.base import Daemon
+from cloudify_agent.api.pm.base import with_broker_connection
 
 
 class NonSuckingServiceManagerDaemon(Daemon):
@@ -129,6 +130,7 @@ class NonSuckingServiceManagerDaemon(Daemon):
             self._logger.debug('Disabling service: {0}'.format(self.name))
             self._runner.run('sc config {0} start= disabled'.format(self.name))
 
+    @with_broker_connection
     def delete(self, force=defaults.DAEMON_FORCE_DELETE):
         if self._is_agent_registered():
             if not force:
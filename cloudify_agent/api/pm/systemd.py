@@ -0,0 +1,210 @@
+#########
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import os
+
+from cloudify.exceptions import CommandExecutionException
+
+from cloudify_agent import VIRTUALENV
+from cloudify_agent.api import utils
+from cloudify_agent.api import defaults
+from cloudify_agent.api import exceptions
+from cloudify_agent.api.pm.base import Daemon
+from cloudify_agent.api.pm.base import with_broker_connection
+
+
+class SystemDDaemon(Daemon):
+
+    """
+    Implementation for the systemd process management.
+
+    The worker runs in the foreground of a service of Type=notify, and
+    notifies systemd once it is ready (see cloudify_agent.app), so that
+    starting the service returns once the daemon is up. systemd re-spawns
+    the daemon according to its restart policy, and limits its resources.
+
+    Following are all possible custom key-word arguments
+    (in addition to the ones available in the base daemon)
+
+    ``start_on_boot``
+
+        start this daemon when the system boots.
+
+    ``restart``
+
+        the service restart policy (e.g. on-failure, always or no).
+        defaults to on-failure.
+
+    ``restart_sec``
+
+        the amount of seconds to wait before re-spawning the daemon.
+
+    ``cpu_quota``
+
+        the CPU time the daemon may use, relative to a single CPU
+        (e.g. 50%). not limited by default.
+
+    ``memory_max``
+
+        the memory the daemon may use, in bytes or with a K, M or G suffix
+        (e.g. 1G). not limited by default.
+
+    The variables exported by the file given by the ``extra_env_path``
+    argument (see `utils.env_to_file`) are copied to the service
+    configuration file when configuring, as systemd does not run it.
+    """
+
+    SCRIPT_DIR = '/etc/systemd/system'
+    CONFIG_DIR = '/etc/default'
+    SYSTEMCTL = 'systemctl'
+    PROCESS_MANAGEMENT = 'systemd'
+
+    def __init__(self, logger=None, **params):
+        super(SystemDDaemon, self).__init__(logger=logger, **params)
+
+        self.service_name = 'cloudify-worker-{0}'.format(self.name)
+        self.script_path = os.path.join(
+            self.SCRIPT_DIR, '{0}.service'.format(self.service_name))
+        self.config_path = os.path.join(self.CONFIG_DIR, self.service_name)
+
+        # systemd specific configuration
+        self.start_on_boot = str(params.get(
+            'start_on_boot', 'true')).lower() == 'true'
+        self.restart = params.get('restart') or 'on-failure'
+        self.restart_sec = params.get('restart_sec', 5)
+        self.cpu_quota = params.get('cpu_quota')
+        self.memory_max = params.get('memory_max')
+
+    def configure(self):
+        # the unit is installed, and enabled, by a single privileged
+        # command
+        with self._privileged() as staging:
+            super(SystemDDaemon, self).configure()
+            staging.run(self._systemctl('daemon-reload'))
+            if self.start_on_boot:
+                self._logger.info('Creating start-on-boot entry')
+                staging.run(self._systemctl('enable', self.service_name))
+
+    @with_broker_connection
+    def delete(self, force=defaults.DAEMON_FORCE_DELETE):
+        if self._is_agent_registered():
+            if not force:
+                raise exceptions.DaemonStillRunningException(self.name)
+            self.stop()
+
+        with self._privileged() as staging:
+            if os.path.exists(self.script_path):
+                self._logger.debug('Deleting {0}'.format(self.script_path))
+                staging.run('{0} || true'.format(
+                    self._systemctl('disable', self.service_name)))
+                staging.remove(self.script_path)
+                staging.run(self._systemctl('daemon-reload'))
+            if os.path.exists(self.config_path):
+                self._logger.debug('Deleting {0}'.format(self.config_path))
+                staging.remove(self.config_path)
+
+    def start_command(self):
+        # the unit may be pending installation, while configuring
+        staged = self._staging is not None and \
+            self._staging.installs(self.script_path)
+        if not staged and not os.path.isfile(self.script_path):
+            raise exceptions.DaemonNotConfiguredError(self.name)
+        return 'sudo {0}'.format(self._systemctl('start', self.service_name))
+
+    def stop_command(self):
+        return 'sudo {0}'.format(self._systemctl('stop', self.service_name))
+
+    def status_command(self):
+        return self._systemctl('is-active', '--quiet', self.service_name)
+
+    def status(self):
+        running = utils.probe_process(
+            self.pid_file, '--hostname={0}'.format(self.name))
+        if running is not None:
+            return running
+        try:
+            self._runner.run(self.status_command())
+            return True
+        except CommandExecutionException as e:
+            self._logger.debug(str(e))
+            return False
+
+    def create_script(self):
+        self._logger.debug('Rendering systemd unit from template')
+        rendered = utils.render_template_to_file(
+            template_path='pm/systemd/systemd.template',
+            name=self.name,
+            queue=self.queue,
+            user=self.user,
+            workdir=self.workdir,
+            config_path=self.config_path,
+            virtualenv_path=VIRTUALENV,
+            min_workers=self.min_workers,
+            max_workers=self.max_workers,
+            log_level=self.log_level,
+            log_file=self.get_logfile(),
+            pid_file=self.pid_file,
+            restart=self.restart,
+            restart_sec=self.restart_sec,
+            start_timeout=defaults.START_TIMEOUT,
+            stop_timeout=defaults.STOP_TIMEOUT,
+            cpu_quota=self.cpu_quota,
+            memory_max=self.memory_max
+        )
+        with self._privileged() as staging:
+            staging.install(rendered, self.script_path)
+
+    def create_config(self):
+        self._logger.debug('Rendering configuration file "{0}" from template'
+                           .format(self.config_path))
+        rendered = utils.render_template_to_file(
+            template_path='pm/systemd/systemd.conf.template',
+            name=self.name,
+            user=self.user,
+            workdir=self.workdir,
+            rest_host=self.rest_host,
+            rest_port=self.rest_port,
+            rest_protocol=self.rest_protocol,
+            file_server_host=self.file_server_host,
+            file_server_port=self.file_server_port,
+            file_server_protocol=self.file_server_protocol,
+            security_enabled=self.security_enabled,
+            verify_rest_certificate=self.verify_rest_certificate,
+            local_rest_cert_file=self.local_rest_cert_file,
+            storage_dir=utils.internal.get_storage_directory(self.user),
+            virtualenv_path=VIRTUALENV,
+            extra_env=self._read_extra_env()
+        )
+        with self._privileged() as staging:
+            staging.install(rendered, self.config_path)
+
+    def _read_extra_env(self):
+        extra_env = []
+        if self.extra_env_path and os.path.exists(self.extra_env_path):
+            with open(self.extra_env_path) as f:
+                content = f.read()
+            for line in content.splitlines():
+                line = line.strip()
+                # systemd ignores 'export' statements
+                if line.startswith('export '):
+                    line = line[len('export '):].lstrip()
+                if line.startswith('#') or '=' not in line:
+                    continue
+                key, value = line.split('=', 1)
+                extra_env.append((key, value))
+        return extra_env
+
+    def _systemctl(self, *args):
+        return ' '.join((self.SYSTEMCTL,) + args)
@@ -20,8 +20,13 @@ import tempfile
 import os
 import errno
 import getpass
+import stat
+import socket
 import types
+import threading
+import collections
 
+import fasteners
 import pkg_resources
 from jinja2 import Template
 from base64 import urlsafe_b64encode
@@ -50,6 +55,16 @@ class _Internal(object):
     CLOUDIFY_DAEMON_NAME_KEY = 'CLOUDIFY_DAEMON_NAME'
     CLOUDIFY_DAEMON_STORAGE_DIRECTORY_KEY = 'CLOUDIFY_DAEMON_STORAGE_DIRECTORY'
     CLOUDIFY_DAEMON_USER_KEY = 'CLOUDIFY_DAEMON_USER'
+    CLOUDIFY_PLUGINS_CACHE_DIRECTORY_KEY = 'CLOUDIFY_PLUGINS_CACHE_DIRECTORY'
+    CLOUDIFY_WAGON_CACHE_MAX_SIZE_KEY = 'CLOUDIFY_WAGON_CACHE_MAX_SIZE'
+    CLOUDIFY_WHEELHOUSE_MAX_SIZE_KEY = 'CLOUDIFY_WHEELHOUSE_MAX_SIZE'
+    CLOUDIFY_SOURCE_CACHE_MAX_SIZE_KEY = 'CLOUDIFY_SOURCE_CACHE_MAX_SIZE'
+    CLOUDIFY_PLUGINS_DEDUP_KEY = 'CLOUDIFY_PLUGINS_DEDUP'
+    CLOUDIFY_PLUGINS_TRASH_REAP_RATE_KEY = 'CLOUDIFY_PLUGINS_TRASH_REAP_RATE'
+    CLOUDIFY_MANAGED_PLUGINS_CACHE_TTL_KEY = \
+        'CLOUDIFY_MANAGED_PLUGINS_CACHE_TTL'
+    CLOUDIFY_PLUGINS_DISK_QUOTA_KEY = 'CLOUDIFY_PLUGINS_DISK_QUOTA'
+    CLOUDIFY_PLUGINS_INSTRUMENTATION_KEY = 'CLOUDIFY_PLUGINS_INSTRUMENTATION'
 
     @classmethod
     def get_daemon_name(cls):
@@ -96,6 +111,111 @@ class _Internal(object):
             username = cls.get_daemon_user()
         return os.path.join(get_home_dir(username), '.cfy-agent')
 
+    @classmethod
+    def get_plugins_cache_dir(cls):
+
+        """
+        Retrieve path to the directory where downloaded plugin archives
+        are cached. The cache lives under the storage directory so that
+        it is shared by all agents installed for the same user, and
+        survives agent re-installations.
+        """
+
+        if cls.CLOUDIFY_PLUGINS_CACHE_DIRECTORY_KEY in os.environ:
+            return os.environ[cls.CLOUDIFY_PLUGINS_CACHE_DIRECTORY_KEY]
+        return os.path.join(cls.get_storage_directory(), 'cache')
+
+    @classmethod
+    def get_wagon_cache_max_size(cls):
+
+        """
+        Retrieve the size budget (in bytes) of the wagon cache.
+        A value of 0 disables the cache.
+        """
+
+        return int(os.environ.get(cls.CLOUDIFY_WAGON_CACHE_MAX_SIZE_KEY,
+                                  defaults.WAGON_CACHE_MAX_SIZE))
+
+    @classmethod
+    def get_wheelhouse_max_size(cls):
+
+        """
+        Retrieve the size budget (in bytes) of the source plugins
+        wheelhouse. A value of 0 disables the wheelhouse.
+        """
+
+        return int(os.environ.get(cls.CLOUDIFY_WHEELHOUSE_MAX_SIZE_KEY,
+                                  defaults.WHEELHOUSE_MAX_SIZE))
+
+    @classmethod
+    def get_source_cache_max_size(cls):
+
+        """
+        Retrieve the size budget (in bytes) of the source plugin archives
+        cache. A value of 0 disables the cache.
+        """
+
+        return int(os.environ.get(cls.CLOUDIFY_SOURCE_CACHE_MAX_SIZE_KEY,
+                                  defaults.SOURCE_CACHE_MAX_SIZE))
+
+    @classmethod
+    def get_plugins_dedup_mode(cls):
+
+        """
+        Retrieve the deduplication mode of source plugin installations:
+        'off', 'hardlink' or 'reflink' (falling back to hard links where
+        reflinks are not supported).
+        """
+
+        return os.environ.get(cls.CLOUDIFY_PLUGINS_DEDUP_KEY,
+                              defaults.PLUGINS_DEDUP_MODE).strip().lower()
+
+    @classmethod
+    def get_plugins_trash_reap_rate(cls):
+
+        """
+        Retrieve the maximal number of files removed per second when
+        deleting uninstalled plugins in the background. A value of 0
+        removes them as fast as possible.
+        """
+
+        return int(os.environ.get(cls.CLOUDIFY_PLUGINS_TRASH_REAP_RATE_KEY,
+                                  defaults.PLUGINS_TRASH_REAP_RATE))
+
+    @classmethod
+    def get_managed_plugins_cache_ttl(cls):
+
+        """
+        Retrieve the number of seconds managed plugin lookups are cached
+        for. A value of 0 disables the cache.
+        """
+
+        return int(os.environ.get(cls.CLOUDIFY_MANAGED_PLUGINS_CACHE_TTL_KEY,
+                                  defaults.MANAGED_PLUGINS_CACHE_TTL))
+
+    @classmethod
+    def get_plugins_disk_quota(cls):
+
+        """
+        Retrieve the disk quota (in bytes) of plugin installations, beyond
+        which unused plugins are removed. A value of 0 disables the quota.
+        """
+
+        return int(os.environ.get(cls.CLOUDIFY_PLUGINS_DISK_QUOTA_KEY,
+                                  defaults.PLUGINS_DISK_QUOTA))
+
+    @classmethod
+    def get_plugins_instrumentation(cls):
+
+        """
+        Retrieve the plugin installation instrumentation setting: empty
+        (disabled), 'true' for the default events file, or a path to an
+        events file.
+        """
+
+        return os.environ.get(cls.CLOUDIFY_PLUGINS_INSTRUMENTATION_KEY,
+                              '').strip()
+
     @staticmethod
     def generate_agent_name():
 
@@ -224,7 +344,8 @@ def get_celery_client(broker_url,
 
 def get_agent_registered(name,
                          celery_client,
-                         timeout=workflows_tasks.INSPECT_TIMEOUT):
+                         timeout=workflows_tasks.INSPECT_TIMEOUT,
+                         connection=None):
 
     """
     Query for agent registered tasks based on agent name.
@@ -232,6 +353,8 @@ def get_agent_registered(name,
     :param name: the agent name
     :param celery_client: the celery client to use
     :param timeout: timeout for inspect command
+    :param connection: the broker connection to use, a new one is
+                       established if not specified.
 
     :return: agents registered tasks
     :rtype: dict
@@ -241,7 +364,8 @@ def get_agent_registered(name,
     destination = 'celery@{0}'.format(name)
     inspect = celery_client.control.inspect(
         destination=[destination],
-        timeout=timeout)
+        timeout=timeout,
+        connection=connection)
 
     registered = inspect.registered()
     if registered is None or destination not in registered:
@@ -249,6 +373,184 @@ def get_agent_registered(name,
     return set(registered[destination])
 
 
+class BrokerConnection(object):
+
+    """
+    A broker connection shared by a sequence of operations, such as the
+    polling done while a daemon starts or stops, instead of connecting for
+    each of them.
+
+    The connection is established on first use and re-established if it
+    fails. Users hold it with `acquire` and `release` (or as a context
+    manager, which may be nested), and it is closed once the last one
+    releases it.
+    """
+
+    def __init__(self,
+                 broker_url,
+                 broker_ssl_enabled=False,
+                 broker_ssl_cert_path=None):
+        self.broker_url = broker_url
+        self.broker_ssl_enabled = broker_ssl_enabled
+        self.broker_ssl_cert_path = broker_ssl_cert_path
+        self._celery_client = None
+        self._connection = None
+        self._users = 0
+        self._lock = threading.RLock()
+
+    def acquire(self):
+        with self._lock:
+            self._users += 1
+        return self
+
+    def release(self):
+        with self._lock:
+            self._users -= 1
+            if self._users == 0:
+                self._close()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *_):
+        self.release()
+
+    def get_agent_registered(self,
+                             name,
+                             timeout=workflows_tasks.INSPECT_TIMEOUT):
+
+        """
+        Query for agent registered tasks (see `get_agent_registered`).
+        """
+
+        return self._call(lambda connection: get_agent_registered(
+            name, self._celery_client, timeout, connection=connection))
+
+    def delete_queues(self, queues, batch_size=None):
+
+        """
+        Delete queues, whether or not they exist.
+
+        The deletions are pipelined over a single channel: all but the last
+        queue of every batch are deleted without waiting for the broker to
+        confirm them, and waiting for the last one confirms them all, as
+        the broker handles the methods of a channel in order. If the broker
+        fails any of them (which closes the channel), the batch is deleted
+        again one queue at a time, to find out which queues failed.
+
+        :param queues: the names of the queues to delete.
+        :param batch_size: the number of deletions pipelined before waiting
+                           for the broker.
+
+        :return: a dict mapping every queue name to the error deleting it,
+                 or to None if it was deleted.
+        """
+
+        queues = list(collections.OrderedDict.fromkeys(queues))
+        batch_size = batch_size or defaults.QUEUE_DELETE_BATCH_SIZE
+
+        def delete(connection):
+            results = collections.OrderedDict()
+            for i in range(0, len(queues), batch_size):
+                results.update(_delete_queues(
+                    connection, queues[i:i + batch_size]))
+            return results
+        return self._call(delete)
+
+    def _call(self, function):
+        with self._lock:
+            with self:
+                connection = self._connect()
+                try:
+                    return function(connection)
+                except connection.connection_errors:
+                    # e.g. the broker closed an idle connection, retried
+                    # once on a new connection
+                    self._close()
+                    return function(self._connect())
+
+    def _connect(self):
+        if self._connection is None:
+            if self._celery_client is None:
+                self._celery_client = get_celery_client(
+                    broker_url=self.broker_url,
+                    broker_ssl_enabled=self.broker_ssl_enabled,
+                    broker_ssl_cert_path=self.broker_ssl_cert_path)
+            self._connection = self._celery_client.connection()
+        return self._connection
+
+    def _close(self):
+        connection, self._connection = self._connection, None
+        celery_client, self._celery_client = self._celery_client, None
+        try:
+            if connection is not None:
+                connection.release()
+        finally:
+            # also closes the connections celery pooled for publishing
+            if celery_client is not None:
+                celery_client.close()
+
+
+def _delete_queues(connection, queues):
+    channel = connection.channel()
+    try:
+        try:
+            for queue in queues[:-1]:
+                channel.queue_delete(queue, nowait=True)
+            channel.queue_delete(queues[-1])
+            return [(queue, None) for queue in queues]
+        except connection.channel_errors:
+            pass
+    finally:
+        _close_channel(connection, channel)
+    results = []
+    for queue in queues:
+        channel = connection.channel()
+        try:
+            channel.queue_delete(queue)
+            error = None
+        except connection.channel_errors as e:
+            error = e
+        finally:
+            _close_channel(connection, channel)
+        results.append((queue, error))
+    return results
+
+
+def _close_channel(connection, channel):
+    try:
+        channel.close()
+    except connection.channel_errors:
+        # already closed by the broker
+        pass
+
+
+def delete_daemons_queues(daemons):
+
+    """
+    Delete the AMQP queues of several daemons, over a single connection per
+    broker (see `BrokerConnection.delete_queues`).
+
+    :param daemons: the daemons whose queues are deleted.
+    :type daemons: list of cloudify_agent.api.pm.base.Daemon
+
+    :return: a dict mapping every queue name to the error deleting it, or to
+             None if it was deleted.
+    """
+
+    brokers = collections.OrderedDict()
+    for daemon in daemons:
+        key = (daemon.broker_url,
+               daemon.broker_ssl_enabled,
+               daemon.broker_ssl_cert_path)
+        brokers.setdefault(key, []).extend(daemon.amqp_queues())
+    results = collections.OrderedDict()
+    for key, queues in brokers.items():
+        with BrokerConnection(*key) as connection:
+            results.update(connection.delete_queues(queues))
+    return results
+
+
 def get_windows_home_dir(username):
     return 'C:\\Users\\{0}'.format(username)
 
@@ -550,6 +852,235 @@ def safe_create_dir(path):
             raise
 
 
+def get_daemon_ready_path(storage_dir, name):
+
+    """
+    The path of the file a daemon worker creates once it is ready to
+    consume tasks, and removes when shutting down.
+    """
+
+    return os.path.join(storage_dir, '{0}.ready'.format(name))
+
+
+def mark_daemon_ready(path):
+
+    """
+    Atomically create a daemon readiness file, holding the worker pid.
+    """
+
+    safe_create_dir(os.path.dirname(path))
+    write_file_atomically(path, str(os.getpid()))
+
+
+def read_daemon_ready(path):
+
+    """
+    Read a daemon readiness file.
+
+    :return: the pid of the ready worker, or None if it is not ready.
+    """
+
+    try:
+        with open(path) as f:
+            return int(f.read().strip())
+    except (IOError, ValueError):
+        return None
+
+
+def sd_notify(state):
+
+    """
+    Send a state notification (e.g. READY=1) to the service manager, see
+    sd_notify(3). Only processes run by systemd in a service of
+    Type=notify are given a notification socket.
+
+    :param state: newline separated variable assignments.
+
+    :return: whether the notification was sent.
+    """
+
+    address = os.environ.get('NOTIFY_SOCKET')
+    if not address or not hasattr(socket, 'AF_UNIX'):
+        return False
+    if address.startswith('@'):
+        # an abstract namespace socket
+        address = '\0' + address[1:]
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.connect(address)
+        sock.sendall(state)
+    finally:
+        sock.close()
+    return True
+
+
+def probe_process(pid_file, argument, proc='/proc'):
+
+    """
+    Check whether the process whose pid is written in a pid file is
+    running, by inspecting it under /proc rather than running a status
+    command. As the pid may have been reused by another process since the
+    pid file was written, the process command line must include the given
+    argument, and the process must have started before the pid file was
+    written.
+
+    :param pid_file: the pid file path.
+    :param argument: an argument of the process command line (e.g. the
+                     celery worker --hostname=<name> option).
+    :param proc: the proc file system mount point.
+
+    :return: True if the process is running, False if it is not, or None
+             if it cannot be determined (e.g. there is no proc file system,
+             or the pid file is not readable), in which case a status
+             command should be used instead.
+    """
+
+    boot_time = _get_boot_time(proc)
+    if boot_time is None:
+        return None
+    try:
+        with open(pid_file) as f:
+            pid = int(f.read().strip())
+            pid_file_mtime = os.fstat(f.fileno()).st_mtime
+    except ValueError:
+        return None
+    except (IOError, OSError) as e:
+        return False if e.errno == errno.ENOENT else None
+    process_dir = os.path.join(proc, str(pid))
+    try:
+        with open(os.path.join(process_dir, 'cmdline')) as f:
+            arguments = f.read().split('\0')
+        with open(os.path.join(process_dir, 'stat')) as f:
+            # the command name may contain spaces and parentheses
+            fields = f.read().rsplit(')', 1)[1].split()
+        state, start_ticks = fields[0], int(fields[19])
+    except (IOError, OSError) as e:
+        return False if e.errno in (errno.ENOENT, errno.ESRCH) else None
+    except (IndexError, ValueError):
+        return None
+    if state == 'Z' or argument not in arguments:
+        return False
+    start_time = boot_time + float(start_ticks) / _CLOCK_TICKS
+    # the boot time is only accurate to the second
+    return start_time <= pid_file_mtime + 1
+
+
+_CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+_boot_times = {}
+
+
+def _get_boot_time(proc):
+    if proc not in _boot_times:
+        boot_time = None
+        try:
+            with open(os.path.join(proc, 'stat')) as f:
+                for line in f:
+                    if line.startswith('btime '):
+                        boot_time = int(line.split()[1])
+                        break
+        except (IOError, OSError, ValueError):
+            pass
+        _boot_times[proc] = boot_time
+    return _boot_times[proc]
+
+
+def write_file_atomically(path, content):
+
+    """
+    Write a file so that readers, and the file system after a crash, see
+    either its previous content or the new one in full: the content is
+    written to a temporary file, flushed to disk, and renamed over the
+    file.
+
+    Concurrent writers should be serialized (e.g. with a `PathLock`), as
+    the last rename wins.
+
+    :param path: the file path.
+    :param content: the new file content.
+    """
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(
+        prefix='.{0}.'.format(os.path.basename(path)),
+        suffix='.tmp',
+        dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        # temporary files are only readable by their owner
+        os.chmod(tmp_path, stat.S_IMODE(os.stat(path).st_mode)
+                 if os.path.exists(path) else 0o644)
+        if os.name == 'nt' and os.path.exists(path):
+            # rename does not replace existing files on windows
+            os.remove(path)
+        os.rename(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    if os.name == 'posix':
+        # persist the rename itself
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+class PathLock(object):
+
+    """
+    A lock on a file path, exclusive across processes as well as across
+    threads of the same process (`fasteners.InterProcessLock` alone is
+    only exclusive across processes, as fcntl locks are held by the
+    process).
+    """
+
+    _thread_locks = {}
+    _thread_locks_guard = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+        with self._thread_locks_guard:
+            self._thread_lock = self._thread_locks.setdefault(
+                os.path.abspath(path), threading.Lock())
+        self._process_lock = fasteners.InterProcessLock(path)
+
+    def acquire(self, blocking=True):
+
+        """
+        :param blocking: whether to wait for the lock to be released.
+
+        :return: whether the lock was acquired.
+        """
+
+        if not self._thread_lock.acquire(blocking):
+            return False
+        try:
+            acquired = self._process_lock.acquire(blocking=blocking)
+        except BaseException:
+            self._thread_lock.release()
+            raise
+        if not acquired:
+            self._thread_lock.release()
+        return acquired
+
+    def release(self):
+        try:
+            self._process_lock.release()
+        finally:
+            self._thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *_):
+        self.release()
+
+
 def get_rest_client(security_enabled,
                     rest_host,
                     rest_protocol,
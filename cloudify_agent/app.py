@@ -19,6 +19,9 @@ used outside the scope of an @operation.
 """
 import os
 import sys
+import socket
+import time
+import threading
 import traceback
 import logging
 import logging.handlers
@@ -31,6 +34,7 @@ from cloudify.celery import gate_keeper
 from cloudify.celery import logging_server
 
 from cloudify_agent.api import utils
+from cloudify_agent.api.plugins import imports
 
 LOGFILE_SIZE_BYTES = 5 * 1024 * 1024
 LOGFILE_BACKUP_COUNT = 5
@@ -80,6 +84,80 @@ def reset_worker_tasks_state(sender, *args, **kwargs):
             pass
     sender.hub.call_soon(callback=callback)
 
+
+@signals.worker_ready.connect
+def mark_ready(*args, **kwargs):
+    # lets Daemon.start know the worker is up without querying it through
+    # the broker (see cloudify_agent.api.pm.base)
+    if daemon_name:
+        utils.mark_daemon_ready(_ready_path())
+
+
+@signals.worker_shutdown.connect
+def unmark_ready(*args, **kwargs):
+    if daemon_name:
+        try:
+            os.remove(_ready_path())
+        except OSError:
+            pass
+
+
+@signals.worker_ready.connect
+def notify_ready(*args, **kwargs):
+    # systemd considers a daemon of Type=notify started once notified (see
+    # cloudify_agent.api.pm.systemd)
+    try:
+        utils.sd_notify('READY=1\nMAINPID={0}'.format(os.getpid()))
+    except socket.error as e:
+        logging.getLogger(__name__).warning(
+            'Failed notifying systemd the worker is ready: {0}'.format(e))
+
+
+@signals.worker_shutdown.connect
+def notify_stopping(*args, **kwargs):
+    try:
+        utils.sd_notify('STOPPING=1')
+    except socket.error:
+        pass
+
+
+def _ready_path():
+    return utils.get_daemon_ready_path(
+        utils.internal.get_daemon_storage_dir(), daemon_name)
+
+
+@signals.worker_ready.connect
+def collect_plugins_garbage(*args, **kwargs):
+    # delete whatever was left in the trash by a previous run, and unused
+    # plugins beyond the disk quota, without delaying the worker
+    thread = threading.Thread(target=_collect_plugins_garbage,
+                              name='plugins-garbage-collector')
+    thread.daemon = True
+    thread.start()
+
+
+def _collect_plugins_garbage():
+    # imported here, as every operation subprocess imports this module
+    from cloudify_agent.api.plugins import installer
+    from cloudify_agent.api.plugins import trash
+    logger = logging.getLogger('cloudify_agent.plugins')
+    trash.reap_in_background(logger=logger)
+    # plugins used since are kept, as deployments created since may use them
+    listed_at = time.time()
+    try:
+        deployment_ids = installer.get_deployment_ids()
+    except Exception as e:
+        logger.warning('Failed listing deployments, plugins referenced by '
+                       'deleted deployments will not be removed: {0}'
+                       .format(e))
+        deployment_ids = None
+    try:
+        installer.PluginInstaller(logger=logger).collect_garbage(
+            deployment_ids=deployment_ids,
+            deployments_listed_at=listed_at)
+    except Exception as e:
+        logger.warning('Plugins garbage collection failed: {0}'.format(e))
+
 # This attribute is used as the celery App instance.
 # it is referenced in two ways:
 #   1. Celery command line --app options.
@@ -89,6 +167,10 @@ app = Celery()
 gate_keeper.configure_app(app)
 logging_server.configure_app(app)
 
+# resolve imports of plugin modules (including by operations dispatched
+# to a subprocess, which imports this module too) through the plugins index
+imports.install_finder()
+
 try:
     # running inside an agent
     daemon_name = utils.internal.get_daemon_name()
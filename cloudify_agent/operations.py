@@ -21,11 +21,13 @@ import sys
 import os
 import copy
 from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
 import celery
 
 import cloudify.manager
 from cloudify import ctx
+from cloudify.state import current_ctx
 from cloudify.exceptions import NonRecoverableError
 
 from cloudify.utils import ManagerVersion
@@ -42,18 +44,57 @@ from cloudify_agent.installer.config import configuration
 
 
 @operation
-def install_plugins(plugins, **_):
+def install_plugins(plugins, concurrency=None, **_):
+    concurrency = int(concurrency or defaults.PLUGINS_INSTALL_CONCURRENCY)
     installer = PluginInstaller(logger=ctx.logger)
-    for plugin in plugins:
-        ctx.logger.info('Installing plugin: {0}'.format(plugin['name']))
+    deployment_id = ctx.deployment.id
+    blueprint_id = ctx.blueprint.id
+    current = current_ctx.get_ctx()
+    parameters = current_ctx.get_parameters()
+
+    def install(plugin):
+        # the operation context is thread local
+        with current_ctx.push(current, parameters):
+            ctx.logger.info('Installing plugin: {0}'.format(plugin['name']))
+            try:
+                installer.install(plugin=plugin,
+                                  deployment_id=deployment_id,
+                                  blueprint_id=blueprint_id)
+            except Exception:
+                return sys.exc_info()
+
+    if concurrency > 1 and len(plugins) > 1:
+        pool = ThreadPool(min(concurrency, len(plugins)))
         try:
-            installer.install(plugin=plugin,
-                              deployment_id=ctx.deployment.id,
-                              blueprint_id=ctx.blueprint.id)
-        except exceptions.PluginInstallationError as e:
+            results = pool.map(install, plugins)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [install(plugin) for plugin in plugins]
+
+    failures = [(plugin, exc_info)
+                for plugin, exc_info in zip(plugins, results) if exc_info]
+    if len(failures) == 1:
+        tpe, value, tb = failures[0][1]
+        if isinstance(value, exceptions.PluginInstallationError):
             # preserve traceback
-            tpe, value, tb = sys.exc_info()
-            raise NonRecoverableError, NonRecoverableError(str(e)), tb
+            raise NonRecoverableError, NonRecoverableError(str(value)), tb
+        raise tpe, value, tb
+    elif failures:
+        # the raised error only holds the messages
+        for plugin, exc_info in failures:
+            ctx.logger.error('Failed installing plugin: {0}'
+                             .format(plugin['name']), exc_info=exc_info)
+        raise NonRecoverableError('Failed installing {0} plugins: {1}'.format(
+            len(failures), '; '.join('{0}: {1}'.format(plugin['name'], value)
+                                     for plugin, (_, value, _) in failures)))
+
+
+@operation
+def prefetch_plugins(plugins, concurrency=None, **_):
+    installer = PluginInstaller(logger=ctx.logger)
+    return installer.prefetch(plugins, concurrency=concurrency)
 
 
 @operation
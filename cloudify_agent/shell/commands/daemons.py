@@ -16,6 +16,9 @@
 import click
 import json
 import os
+import time
+import threading
+from multiprocessing.pool import ThreadPool
 
 from cloudify_agent.api import defaults
 from cloudify_agent.api import utils as api_utils
@@ -29,7 +32,7 @@ from cloudify_agent.shell.decorators import handle_failures
               help='The process management system to use '
                    'when creating the daemon. [env {0}]'
               .format(env.CLOUDIFY_DAEMON_PROCESS_MANAGEMENT),
-              type=click.Choice(['init.d', 'nssm', 'detach']),
+              type=click.Choice(['init.d', 'nssm', 'detach', 'systemd']),
               required=True,
               envvar=env.CLOUDIFY_DAEMON_PROCESS_MANAGEMENT)
 @click.option('--file-server-host',
@@ -242,6 +245,28 @@ def create(**params):
                .format(daemon.name))
 
 
+def _bulk_options(func):
+
+    """
+    Options selecting several daemons for a lifecycle command, instead of
+    the one selected by --name.
+    """
+
+    func = click.option('--concurrency',
+                        help='The maximal number of daemons handled '
+                             'concurrently, when several are selected.',
+                        type=int,
+                        default=defaults.DAEMONS_CONCURRENCY)(func)
+    func = click.option('--all', 'all_daemons',
+                        help='Handle all existing daemons.',
+                        is_flag=True,
+                        default=False)(func)
+    func = click.option('--names',
+                        help='Comma separated names of the daemons to '
+                             'handle.')(func)
+    return func
+
+
 @click.command()
 @click.option('--name',
               help='The name of the daemon. [env {0}]'
@@ -273,7 +298,6 @@ def configure(name, user=None):
 @click.option('--name',
               help='The name of the daemon. [env {0}]'
               .format(env.CLOUDIFY_DAEMON_NAME),
-              required=True,
               envvar=env.CLOUDIFY_DAEMON_NAME)
 @click.option('--user',
               help='The user to load the configuration from. Defaults to '
@@ -293,21 +317,29 @@ def configure(name, user=None):
                    'queue that this daemon is listening to before the agent.',
               is_flag=True,
               default=not defaults.DELETE_AMQP_QUEUE_BEFORE_START)
+@_bulk_options
 @handle_failures
-def start(name, interval, timeout, no_delete_amqp_queue, user=None):
+def start(name, interval, timeout, no_delete_amqp_queue, names, all_daemons,
+          concurrency, user=None):
 
     """
     Starts the daemon.
 
     """
 
+    def start_daemon(daemon):
+        daemon.start(
+            interval=interval,
+            timeout=timeout,
+            delete_amqp_queue=not no_delete_amqp_queue
+        )
+
+    daemons = _load_daemons(name, names, all_daemons, user=user)
+    if daemons is not None:
+        _run_bulk('Starting', daemons, start_daemon, concurrency)
+        return
     click.echo('Starting...')
-    daemon = _load_daemon(name, user=user)
-    daemon.start(
-        interval=interval,
-        timeout=timeout,
-        delete_amqp_queue=not no_delete_amqp_queue
-    )
+    start_daemon(_load_daemon(name, user=user))
     click.echo('Successfully started daemon: {0}'.format(name))
 
 
@@ -315,7 +347,6 @@ def start(name, interval, timeout, no_delete_amqp_queue, user=None):
 @click.option('--name',
               help='The name of the daemon. [env {0}]'
               .format(env.CLOUDIFY_DAEMON_NAME),
-              required=True,
               envvar=env.CLOUDIFY_DAEMON_NAME)
 @click.option('--interval',
               help='The interval in seconds to sleep when waiting '
@@ -325,20 +356,27 @@ def start(name, interval, timeout, no_delete_amqp_queue, user=None):
               help='The timeout in seconds to wait '
                    'for the daemon to stop.',
               default=defaults.STOP_TIMEOUT)
+@_bulk_options
 @handle_failures
-def stop(name, interval, timeout):
+def stop(name, interval, timeout, names, all_daemons, concurrency):
 
     """
     Stops the daemon.
 
     """
 
+    def stop_daemon(daemon):
+        daemon.stop(
+            interval=interval,
+            timeout=timeout
+        )
+
+    daemons = _load_daemons(name, names, all_daemons)
+    if daemons is not None:
+        _run_bulk('Stopping', daemons, stop_daemon, concurrency)
+        return
     click.echo('Stopping...')
-    daemon = _load_daemon(name)
-    daemon.stop(
-        interval=interval,
-        timeout=timeout
-    )
+    stop_daemon(_load_daemon(name))
     click.secho('Successfully stopped daemon: {0}'.format(name))
 
 
@@ -346,19 +384,22 @@ def stop(name, interval, timeout):
 @click.option('--name',
               help='The name of the daemon. [env {0}]'
               .format(env.CLOUDIFY_DAEMON_NAME),
-              required=True,
               envvar=env.CLOUDIFY_DAEMON_NAME)
+@_bulk_options
 @handle_failures
-def restart(name):
+def restart(name, names, all_daemons, concurrency):
 
     """
     Restarts the daemon.
 
     """
 
+    daemons = _load_daemons(name, names, all_daemons)
+    if daemons is not None:
+        _run_bulk('Restarting', daemons, _restart_daemon, concurrency)
+        return
     click.echo('Restarting...')
-    daemon = _load_daemon(name)
-    daemon.restart()
+    _restart_daemon(_load_daemon(name))
     click.echo('Successfully restarted daemon: {0}'.format(name))
 
 
@@ -366,20 +407,36 @@ def restart(name):
 @click.option('--name',
               help='The name of the daemon. [env {0}]'
               .format(env.CLOUDIFY_DAEMON_NAME),
-              required=True,
               envvar=env.CLOUDIFY_DAEMON_NAME)
+@_bulk_options
 @handle_failures
-def delete(name):
+def delete(name, names, all_daemons, concurrency):
 
     """
     Deletes the daemon.
 
     """
 
+    daemons = _load_daemons(name, names, all_daemons)
+    if daemons is not None:
+        deleted = []
+
+        def delete_daemon(daemon):
+            # the queues of all daemons are deleted together afterwards
+            daemon.defer_amqp_queues_deletion()
+            _delete_daemon(daemon)
+            deleted.append(daemon)
+
+        try:
+            _run_bulk('Deleting', daemons, delete_daemon, concurrency)
+        finally:
+            failed = _delete_queues(deleted)
+        if failed:
+            raise click.ClickException('Failed deleting {0} AMQP queues'
+                                       .format(failed))
+        return
     click.echo('Deleting...')
-    daemon = _load_daemon(name)
-    daemon.delete()
-    DaemonFactory().delete(name)
+    _delete_daemon(_load_daemon(name))
     click.echo('Successfully deleted daemon: {0}'.format(name))
 
 
@@ -410,10 +467,8 @@ def ls():
 
     """
 
-    from cloudify_agent.shell.main import get_logger
-    daemons = DaemonFactory().load_all(logger=get_logger())
-    for daemon in daemons:
-        click.echo(daemon.name)
+    for name in DaemonFactory().names():
+        click.echo(name)
 
 
 @click.command()
@@ -427,6 +482,140 @@ def status(name):
     _load_daemon(name).status()
 
 
+def _restart_daemon(daemon):
+    daemon.restart()
+
+
+def _delete_daemon(daemon):
+    daemon.delete()
+    DaemonFactory().delete(daemon.name)
+
+
+def _load_daemons(name, names, all_daemons, user=None):
+
+    """
+    Load the daemons selected by the --names or --all options.
+
+    :return: a list of daemons, or None if a single daemon was selected by
+             the --name option.
+    """
+
+    from cloudify_agent.shell.main import get_logger
+    if all_daemons:
+        return DaemonFactory(username=user).load_all(logger=get_logger(),
+                                                     lazy=True)
+    if names:
+        return [_load_daemon(daemon_name.strip(), user=user)
+                for daemon_name in names.split(',') if daemon_name.strip()]
+    if not name:
+        raise click.UsageError('--name, --names or --all should be '
+                               'specified.')
+    return None
+
+
+def _run_bulk(action, daemons, operation, concurrency):
+
+    """
+    Run a lifecycle operation on several daemons concurrently, and echo a
+    summary of the results.
+
+    :param action: the operation description (e.g. 'Starting').
+    :param operation: a function running the operation on a daemon.
+    :param concurrency: the maximal number of concurrent operations.
+    """
+
+    if not daemons:
+        click.echo('No daemons found')
+        return
+    click.echo('{0} {1} daemons...'.format(action, len(daemons)))
+    connections = _BrokerConnections()
+
+    def run(daemon):
+        operation_start = time.time()
+        try:
+            daemon.set_broker_connection(connections.get(daemon))
+            operation(daemon)
+            error = None
+        except Exception as e:
+            error = e
+        return daemon.name, error, time.time() - operation_start
+
+    bulk_start = time.time()
+    pool = ThreadPool(max(min(concurrency, len(daemons)), 1))
+    try:
+        results = pool.map(run, daemons)
+    finally:
+        pool.close()
+        pool.join()
+        connections.close()
+    failed = 0
+    for daemon_name, error, duration in results:
+        if error:
+            failed += 1
+            click.echo('{0}: failed after {1:.1f} seconds: {2}'
+                       .format(daemon_name, duration, error))
+        else:
+            click.echo('{0}: succeeded in {1:.1f} seconds'
+                       .format(daemon_name, duration))
+    click.echo('Total: {0} daemons, {1} failed, {2:.1f} seconds'
+               .format(len(daemons), failed, time.time() - bulk_start))
+    if failed:
+        raise click.ClickException('{0} failed for {1} of {2} daemons'
+                                   .format(action, failed, len(daemons)))
+
+
+def _delete_queues(daemons):
+
+    """
+    Delete the AMQP queues of daemons, and echo the result for every queue.
+
+    :return: the number of queues that failed to be deleted.
+    """
+
+    if not daemons:
+        return 0
+    click.echo('Deleting AMQP queues...')
+    results = api_utils.delete_daemons_queues(daemons)
+    failed = 0
+    for queue, error in results.items():
+        if error:
+            failed += 1
+            click.echo('{0}: failed: {1}'.format(queue, error))
+        else:
+            click.echo('{0}: deleted'.format(queue))
+    return failed
+
+
+class _BrokerConnections(object):
+
+    """
+    The broker connections used by a bulk operation. Every thread reuses a
+    connection per broker for all the daemons it handles, as connections
+    may not be used concurrently.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def get(self, daemon):
+        key = (daemon.broker_url,
+               daemon.broker_ssl_enabled,
+               daemon.broker_ssl_cert_path)
+        connections = self._local.__dict__.setdefault('connections', {})
+        if key not in connections:
+            connection = api_utils.BrokerConnection(*key).acquire()
+            connections[key] = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connections[key]
+
+    def close(self):
+        for connection in self._connections:
+            connection.release()
+
+
 def _load_daemon(name, user=None):
     from cloudify_agent.shell.main import get_logger
     return DaemonFactory(username=user).load(name, logger=get_logger())
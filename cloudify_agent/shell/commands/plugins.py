@@ -0,0 +1,175 @@
+#########
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import json
+import time
+
+import click
+
+from cloudify_agent.api.plugins import cache
+from cloudify_agent.api.plugins import index
+from cloudify_agent.api.plugins import installer
+from cloudify_agent.api.plugins import trash
+from cloudify_agent.shell.decorators import handle_failures
+
+
+@click.command('list')
+@handle_failures
+def plugins_list():
+
+    """
+    List the plugins installed in the agent virtualenv.
+
+    """
+
+    entries = index.PluginIndex().list()
+    total = 0
+    for entry in entries:
+        total += entry['size'] or 0
+        identity = entry['plugin_id'] or entry['name'] or 'unknown'
+        click.echo('{0} [{1}: {2}, deployments: {3}, size: {4} bytes, '
+                   'installed: {5}, last used: {6}]'
+                   .format(entry['dir'],
+                           entry['kind'],
+                           identity,
+                           ', '.join(entry['deployments']) or 'none',
+                           entry['size'],
+                           _format_time(entry['installed_at']),
+                           _format_time(entry['last_used'])))
+    click.echo('Total: {0} plugins, {1} bytes'.format(len(entries), total))
+
+
+@click.command('gc')
+@click.option('--quota',
+              help='The size (in bytes) to shrink the plugins to, by '
+                   'removing least recently used unreferenced plugins. '
+                   'Defaults to the configured plugins disk quota.',
+              type=int)
+@click.option('--all',
+              'collect_all',
+              help='Remove all of the unreferenced plugins.',
+              is_flag=True,
+              default=False)
+@click.option('--ignore-deleted-deployments',
+              help='Consider plugins referenced only by deployments that '
+                   'no longer exist on the manager as unreferenced.',
+              is_flag=True,
+              default=False)
+@handle_failures
+def gc(quota, collect_all, ignore_deleted_deployments):
+
+    """
+    Remove unused plugins from the agent virtualenv.
+
+    """
+
+    if collect_all:
+        quota = 0
+    deployment_ids = None
+    listed_at = None
+    if ignore_deleted_deployments:
+        listed_at = time.time()
+        deployment_ids = installer.get_deployment_ids()
+    reclaimed = installer.PluginInstaller().collect_garbage(
+        quota=quota,
+        deployment_ids=deployment_ids,
+        deployments_listed_at=listed_at)
+    # the command is about to exit, so delete in the foreground
+    trash.Trash().empty()
+    click.echo('Reclaimed {0} bytes'.format(reclaimed))
+
+
+@click.command('prefetch')
+@click.option('--plugins-file',
+              help='Path to a JSON list of plugins to prefetch, as defined '
+                   'in blueprints.',
+              type=click.File())
+@click.option('--concurrency',
+              help='The number of concurrent downloads.',
+              type=int)
+@handle_failures
+def prefetch(plugins_file, concurrency):
+
+    """
+    Download plugins into the local caches ahead of their installation.
+
+    """
+
+    if plugins_file is None:
+        raise click.ClickException('--plugins-file should be specified.')
+    plugins = json.load(plugins_file)
+    results = installer.PluginInstaller().prefetch(plugins,
+                                                   concurrency=concurrency)
+    failures = [result for result in results if result['error']]
+    for result in results:
+        click.echo('{0} [{1}]: {2}'.format(
+            result['name'],
+            'managed' if result['managed'] else 'source',
+            result['error'] or result['path']))
+    if failures:
+        raise click.ClickException('Failed prefetching {0} of {1} plugins'
+                                   .format(len(failures), len(results)))
+
+
+@click.command('list')
+@handle_failures
+def wheelhouse_list():
+
+    """
+    List the source plugins wheelhouse entries, least recently used first.
+
+    """
+
+    wheelhouse = cache.Wheelhouse()
+    total = 0
+    for entry in wheelhouse.list():
+        total += entry['size']
+        click.echo('{0} {1} [size: {2} bytes, last used: {3}, source: {4}]'
+                   .format(entry['key'],
+                           entry.get('package_name', 'unknown'),
+                           entry['size'],
+                           _format_time(entry['last_used']),
+                           entry.get('source', 'unknown')))
+    click.echo('Total: {0} bytes of {1} bytes'
+               .format(total, wheelhouse.max_size))
+
+
+@click.command('prune')
+@click.option('--max-size',
+              help='The size (in bytes) to shrink the wheelhouse to, by '
+                   'removing least recently used entries. Defaults to the '
+                   'wheelhouse size budget.',
+              type=int)
+@click.option('--all',
+              'prune_all',
+              help='Remove all of the wheelhouse entries.',
+              is_flag=True,
+              default=False)
+@handle_failures
+def wheelhouse_prune(max_size, prune_all):
+
+    """
+    Remove least recently used entries from the source plugins wheelhouse.
+
+    """
+
+    if prune_all:
+        max_size = 0
+    reclaimed = cache.Wheelhouse().evict(max_size=max_size)
+    click.echo('Reclaimed {0} bytes'.format(reclaimed))
+
+
+def _format_time(timestamp):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
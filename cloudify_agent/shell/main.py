@@ -26,6 +26,7 @@ from cloudify_agent.api.utils import logger as api_utils_logger
 from cloudify_agent.shell.commands import daemons
 from cloudify_agent.shell.commands import configure
 from cloudify_agent.shell.commands import installer
+from cloudify_agent.shell.commands import plugins
 
 
 _logger = setup_logger('cloudify_agent.shell.main',
@@ -62,6 +63,11 @@ def plugins_sub_command():
     pass
 
 
+@click.group('wheelhouse')
+def wheelhouse_sub_command():
+    pass
+
+
 main.add_command(configure.configure)
 
 daemon_sub_command.add_command(daemons.create)
@@ -74,6 +80,14 @@ daemon_sub_command.add_command(daemons.inspect)
 daemon_sub_command.add_command(daemons.ls)
 daemon_sub_command.add_command(daemons.status)
 
+wheelhouse_sub_command.add_command(plugins.wheelhouse_list)
+wheelhouse_sub_command.add_command(plugins.wheelhouse_prune)
+
+plugins_sub_command.add_command(plugins.plugins_list)
+plugins_sub_command.add_command(plugins.prefetch)
+plugins_sub_command.add_command(plugins.gc)
+plugins_sub_command.add_command(wheelhouse_sub_command)
+
 main.add_command(daemon_sub_command)
 main.add_command(plugins_sub_command)
 
@@ -0,0 +1,283 @@
+#########
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import os
+import time
+import hashlib
+import multiprocessing
+
+from cloudify_agent.api.plugins import cache
+from cloudify_agent.tests import BaseTest
+from cloudify_agent.tests import utils as test_utils
+from cloudify_agent.tests.api.pm import only_os
+
+
+def _downloader(content, counter=None):
+    def download(output_file):
+        assert not os.path.exists(output_file)
+        if counter is not None:
+            counter.append(output_file)
+        with open(output_file, 'w') as f:
+            f.write(content)
+    return download
+
+
+def _concurrent_fetch(root, content):
+    cache.WagonCache(root=root, max_size=1024).fetch(
+        'plugin-id', _downloader(content))
+
+
+class WagonCacheTest(BaseTest):
+
+    def setUp(self):
+        super(WagonCacheTest, self).setUp()
+        self.root = os.path.join(self.temp_folder, 'wagons')
+        self.cache = cache.WagonCache(root=self.root,
+                                      max_size=1024,
+                                      logger=self.logger)
+
+    def test_fetch_miss_then_hit(self):
+        downloads = []
+        path, cache_hit = self.cache.fetch('1', _downloader('wagon',
+                                                            downloads))
+        self.assertFalse(cache_hit)
+        self.assertEqual((path, True), self.cache.fetch(
+            '1', _downloader('wagon', downloads)))
+        self.assertEqual(1, len(downloads))
+        self.assertEqual(1, self.cache.hits)
+        self.assertEqual(1, self.cache.misses)
+        with open(path) as f:
+            self.assertEqual('wagon', f.read())
+
+    def test_fetch_output_file(self):
+        output_file = os.path.join(self.temp_folder, 'wagon.tar.gz')
+        self.assertEqual((output_file, False), self.cache.fetch(
+            '1', _downloader('wagon'), output_file=output_file))
+        os.remove(output_file)
+        self.assertEqual((output_file, True), self.cache.fetch(
+            '1', _downloader('other'), output_file=output_file))
+        # the private copy outlives the cache entry
+        self.cache.clear()
+        with open(output_file) as f:
+            self.assertEqual('wagon', f.read())
+
+    def test_content_addressed(self):
+        path, _ = self.cache.fetch('1', _downloader('wagon'))
+        self.assertEqual(hashlib.sha256('wagon').hexdigest(),
+                         os.path.basename(path))
+        self.assertEqual(path, self.cache.fetch('2', _downloader('wagon'))[0])
+        self.assertEqual(1, self.cache.stats()['entries'])
+
+    def test_lru_eviction(self):
+        first, _ = self.cache.fetch('1', _downloader('a' * 400))
+        second, _ = self.cache.fetch('2', _downloader('b' * 400))
+        # make sure the first entry is the most recently used
+        past = time.time() - 10
+        os.utime(second, (past, past))
+        self.cache.get('1')
+        third, _ = self.cache.fetch('3', _downloader('c' * 400))
+        self.assertTrue(os.path.exists(first))
+        self.assertFalse(os.path.exists(second))
+        self.assertTrue(os.path.exists(third))
+        self.assertIsNone(self.cache.get('2'))
+        self.assertEqual(800, self.cache.size())
+
+    def test_corrupted_entry_is_a_miss(self):
+        path, _ = self.cache.fetch('1', _downloader('wagon'))
+        with open(path, 'a') as f:
+            f.write('garbage')
+        self.assertIsNone(self.cache.get('1'))
+
+    def test_failed_download_not_cached(self):
+        def download(output_file):
+            raise RuntimeError('download failed')
+        self.assertRaises(RuntimeError, self.cache.fetch, '1', download)
+        self.assertIsNone(self.cache.get('1'))
+        self.assertEqual([], os.listdir(self.cache.tmp_dir))
+
+    def test_clear(self):
+        self.cache.fetch('1', _downloader('wagon'))
+        self.assertEqual(len('wagon'), self.cache.clear())
+        self.assertEqual(0, self.cache.stats()['entries'])
+
+    def test_disabled(self):
+        self.assertFalse(cache.WagonCache(root=self.root,
+                                          max_size=0).enabled)
+
+    # No forking on windows.
+    @only_os('posix')
+    def test_concurrent_fetch(self):
+        processes = [multiprocessing.Process(target=_concurrent_fetch,
+                                             args=(self.root, 'wagon'))
+                     for _ in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join(timeout=30)
+            self.assertEqual(0, process.exitcode)
+        self.assertEqual(1, self.cache.stats()['entries'])
+        self.assertIsNotNone(self.cache.get('plugin-id'))
+
+
+class SourceCacheTest(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = test_utils.HTTPServerStandIn()
+        cls.server.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        super(SourceCacheTest, self).setUp()
+        self.server.requests = []
+        self.server.files['/plugin.tar.gz'] = b'archive'
+        self.url = self.server.url('plugin.tar.gz')
+        self.cache = cache.SourceCache(
+            root=os.path.join(self.temp_folder, 'sources'),
+            max_size=1024,
+            logger=self.logger)
+
+    def test_fetch_miss_then_hit(self):
+        path, cache_hit = self.cache.fetch(self.url)
+        self.assertFalse(cache_hit)
+        self.assertEqual((path, True), self.cache.fetch(self.url))
+        self.assertEqual(1, len(self.server.requests))
+        self.assertEqual(1, self.cache.hits)
+        self.assertEqual(1, self.cache.misses)
+        with open(path, 'rb') as f:
+            self.assertEqual(b'archive', f.read())
+
+    def test_stale_entry_revalidated(self):
+        self.cache.ttl = 0
+        path, _ = self.cache.fetch(self.url)
+        self.assertEqual((path, True), self.cache.fetch(self.url))
+        self.assertEqual(2, len(self.server.requests))
+        self.assertIn('if-none-match', self.server.requests[-1][1])
+        self.assertEqual(1, self.cache.hits)
+        # modified on the server
+        self.server.files['/plugin.tar.gz'] = b'modified'
+        path, cache_hit = self.cache.fetch(self.url)
+        self.assertFalse(cache_hit)
+        with open(path, 'rb') as f:
+            self.assertEqual(b'modified', f.read())
+        self.assertEqual(2, self.cache.misses)
+
+    def test_pinned_digest_never_stale(self):
+        self.cache.ttl = 0
+        url = '{0}#sha256={1}'.format(
+            self.url, hashlib.sha256(b'archive').hexdigest())
+        path, _ = self.cache.fetch(url)
+        self.assertEqual((path, True), self.cache.fetch(url))
+        self.assertEqual(1, len(self.server.requests))
+
+    def test_failed_download_not_cached(self):
+        self.assertRaises(Exception, self.cache.fetch,
+                          self.server.url('missing.tar.gz'))
+        self.assertEqual(0, self.cache.stats()['entries'])
+        self.assertEqual([], os.listdir(self.cache.tmp_dir))
+
+    def test_cacheable(self):
+        self.assertTrue(self.cache.cacheable(self.url))
+        self.assertTrue(self.cache.cacheable('https://host/plugin.zip'))
+        self.assertFalse(self.cache.cacheable('file:///tmp/plugin.zip'))
+        self.assertFalse(self.cache.cacheable('plugin'))
+
+
+class WheelhouseTest(BaseTest):
+
+    def setUp(self):
+        super(WheelhouseTest, self).setUp()
+        self.root = os.path.join(self.temp_folder, 'wheelhouse')
+        self.wheelhouse = cache.Wheelhouse(root=self.root,
+                                           max_size=1024,
+                                           logger=self.logger)
+
+    def _build(self, size=100, builds=None):
+        def build(wheels_dir):
+            if builds is not None:
+                builds.append(wheels_dir)
+            with open(os.path.join(wheels_dir, 'plugin-1.0-py2-none-any.whl'),
+                      'w') as f:
+                f.write('w' * size)
+        return build
+
+    def test_key(self):
+        key = cache.Wheelhouse.key('http://host/plugin.tar.gz', 'digest')
+        self.assertEqual(key, cache.Wheelhouse.key(
+            'http://host/plugin.tar.gz', 'digest', ''))
+        self.assertNotEqual(key, cache.Wheelhouse.key(
+            'http://host/plugin.tar.gz', 'other-digest'))
+        self.assertNotEqual(key, cache.Wheelhouse.key(
+            'http://other/plugin.tar.gz', 'digest'))
+        self.assertNotEqual(key, cache.Wheelhouse.key(
+            'http://host/plugin.tar.gz', 'digest', '-r requirements.txt'))
+        # local copies of blueprint resources are keyed by file name
+        self.assertEqual(
+            cache.Wheelhouse.key('file:///tmp/a/plugin.zip', 'digest'),
+            cache.Wheelhouse.key('file:///tmp/b/plugin.zip', 'digest'))
+
+    def test_build_once(self):
+        builds = []
+        path = self.wheelhouse.build('key', self._build(builds=builds),
+                                     metadata={'package_name': 'plugin'})
+        self.assertEqual(path, self.wheelhouse.build(
+            'key', self._build(builds=builds)))
+        self.assertEqual(1, len(builds))
+        self.assertEqual(path, self.wheelhouse.get('key'))
+        self.assertEqual(1, self.wheelhouse.hits)
+        self.assertTrue(os.path.isfile(
+            os.path.join(path, 'plugin-1.0-py2-none-any.whl')))
+
+    def test_build_over_incomplete_entry(self):
+        # e.g. left by a crash, without metadata
+        leftover = os.path.join(self.root, 'key')
+        os.makedirs(os.path.join(leftover, 'partial'))
+        self.assertIsNone(self.wheelhouse.get('key'))
+        path = self.wheelhouse.build('key', self._build())
+        self.assertEqual(leftover, path)
+        self.assertEqual(path, self.wheelhouse.get('key'))
+        self.assertEqual(
+            sorted(['plugin-1.0-py2-none-any.whl',
+                    cache.Wheelhouse.METADATA_FILE]),
+            sorted(os.listdir(path)))
+
+    def test_failed_build_not_cached(self):
+        def build(wheels_dir):
+            raise RuntimeError('build failed')
+        self.assertRaises(RuntimeError, self.wheelhouse.build, 'key', build)
+        self.assertIsNone(self.wheelhouse.get('key'))
+        self.assertEqual([], os.listdir(self.wheelhouse.tmp_dir))
+
+    def test_list(self):
+        self.wheelhouse.build('key', self._build(),
+                              metadata={'package_name': 'plugin',
+                                        'source': 'http://host/p.tar.gz'})
+        entries = self.wheelhouse.list()
+        self.assertEqual(1, len(entries))
+        entry = entries[0]
+        self.assertEqual('key', entry['key'])
+        self.assertEqual('plugin', entry['package_name'])
+        self.assertEqual('http://host/p.tar.gz', entry['source'])
+        self.assertEqual(['plugin-1.0-py2-none-any.whl'], entry['wheels'])
+        self.assertGreater(entry['size'], 100)
+
+    def test_eviction(self):
+        first = self.wheelhouse.build('first', self._build(size=600))
+        second = self.wheelhouse.build('second', self._build(size=600))
+        self.assertFalse(os.path.exists(first))
+        self.assertTrue(os.path.exists(second))
@@ -0,0 +1,58 @@
+#########
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import pkg_resources
+from mock import patch
+
+from cloudify_agent.api.plugins import constraints
+from cloudify_agent.tests import BaseTest
+
+
+class ConstraintsSnapshotTest(BaseTest):
+
+    def test_installed_versions(self):
+        snapshot = constraints.get_snapshot()
+        celery_version = pkg_resources.get_distribution('celery').version
+        self.assertEqual(celery_version, snapshot.get_version('celery'))
+        self.assertIn('celery=={0}'.format(celery_version),
+                      snapshot.render().splitlines())
+
+    def test_name_normalization(self):
+        snapshot = constraints.get_snapshot()
+        self.assertIn('cloudify-rest-client', snapshot)
+        self.assertIn('Cloudify_Rest_Client', snapshot)
+        self.assertNotIn('no-such-package', snapshot)
+        self.assertIsNone(snapshot.get_version('no-such-package'))
+
+    def test_excluded_packages(self):
+        snapshot = constraints.get_snapshot()
+        for package_name in constraints.EXCLUDED_PACKAGES:
+            self.assertNotIn(package_name, snapshot)
+
+    def test_memoized(self):
+        self.assertIs(constraints.get_snapshot(),
+                      constraints.get_snapshot())
+
+    def test_invalidate(self):
+        snapshot = constraints.get_snapshot()
+        constraints.invalidate()
+        self.assertIsNot(snapshot, constraints.get_snapshot())
+
+    def test_invalidated_on_site_packages_change(self):
+        snapshot = constraints.get_snapshot()
+        stat_key = constraints._stat_key() + (('changed', 0),)
+        with patch('cloudify_agent.api.plugins.constraints._stat_key',
+                   lambda: stat_key):
+            self.assertIsNot(snapshot, constraints.get_snapshot())
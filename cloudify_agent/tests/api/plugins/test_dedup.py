@@ -0,0 +1,182 @@
+#########
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import os
+import stat
+
+from mock import patch
+
+from cloudify_agent.api.plugins import dedup
+from cloudify_agent.tests import BaseTest
+from cloudify_agent.tests.api.pm import only_os
+
+
+def _create_prefix(path, content='plugin'):
+    site_packages = os.path.join(path, 'lib', 'python2.7', 'site-packages')
+    os.makedirs(os.path.join(site_packages, 'plugin'))
+    os.makedirs(os.path.join(path, 'bin'))
+    with open(os.path.join(site_packages, 'plugin', '__init__.py'), 'w') as f:
+        f.write(content)
+    with open(os.path.join(site_packages, 'plugin', 'tasks.py'), 'w') as f:
+        f.write('def run(): pass')
+    script = os.path.join(path, 'bin', 'plugin')
+    with open(script, 'w') as f:
+        f.write('#!/bin/sh')
+    os.chmod(script, 0o755)
+    os.symlink('lib', os.path.join(path, 'lib64'))
+    with open(os.path.join(path, 'constraint.txt'), 'w') as f:
+        f.write(path)
+
+
+def _inode(prefix, *path):
+    return os.stat(os.path.join(prefix, *path)).st_ino
+
+
+# No hard links on windows.
+@only_os('posix')
+class DedupStoreTest(BaseTest):
+
+    def setUp(self):
+        super(DedupStoreTest, self).setUp()
+        self.plugins_dir = os.path.join(self.temp_folder, 'plugins')
+        os.mkdir(self.plugins_dir)
+        self.store = dedup.DedupStore(
+            root=os.path.join(self.plugins_dir, '.dedup'),
+            mode=dedup.HARDLINK,
+            logger=self.logger)
+
+    def _prefix(self, name, **kwargs):
+        path = os.path.join(self.plugins_dir, name)
+        _create_prefix(path, **kwargs)
+        return path
+
+    def test_ingest(self):
+        first = self._prefix('first')
+        second = self._prefix('second')
+        self.store.ingest(first)
+        manifest = self.store.ingest(second)
+        init = ('lib', 'python2.7', 'site-packages', 'plugin', '__init__.py')
+        self.assertEqual(_inode(first, *init), _inode(second, *init))
+        self.assertEqual(_inode(first, 'bin', 'plugin'),
+                         _inode(second, 'bin', 'plugin'))
+        self.assertNotEqual(_inode(first, 'constraint.txt'),
+                            _inode(second, 'constraint.txt'))
+        self.assertEqual(3, len(manifest['files']))
+        self.assertEqual([['lib64', 'lib']], manifest['symlinks'])
+        # executables and regular files with the same content are
+        # different objects
+        self.assertTrue(os.access(os.path.join(first, 'bin', 'plugin'),
+                                  os.X_OK))
+        # shared content is read only
+        mode = os.stat(os.path.join(first, *init)).st_mode
+        self.assertFalse(mode & stat.S_IWUSR)
+        self.assertEqual(manifest, dedup.read_manifest(second))
+
+    def test_ingest_different_content(self):
+        first = self._prefix('first')
+        second = self._prefix('second', content='modified')
+        self.store.ingest(first)
+        self.store.ingest(second)
+        init = ('lib', 'python2.7', 'site-packages', 'plugin', '__init__.py')
+        self.assertNotEqual(_inode(first, *init), _inode(second, *init))
+        tasks = ('lib', 'python2.7', 'site-packages', 'plugin', 'tasks.py')
+        self.assertEqual(_inode(first, *tasks), _inode(second, *tasks))
+
+    def test_materialize(self):
+        first = self._prefix('first')
+        self.store.ingest(first, key='build')
+        second = os.path.join(self.plugins_dir, 'second')
+        os.mkdir(second)
+        self.assertTrue(self.store.materialize('build', second))
+        self.assertEqual(_inode(first, 'bin', 'plugin'),
+                         _inode(second, 'bin', 'plugin'))
+        self.assertEqual('lib', os.readlink(os.path.join(second, 'lib64')))
+        with open(os.path.join(second, 'lib', 'python2.7', 'site-packages',
+                               'plugin', '__init__.py')) as f:
+            self.assertEqual('plugin', f.read())
+        self.assertFalse(self.store.materialize('unknown', second))
+
+    def test_release(self):
+        first = self._prefix('first')
+        second = self._prefix('second', content='modified')
+        self.store.ingest(first, key='build')
+        self.store.ingest(second)
+        # only the content unique to the first prefix is reclaimed
+        self.assertEqual(len('plugin'), self.store.release(first))
+        self.assertFalse(os.path.exists(first))
+        self.assertEqual(3, len(self.store._all_objects()))
+        # the build of the released prefix can no longer be materialized
+        third = os.path.join(self.plugins_dir, 'third')
+        os.mkdir(third)
+        self.assertFalse(self.store.materialize('build', third))
+        self.store.release(second)
+        self.assertEqual([], self.store._all_objects())
+
+    def test_gc_keeps_objects_referenced_by_manifest(self):
+        first = self._prefix('first')
+        self.store.ingest(first)
+        # e.g. a prefix that was copied rather than linked
+        for dir_path, _, file_names in os.walk(first):
+            for file_name in file_names:
+                path = os.path.join(dir_path, file_name)
+                if os.path.islink(path):
+                    continue
+                with open(path) as f:
+                    content = f.read()
+                os.remove(path)
+                with open(path, 'w') as f:
+                    f.write(content)
+        self.assertEqual(0, self.store.gc())
+        self.assertEqual(3, len(self.store._all_objects()))
+
+    def test_references_counted(self):
+        first = self._prefix('first')
+        second = self._prefix('second', content='modified')
+        self.store.ingest(first)
+        self.store.ingest(second)
+        references = self.store._load_references()
+        self.assertEqual([1, 1, 2, 2], sorted(references.values()))
+        self.store.release(first)
+        self.assertEqual([1, 1, 1], sorted(
+            self.store._load_references().values()))
+        # garbage collection does not scan the prefixes manifests
+        with patch('cloudify_agent.api.plugins.dedup.read_manifest',
+                   side_effect=AssertionError):
+            self.assertEqual(0, self.store.gc())
+
+    def test_references_recounted(self):
+        first = self._prefix('first')
+        self.store.ingest(first)
+        os.remove(self.store.references_path)
+        self.assertEqual([1, 1, 1], sorted(
+            self.store._load_references().values()))
+
+    def test_reflink_falls_back(self):
+        store = dedup.DedupStore(root=self.store.root,
+                                 mode=dedup.REFLINK,
+                                 logger=self.logger)
+        first = self._prefix('first')
+        store.ingest(first, key='build')
+        second = os.path.join(self.plugins_dir, 'second')
+        os.mkdir(second)
+        self.assertTrue(store.materialize('build', second))
+        with open(os.path.join(second, 'bin', 'plugin')) as f:
+            self.assertEqual('#!/bin/sh', f.read())
+        store.release(first)
+        store.release(second)
+        self.assertEqual([], store._all_objects())
+
+    def test_invalid_mode(self):
+        self.assertRaises(ValueError, dedup.DedupStore, mode='copy')
@@ -0,0 +1,254 @@
+#########
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import os
+import io
+import hashlib
+import tarfile
+import zipfile
+
+import requests
+
+from cloudify_agent.api import exceptions
+from cloudify_agent.api.plugins import download
+
+from cloudify_agent.tests import resources
+from cloudify_agent.tests import BaseTest
+from cloudify_agent.tests import utils as test_utils
+
+PLUGIN_DIR_NAME = 'mock-plugin-with-requirements'
+
+
+def _plugin_source_path():
+    return resources.get_resource(os.path.join('plugins', PLUGIN_DIR_NAME))
+
+
+def _tar_archive(mode='w:gz'):
+    buf = io.BytesIO()
+    archive = tarfile.open(fileobj=buf, mode=mode)
+    try:
+        archive.add(_plugin_source_path(), PLUGIN_DIR_NAME)
+    finally:
+        archive.close()
+    return buf.getvalue()
+
+
+def _zip_archive():
+    buf = io.BytesIO()
+    archive = zipfile.ZipFile(buf, 'w')
+    try:
+        source_path = _plugin_source_path()
+        for dir_path, _, file_names in os.walk(source_path):
+            for file_name in file_names:
+                path = os.path.join(dir_path, file_name)
+                archive.write(path, os.path.join(
+                    PLUGIN_DIR_NAME, os.path.relpath(path, source_path)))
+    finally:
+        archive.close()
+    return buf.getvalue()
+
+
+class DownloadAndExtractTest(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = test_utils.HTTPServerStandIn()
+        cls.server.start()
+        cls.tar_gz = _tar_archive()
+        cls.server.files['/plugin.tar.gz'] = cls.tar_gz
+        cls.server.files['/plugin.tar'] = _tar_archive(mode='w')
+        cls.server.files['/plugin.zip'] = _zip_archive()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        super(DownloadAndExtractTest, self).setUp()
+        self.server.requests = []
+        self.server.drops = 0
+        self.server.on_drop = None
+        self.server.support_ranges = True
+        self.server.files['/plugin.tar.gz'] = self.tar_gz
+        self.target_dir = os.path.join(self.temp_folder, 'extracted')
+        os.mkdir(self.target_dir)
+
+    def _download(self, path, **kwargs):
+        return download.download_and_extract(self.server.url(path),
+                                             self.target_dir,
+                                             logger=self.logger,
+                                             **kwargs)
+
+    def _assert_extracted(self):
+        self.assertTrue(test_utils.are_dir_trees_equal(
+            _plugin_source_path(), self.target_dir))
+
+    def test_tar_gz(self):
+        result = self._download('plugin.tar.gz')
+        self._assert_extracted()
+        self.assertEqual(hashlib.sha256(self.tar_gz).hexdigest(),
+                         result.digest)
+        self.assertEqual(len(self.tar_gz), result.size)
+        self.assertEqual(0, result.resumes)
+        self.assertGreater(result.throughput, 0)
+
+    def test_tar(self):
+        result = self._download('plugin.tar')
+        self._assert_extracted()
+        self.assertEqual(
+            hashlib.sha256(self.server.files['/plugin.tar']).hexdigest(),
+            result.digest)
+
+    def test_zip(self):
+        result = self._download('plugin.zip')
+        self._assert_extracted()
+        self.assertEqual(
+            hashlib.sha256(self.server.files['/plugin.zip']).hexdigest(),
+            result.digest)
+
+    def test_file_url(self):
+        archive_path = os.path.join(self.temp_folder, 'plugin.tar.gz')
+        with open(archive_path, 'wb') as f:
+            f.write(self.tar_gz)
+        result = download.download_and_extract(
+            'file://{0}'.format(archive_path), self.target_dir)
+        self._assert_extracted()
+        self.assertEqual(hashlib.sha256(self.tar_gz).hexdigest(),
+                         result.digest)
+
+    def test_resume(self):
+        self.server.drops = 2
+        self.server.drop_after = len(self.tar_gz) // 3
+        result = self._download('plugin.tar.gz')
+        self._assert_extracted()
+        self.assertEqual(2, result.resumes)
+        self.assertEqual(hashlib.sha256(self.tar_gz).hexdigest(),
+                         result.digest)
+        ranges = [headers.get('range') for _, headers in self.server.requests]
+        self.assertEqual([None,
+                          'bytes={0}-'.format(self.server.drop_after),
+                          'bytes={0}-'.format(2 * self.server.drop_after)],
+                         ranges)
+        etag = '"{0}"'.format(result.digest)
+        self.assertEqual([etag, etag], [headers.get('if-range') for _, headers
+                                        in self.server.requests[1:]])
+
+    def _change_when_dropped(self, archive):
+        def change(path):
+            self.server.files[path] = archive
+        self.server.on_drop = change
+
+    def test_changed_while_resuming(self):
+        changed = _tar_archive(mode='w')
+        self._change_when_dropped(changed)
+        self.server.drops = 1
+        self.server.drop_after = len(self.tar_gz) // 2
+        result = self._download('plugin.tar.gz')
+        self._assert_extracted()
+        self.assertEqual(1, result.resumes)
+        self.assertEqual(hashlib.sha256(changed).hexdigest(), result.digest)
+        self.assertEqual(len(changed), result.size)
+
+    def test_resume_without_range_support(self):
+        self.server.support_ranges = False
+        self.server.drops = 1
+        self.server.drop_after = len(self.tar_gz) // 2
+        result = self._download('plugin.tar.gz')
+        self._assert_extracted()
+        self.assertEqual(1, result.resumes)
+        self.assertEqual(hashlib.sha256(self.tar_gz).hexdigest(),
+                         result.digest)
+
+    def test_retries_exhausted(self):
+        self.server.drops = 3
+        self.server.drop_after = 100
+        with self.assertRaises(exceptions.PluginInstallationError) as c:
+            self._download('plugin.tar.gz', retries=2)
+        self.assertIn('after 3 attempts', str(c.exception))
+
+    def test_digest_verified(self):
+        digest = hashlib.sha256(self.tar_gz).hexdigest()
+        self._download('plugin.tar.gz#sha256={0}'.format(digest))
+        self._assert_extracted()
+
+    def test_digest_mismatch(self):
+        with self.assertRaises(exceptions.PluginInstallationError) as c:
+            self._download('plugin.tar.gz', expected_digest='0' * 64)
+        self.assertIn('Digest mismatch', str(c.exception))
+
+    def test_member_outside_target_dir(self):
+        buf = io.BytesIO()
+        archive = tarfile.open(fileobj=buf, mode='w:gz')
+        info = tarfile.TarInfo('../escaped')
+        info.size = 4
+        archive.addfile(info, io.BytesIO(b'data'))
+        archive.close()
+        self.server.files['/evil.tar.gz'] = buf.getvalue()
+        with self.assertRaises(exceptions.PluginInstallationError) as c:
+            self._download('evil.tar.gz')
+        self.assertIn('outside', str(c.exception))
+        self.assertFalse(os.path.exists(
+            os.path.join(self.temp_folder, 'escaped')))
+
+    def test_not_an_archive(self):
+        self.server.files['/plugin.txt'] = b'not an archive'
+        self.assertRaises(exceptions.PluginInstallationError,
+                          self._download, 'plugin.txt')
+
+    def test_not_found(self):
+        self.assertRaises(requests.exceptions.HTTPError,
+                          self._download, 'missing.tar.gz')
+
+    def test_download_to_file(self):
+        output_path = os.path.join(self.temp_folder, 'plugin.tar.gz')
+        result = download.download_to_file(self.server.url('plugin.tar.gz'),
+                                           output_path,
+                                           logger=self.logger)
+        with open(output_path, 'rb') as f:
+            self.assertEqual(self.tar_gz, f.read())
+        self.assertEqual(hashlib.sha256(self.tar_gz).hexdigest(),
+                         result.digest)
+        self.assertEqual('"{0}"'.format(result.digest), result.etag)
+
+    def test_download_to_file_changed_while_resuming(self):
+        changed = _tar_archive(mode='w')
+        self._change_when_dropped(changed)
+        self.server.drops = 1
+        self.server.drop_after = len(self.tar_gz) // 2
+        output_path = os.path.join(self.temp_folder, 'plugin.tar.gz')
+        result = download.download_to_file(self.server.url('plugin.tar.gz'),
+                                           output_path,
+                                           logger=self.logger)
+        with open(output_path, 'rb') as f:
+            self.assertEqual(changed, f.read())
+        self.assertEqual(hashlib.sha256(changed).hexdigest(), result.digest)
+        self.assertEqual('"{0}"'.format(result.digest), result.etag)
+
+    def test_download_to_file_not_modified(self):
+        output_path = os.path.join(self.temp_folder, 'plugin.tar.gz')
+        etag = '"{0}"'.format(hashlib.sha256(self.tar_gz).hexdigest())
+        self.assertIsNone(download.download_to_file(
+            self.server.url('plugin.tar.gz'),
+            output_path,
+            etag=etag,
+            logger=self.logger))
+        self.assertFalse(os.path.exists(output_path))
+        self.assertEqual(etag, self.server.requests[-1][1]['if-none-match'])
+        result = download.download_to_file(
+            self.server.url('plugin.tar.gz'),
+            output_path,
+            etag='"outdated"',
+            logger=self.logger)
+        self.assertEqual(len(self.tar_gz), result.size)
@@ -0,0 +1,164 @@
+#########
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import os
+import sys
+import shutil
+import zipfile
+
+from mock import patch
+
+from cloudify_agent.api.plugins import imports
+from cloudify_agent.api.plugins import index
+from cloudify_agent.tests import BaseTest
+
+
+def _create_prefix(prefix, package_name, module_value):
+    site_packages = os.path.join(prefix, index._site_packages_dirs()[0])
+    package_dir = os.path.join(site_packages, package_name)
+    os.makedirs(os.path.join(package_dir, 'sub'))
+    with open(os.path.join(package_dir, '__init__.py'), 'w') as f:
+        f.write('value = {0!r}\n'.format(module_value))
+    with open(os.path.join(package_dir, 'sub', '__init__.py'), 'w') as f:
+        f.write('value = {0!r}\n'.format(module_value))
+    with open(os.path.join(site_packages,
+                           '{0}_module.py'.format(package_name)), 'w') as f:
+        f.write('value = {0!r}\n'.format(module_value))
+    return site_packages
+
+
+class PluginModuleFinderTest(BaseTest):
+
+    def setUp(self):
+        super(PluginModuleFinderTest, self).setUp()
+        self.plugins_dir = os.path.join(self.temp_folder, 'plugins')
+        self.index = index.PluginIndex(self.plugins_dir)
+        self.finder = imports.PluginModuleFinder(self.index)
+        sys.meta_path.insert(0, self.finder)
+        self.addCleanup(sys.meta_path.remove, self.finder)
+        self.addCleanup(setattr, sys, 'path', list(sys.path))
+        self.package_name = 'plugin_package_{0}'.format(
+            os.path.basename(self.temp_folder).replace('-', '_'))
+        self.addCleanup(self._unload)
+
+    def _unload(self):
+        for name in list(sys.modules):
+            if name.startswith(self.package_name):
+                del sys.modules[name]
+
+    def _install(self, dir_name, value):
+        site_packages = _create_prefix(
+            os.path.join(self.plugins_dir, dir_name), self.package_name,
+            value)
+        self.index.add(dir_name, index.SOURCE)
+        self.finder.invalidate()
+        return site_packages
+
+    def test_modules_indexed(self):
+        site_packages = self._install('dep-plugin', 'dep')
+        modules = self.index.modules()
+        self.assertEqual([site_packages], modules[self.package_name])
+        self.assertEqual([site_packages],
+                         modules['{0}_module'.format(self.package_name)])
+        self.index.remove('dep-plugin')
+        self.assertEqual({}, self.index.modules())
+
+    def test_import(self):
+        site_packages = self._install('dep-plugin', 'dep')
+        other = self._install('other-plugin', 'other')
+        self.assertIsNone(self.finder.find_module(self.package_name))
+        sys.path.extend([site_packages, other])
+        self.assertIsNotNone(self.finder.find_module(self.package_name))
+        package = __import__(self.package_name)
+        self.assertEqual('dep', package.value)
+        self.assertEqual(os.path.join(site_packages, self.package_name),
+                         os.path.dirname(package.__file__))
+        sub = __import__('{0}.sub'.format(self.package_name),
+                         fromlist=['value'])
+        self.assertEqual('dep', sub.value)
+        module = __import__('{0}_module'.format(self.package_name))
+        self.assertEqual('dep', module.value)
+
+    def test_sys_path_precedence(self):
+        first = self._install('first-plugin', 'first')
+        second = self._install('second-plugin', 'second')
+        sys.path[0:0] = [second, first]
+        self.assertEqual('second', __import__(self.package_name).value)
+
+    def test_single_prefix_left_to_import_machinery(self):
+        site_packages = self._install('dep-plugin', 'dep')
+        sys.path.append(site_packages)
+        with patch.object(self.index, 'modules') as modules:
+            self.assertIsNone(self.finder.find_module(self.package_name))
+        self.assertFalse(modules.called)
+        self.assertEqual('dep', __import__(self.package_name).value)
+
+    def test_only_prefixes_on_sys_path_looked_up(self):
+        sys.path.extend([self._install('first-plugin', 'first'),
+                         self._install('second-plugin', 'second')])
+        self._install('third-plugin', 'third')
+        with patch.object(self.index, 'modules',
+                          wraps=self.index.modules) as modules:
+            self.assertIsNotNone(self.finder.find_module(self.package_name))
+        modules.assert_called_once_with(
+            frozenset(['first-plugin', 'second-plugin']))
+
+    def test_shadowed_by_earlier_entry(self):
+        site_packages = self._install('dep-plugin', 'dep')
+        other_plugin = self._install('other-plugin', 'other')
+        other = os.path.join(self.temp_folder, 'other')
+        os.mkdir(other)
+        with open(os.path.join(other, '{0}_module.py'.format(
+                self.package_name)), 'w') as f:
+            f.write('value = {0!r}\n'.format('other'))
+        sys.path[0:0] = [other, site_packages, other_plugin]
+        self.assertIsNone(self.finder.find_module(
+            '{0}_module'.format(self.package_name)))
+        self.assertEqual('other', __import__(
+            '{0}_module'.format(self.package_name)).value)
+        # not shadowed
+        self.assertIsNotNone(self.finder.find_module(self.package_name))
+
+    def test_shadowed_by_earlier_zip(self):
+        site_packages = self._install('dep-plugin', 'dep')
+        other_plugin = self._install('other-plugin', 'other')
+        archive = os.path.join(self.temp_folder, 'other.zip')
+        with zipfile.ZipFile(archive, 'w') as f:
+            f.writestr('{0}_module.py'.format(self.package_name),
+                       'value = {0!r}\n'.format('zip'))
+        sys.path[0:0] = [archive, site_packages, other_plugin]
+        self.assertIsNone(self.finder.find_module(
+            '{0}_module'.format(self.package_name)))
+        self.assertEqual('zip', __import__(
+            '{0}_module'.format(self.package_name)).value)
+
+    def test_not_provided(self):
+        self._install('dep-plugin', 'dep')
+        self.assertIsNone(self.finder.find_module('json'))
+        self.assertIsNone(self.finder.find_module('sys'))
+        self.assertIsNone(self.finder.find_module(
+            '{0}.sub'.format(self.package_name)))
+
+    def test_removed_since_indexed(self):
+        site_packages = self._install('dep-plugin', 'dep')
+        other = self._install('other-plugin', 'other')
+        sys.path.extend([site_packages, other])
+        shutil.rmtree(os.path.join(other, self.package_name))
+        shutil.rmtree(os.path.join(site_packages, self.package_name))
+        self.assertIsNone(self.finder.find_module(self.package_name))
+
+    def test_missing_index(self):
+        self.assertIsNone(self.finder.find_module(self.package_name))
+        self.assertFalse(os.path.exists(self.index.path))
@@ -0,0 +1,146 @@
+#########
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import os
+import threading
+
+from cloudify_agent.api.plugins import index
+from cloudify_agent.tests import BaseTest
+
+
+class PluginIndexTest(BaseTest):
+
+    def setUp(self):
+        super(PluginIndexTest, self).setUp()
+        self.plugins_dir = os.path.join(self.temp_folder, 'plugins')
+        self.index = index.PluginIndex(self.plugins_dir)
+
+    def _install(self, dir_name, plugin_id=None):
+        path = os.path.join(self.plugins_dir, dir_name)
+        os.makedirs(path)
+        with open(os.path.join(path, 'setup.py'), 'w') as f:
+            f.write('setup()')
+        if plugin_id:
+            with open(os.path.join(path, 'plugin.id'), 'w') as f:
+                f.write(plugin_id)
+
+    def test_add(self):
+        self._install('plugin-1.0')
+        self.index.add('plugin-1.0',
+                       index.MANAGED,
+                       plugin_id='id',
+                       name='plugin',
+                       package_name='plugin',
+                       package_version='1.0',
+                       deployment_id='dep')
+        entry = self.index.get('plugin-1.0')
+        self.assertEqual('id', entry['plugin_id'])
+        self.assertEqual(index.MANAGED, entry['kind'])
+        self.assertEqual('1.0', entry['package_version'])
+        self.assertEqual(['dep'], entry['deployments'])
+        self.assertGreater(entry['size'], 0)
+        self.assertEqual(entry['installed_at'], entry['last_used'])
+        self.assertEqual([entry], self.index.list())
+        self.assertIsNone(self.index.get('missing'))
+
+    def test_remove(self):
+        self.index.add('plugin-1.0', index.MANAGED, plugin_id='id',
+                       deployment_id='dep')
+        self.index.remove('plugin-1.0')
+        self.assertIsNone(self.index.get('plugin-1.0'))
+        self.assertEqual([], self.index.list())
+        # references are removed with the installation
+        self.index.add('plugin-1.0', index.MANAGED, plugin_id='id')
+        self.assertEqual([], self.index.get('plugin-1.0')['deployments'])
+
+    def test_references(self):
+        self.index.add('plugin-1.0', index.MANAGED, plugin_id='id',
+                       deployment_id='dep1')
+        last_used = self.index.get('plugin-1.0')['last_used']
+        self.assertEqual(2, self.index.add_reference('plugin-1.0', 'dep2'))
+        self.assertEqual(2, self.index.add_reference('plugin-1.0', 'dep2'))
+        entry = self.index.get('plugin-1.0')
+        self.assertEqual(['dep1', 'dep2'], entry['deployments'])
+        self.assertGreaterEqual(entry['last_used'], last_used)
+        self.assertEqual(1, self.index.remove_reference('plugin-1.0',
+                                                        'dep1'))
+        self.assertEqual(0, self.index.remove_reference('plugin-1.0',
+                                                        'dep2'))
+        self.assertIsNotNone(self.index.get('plugin-1.0'))
+
+    def test_backfill(self):
+        self._install('managed-1.0', plugin_id='id')
+        self._install('dep-source')
+        os.makedirs(os.path.join(self.plugins_dir, '.dedup'))
+        entries = dict((entry['dir'], entry) for entry in self.index.list())
+        self.assertEqual(set(['managed-1.0', 'dep-source']), set(entries))
+        self.assertEqual('id', entries['managed-1.0']['plugin_id'])
+        self.assertEqual(index.SOURCE, entries['dep-source']['kind'])
+        # their users are unknown
+        for entry in entries.values():
+            self.assertEqual([index.LEGACY], entry['deployments'])
+        self.assertEqual(0, self.index.backfill())
+
+    def test_modules_reindexed_on_upgrade(self):
+        self._install('dep-plugin')
+        package_dir = os.path.join(self.plugins_dir, 'dep-plugin',
+                                   index._site_packages_dirs()[0], 'package')
+        os.makedirs(package_dir)
+        open(os.path.join(package_dir, '__init__.py'), 'w').close()
+        self.index.add('dep-plugin', index.SOURCE)
+        with self.index.transaction() as connection:
+            connection.execute('DELETE FROM modules')
+            connection.execute('PRAGMA user_version = 1')
+        self.assertEqual({}, self.index.modules())
+        plugin_index = index.PluginIndex(self.plugins_dir)
+        self.assertEqual(1, len(plugin_index.list()))
+        self.assertEqual([os.path.dirname(package_dir)],
+                         plugin_index.modules()['package'])
+
+    def test_concurrent_transactions(self):
+        self.index.add('plugin-1.0', index.MANAGED, plugin_id='id')
+
+        def add_references(thread_index):
+            # separate instances, as used by separate processes
+            plugin_index = index.PluginIndex(self.plugins_dir)
+            for i in range(10):
+                plugin_index.add_reference(
+                    'plugin-1.0', 'dep-{0}-{1}'.format(thread_index, i))
+
+        threads = [threading.Thread(target=add_references, args=(i,))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(40, len(self.index.get('plugin-1.0')['deployments']))
+
+    def test_failed_transaction(self):
+        self.index.add('plugin-1.0', index.MANAGED, plugin_id='id')
+
+        def fail():
+            with self.index.transaction() as connection:
+                connection.execute('DELETE FROM plugins')
+                raise RuntimeError('failed')
+        self.assertRaises(RuntimeError, fail)
+        self.assertIsNotNone(self.index.get('plugin-1.0'))
+
+    def test_failed_rollback(self):
+        def fail():
+            with self.index.transaction() as connection:
+                # leaves nothing for the transaction to roll back
+                connection.execute('ROLLBACK')
+                raise RuntimeError('failed')
+        self.assertRaises(RuntimeError, fail)
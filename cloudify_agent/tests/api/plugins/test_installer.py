@@ -13,6 +13,9 @@
 #  * See the License for the specific language governing permissions and
 #  * limitations under the License.
 
+import glob
+import json
+import time
 import tempfile
 import logging
 import os
@@ -30,9 +33,15 @@ from cloudify.utils import setup_logger
 from cloudify.utils import LocalCommandRunner
 from cloudify.exceptions import NonRecoverableError
 from cloudify_rest_client.plugins import Plugin
+from cloudify_rest_client.deployments import Deployment
+from cloudify_rest_client.responses import ListResponse
 
 from cloudify_agent.api import exceptions
+from cloudify_agent.api import utils
+from cloudify_agent.api.plugins import index
 from cloudify_agent.api.plugins import installer
+from cloudify_agent.api.plugins import instrumentation
+from cloudify_agent.api.plugins import trash
 
 from cloudify_agent.tests import resources
 from cloudify_agent.tests import utils as test_utils
@@ -84,6 +93,16 @@ class PluginInstallerTest(BaseTest):
 
     def setUp(self):
         self.installer = installer.PluginInstaller(logger=self.logger)
+        self._patch_plugins_cache_dir()
+
+    def _patch_plugins_cache_dir(self):
+        # plugin IDs are reused across tests with different wagons, so
+        # every test gets a fresh cache
+        cache_dir = tempfile.mkdtemp(prefix='plugins-cache-')
+        key = utils.internal.CLOUDIFY_PLUGINS_CACHE_DIRECTORY_KEY
+        os.environ[key] = cache_dir
+        self.addCleanup(lambda: os.environ.pop(key, None))
+        self.addCleanup(lambda: shutil.rmtree(cache_dir, ignore_errors=True))
 
     def tearDown(self):
         self.installer.uninstall(plugin=self._plugin_struct(''))
@@ -161,6 +180,83 @@ class PluginInstallerTest(BaseTest):
             expected_return='on the brilliant marble-sanded beaches of '
                             'Santraginus V')
 
+    def test_install_from_source_wheelhouse(self):
+        source_plugin_site_packages = []
+        for deployment_id in ['deployment', 'deployment2']:
+            self.installer.install(
+                self._plugin_struct(source='mock-plugin.tar'),
+                deployment_id=deployment_id)
+            self.addCleanup(self.installer.uninstall,
+                            plugin=self._plugin_struct(),
+                            deployment_id=deployment_id)
+            source_plugin_site_packages.extend(glob.glob(os.path.join(
+                self.installer._full_dst_dir('{0}-{1}'.format(
+                    deployment_id, PLUGIN_NAME)),
+                'lib*', 'python*', 'site-packages', 'mock_plugin')))
+        self.assertEqual(2, len(source_plugin_site_packages))
+        self.assertEqual(1, self.installer.wheelhouse.misses)
+        self.assertEqual(1, self.installer.wheelhouse.hits)
+        entry = self.installer.wheelhouse.list()[0]
+        self.assertEqual(PACKAGE_NAME, entry['package_name'])
+        self.assertEqual(1, len(entry['wheels']))
+
+    @only_os('posix')
+    def test_install_from_source_dedup(self):
+        key = utils.internal.CLOUDIFY_PLUGINS_DEDUP_KEY
+        os.environ[key] = 'hardlink'
+        self.addCleanup(lambda: os.environ.pop(key, None))
+        self.installer = installer.PluginInstaller(logger=self.logger)
+        modules = []
+        for deployment_id in ['deployment', 'deployment2']:
+            self.installer.install(
+                self._plugin_struct(source='mock-plugin.tar'),
+                deployment_id=deployment_id)
+            self.addCleanup(self.installer.uninstall,
+                            plugin=self._plugin_struct(),
+                            deployment_id=deployment_id)
+            modules.extend(glob.glob(os.path.join(
+                self.installer._full_dst_dir('{0}-{1}'.format(
+                    deployment_id, PLUGIN_NAME)),
+                'lib*', 'python*', 'site-packages', 'mock_plugin',
+                'tasks.py')))
+        self.assertEqual(2, len(modules))
+        self.assertTrue(os.path.samefile(*modules))
+        # the second installation is materialized out of the first one
+        self.assertEqual(1, self.installer.wheelhouse.misses)
+        self.assertEqual(0, self.installer.wheelhouse.hits)
+        store = self.installer.dedup_store
+        self.installer.uninstall(plugin=self._plugin_struct(),
+                                 deployment_id='deployment')
+        self.assertTrue(os.path.isfile(modules[1]))
+        self.installer.uninstall(plugin=self._plugin_struct(),
+                                 deployment_id='deployment2')
+        # deleted in the background
+        self.installer._trash().empty()
+        self.assertEqual([], store._all_objects())
+
+    def test_install_from_source_instrumentation(self):
+        events_path = os.path.join(self.plugins_work_dir, 'events.jsonl')
+        self.addCleanup(os.remove, events_path)
+        self.installer = installer.PluginInstaller(
+            logger=self.logger,
+            instrumentation_hook=instrumentation.JSONLinesInstrumentation(
+                events_path))
+        self.installer.install(self._plugin_struct(source='mock-plugin.tar'),
+                               deployment_id='deployment')
+        with open(events_path) as f:
+            events = dict((event['phase'], event)
+                          for event in (json.loads(line) for line in f))
+        self.assertEqual(set(['rest_lookup', 'freeze', 'download',
+                              'name_extraction', 'pip_install',
+                              'wheel_build', 'move', 'install']),
+                         set(events))
+        for event in events.values():
+            self.assertEqual(PLUGIN_NAME, event['plugin'])
+            self.assertEqual('deployment', event['deployment_id'])
+        self.assertFalse(events['install']['managed'])
+        self.assertGreater(events['download']['bytes'], 0)
+        self.assertFalse(events['pip_install']['cache_hit'])
+
     def test_install_from_source_already_exists(self):
         self.installer.install(self._plugin_struct(source='mock-plugin.tar'))
         with self.assertRaises(exceptions.PluginInstallationError) as c:
@@ -236,6 +332,79 @@ class PluginInstallerTest(BaseTest):
             package_name=PACKAGE_NAME,
             package_version=PACKAGE_VERSION)
 
+    def test_install_from_wagon_indexed(self):
+        dir_name = '{0}-{1}'.format(PACKAGE_NAME, PACKAGE_VERSION)
+        plugin_index = self.installer._index()
+        with _patch_for_install_wagon(PACKAGE_NAME, PACKAGE_VERSION,
+                                      download_path=self.wagons[PACKAGE_NAME]):
+            self.installer.install(self._plugin_struct())
+            self.installer.install(self._plugin_struct(),
+                                   deployment_id='deployment')
+        entry = plugin_index.get(dir_name)
+        self.assertEqual(index.MANAGED, entry['kind'])
+        self.assertEqual('1', entry['plugin_id'])
+        self.assertEqual(PLUGIN_NAME, entry['name'])
+        self.assertEqual([installer.SYSTEM_DEPLOYMENT, 'deployment'],
+                         entry['deployments'])
+        # the installation outlives the deployment
+        plugin = self._plugin_struct()
+        plugin.update(package_name=PACKAGE_NAME,
+                      package_version=PACKAGE_VERSION)
+        self.installer.uninstall(plugin=plugin, deployment_id='deployment')
+        self.assertEqual([installer.SYSTEM_DEPLOYMENT],
+                         plugin_index.get(dir_name)['deployments'])
+        self.installer.uninstall_wagon(PACKAGE_NAME, PACKAGE_VERSION)
+        self.assertIsNone(plugin_index.get(dir_name))
+
+    def test_install_from_wagon_installed_before_index(self):
+        dir_name = '{0}-{1}'.format(PACKAGE_NAME, PACKAGE_VERSION)
+        plugin_index = self.installer._index()
+        with _patch_for_install_wagon(PACKAGE_NAME, PACKAGE_VERSION,
+                                      download_path=self.wagons[PACKAGE_NAME]):
+            self.installer.install(self._plugin_struct())
+            plugin_index.remove(dir_name)
+            self.installer.install(self._plugin_struct(),
+                                   deployment_id='deployment')
+        # deployments that used the installation before are unknown
+        self.assertEqual([index.LEGACY, 'deployment'],
+                         plugin_index.get(dir_name)['deployments'])
+
+    def test_install_from_source_indexed(self):
+        dir_name = 'deployment-{0}'.format(PLUGIN_NAME)
+        plugin_index = self.installer._index()
+        self.installer.install(self._plugin_struct(source='mock-plugin.tar'),
+                               deployment_id='deployment')
+        entry = plugin_index.get(dir_name)
+        self.assertEqual(index.SOURCE, entry['kind'])
+        self.assertEqual(['deployment'], entry['deployments'])
+        self.installer.uninstall(plugin=self._plugin_struct(),
+                                 deployment_id='deployment')
+        self.assertIsNone(plugin_index.get(dir_name))
+
+    def test_prefetch_managed(self):
+        with _patch_for_install_wagon(
+                PACKAGE_NAME, PACKAGE_VERSION,
+                download_path=self.wagons[PACKAGE_NAME]) as client:
+            result, = self.installer.prefetch([self._plugin_struct()])
+            self.assertTrue(result['managed'])
+            self.assertTrue(os.path.isfile(result['path']))
+            self.installer.install(self._plugin_struct())
+            self.assertEqual(1, client.plugins.downloads)
+        self.assertEqual(1, self.installer.wagon_cache.hits)
+
+    def test_prefetch_source(self):
+        source, missing = self.installer.prefetch([
+            self._plugin_struct(source='mock-plugin.tar'),
+            self._plugin_struct(name='missing')])
+        self.assertFalse(source['managed'])
+        self.assertTrue(os.path.isfile(source['path']))
+        self.assertIsNone(source['error'])
+        self.assertIsNone(missing['path'])
+        self.assertIn('Neither', missing['error'])
+        self.installer.install(self._plugin_struct(source='mock-plugin.tar'),
+                               deployment_id='deployment')
+        self.assertEqual(1, self.installer.source_cache.hits)
+
     def test_install_from_wagon_already_exists(self):
         self.test_install_from_wagon()
         # the installation here should basically do nothing but the
@@ -265,6 +434,17 @@ class PluginInstallerTest(BaseTest):
                 self.installer.install(self._plugin_struct())
             self.assertIn('does not match the ID', str(c.exception))
 
+    def test_install_from_wagon_cached(self):
+        with _patch_for_install_wagon(
+                PACKAGE_NAME, PACKAGE_VERSION,
+                download_path=self.wagons[PACKAGE_NAME]) as client:
+            self.installer.install(self._plugin_struct())
+            self.installer.uninstall_wagon(PACKAGE_NAME, PACKAGE_VERSION)
+            self.installer.install(self._plugin_struct())
+            self.assertEqual(1, client.plugins.downloads)
+        self.assertEqual(1, self.installer.wagon_cache.hits)
+        self.assertEqual(1, self.installer.wagon_cache.misses)
+
     def test_install_from_wagon_central_deployment(self):
         with _patch_for_install_wagon(PACKAGE_NAME, PACKAGE_VERSION,
                                       download_path=self.wagons[PACKAGE_NAME]):
@@ -450,6 +630,183 @@ class TestGetManagedPlugin(BaseTest):
                 installer.get_managed_plugin(plugin)
                 self.assertEqual(plugin, client.plugins.kwargs)
 
+    def test_lookups_cached(self):
+        plugin = {'package_name': 'a', 'package_version': '1',
+                  'supported_platform': 'any', 'distribution': 'x',
+                  'distribution_release': 'x'}
+        with _patch_client(plugins=[{'id': '1'}]) as client:
+            for _ in range(3):
+                self.assertEqual('1', installer.get_managed_plugin(
+                    plugin=plugin).id)
+            # a different query
+            installer.get_managed_plugin(plugin=dict(plugin,
+                                                     package_version='2'))
+            self.assertEqual(2, client.plugins.lists)
+            installer.invalidate_managed_plugins()
+            installer.get_managed_plugin(plugin=plugin)
+            self.assertEqual(3, client.plugins.lists)
+
+    def test_negative_lookups_cached(self):
+        plugin = {'package_name': 'a', 'package_version': '1'}
+        with _patch_client(plugins=[]) as client:
+            self.assertIsNone(installer.get_managed_plugin(plugin=plugin))
+            self.assertIsNone(installer.get_managed_plugin(plugin=plugin))
+            self.assertEqual(1, client.plugins.lists)
+
+    def test_lookups_cache_expiry(self):
+        plugin = {'package_name': 'a', 'package_version': '1'}
+        key = utils.internal.CLOUDIFY_MANAGED_PLUGINS_CACHE_TTL_KEY
+        with _patch_client(plugins=[]) as client:
+            with test_utils.env(key, '0'):
+                installer.get_managed_plugin(plugin=plugin)
+                installer.get_managed_plugin(plugin=plugin)
+            self.assertEqual(2, client.plugins.lists)
+            with test_utils.env(key, '1'):
+                installer.get_managed_plugin(plugin=plugin)
+                with patch('time.time', return_value=time.time() + 2):
+                    installer.get_managed_plugin(plugin=plugin)
+            self.assertEqual(4, client.plugins.lists)
+
+
+class PluginsGarbageCollectionTest(BaseTest):
+
+    def setUp(self):
+        super(PluginsGarbageCollectionTest, self).setUp()
+        virtualenv = os.path.join(self.temp_folder, 'env')
+        self.plugins_dir = os.path.join(virtualenv, 'plugins')
+        os.makedirs(self.plugins_dir)
+        virtualenv_patch = patch(
+            'cloudify_agent.api.plugins.installer.VIRTUALENV', virtualenv)
+        virtualenv_patch.start()
+        self.addCleanup(virtualenv_patch.stop)
+        self.installer = installer.PluginInstaller(logger=self.logger)
+        self.index = index.PluginIndex(self.plugins_dir)
+        self.installer.plugin_index = self.index
+        self.installer.trash = trash.Trash(
+            root=os.path.join(self.plugins_dir, '.trash'),
+            rate=0,
+            logger=self.logger)
+
+    def _install(self, dir_name, size, last_used, deployment_id=None):
+        os.mkdir(os.path.join(self.plugins_dir, dir_name))
+        self.index.add(dir_name, index.SOURCE,
+                       deployment_id=deployment_id or 'uninstalled',
+                       size=size)
+        if not deployment_id:
+            self.index.remove_reference(dir_name, 'uninstalled')
+        with self.index.transaction() as connection:
+            connection.execute('UPDATE plugins SET last_used = ? '
+                               'WHERE dir = ?', (last_used, dir_name))
+
+    def _installed(self):
+        return sorted(entry['dir'] for entry in self.index.list())
+
+    def test_lru_unreferenced_removed(self):
+        self._install('oldest', 100, 1, deployment_id='dep')
+        self._install('old', 100, 2)
+        self._install('new', 100, 3)
+        self.assertEqual(100, self.installer.collect_garbage(quota=250))
+        self.assertEqual(['new', 'oldest'], self._installed())
+        self.assertFalse(os.path.exists(os.path.join(self.plugins_dir,
+                                                     'old')))
+        self.assertEqual(1, len(self.installer.trash.entries()))
+        self.assertEqual(100, self.installer.collect_garbage(quota=0))
+        self.assertEqual(['oldest'], self._installed())
+
+    def test_deleted_deployments(self):
+        self._install('deleted', 100, 1, deployment_id='deleted')
+        self._install('system', 100, 1,
+                      deployment_id=installer.SYSTEM_DEPLOYMENT)
+        self._install('existing', 100, 1, deployment_id='existing')
+        self.assertEqual(0, self.installer.collect_garbage(quota=0))
+        self.assertEqual(100, self.installer.collect_garbage(
+            quota=0, deployment_ids=set(['existing'])))
+        self.assertEqual(['existing', 'system'], self._installed())
+
+    def test_deployment_created_during_collection(self):
+        self._install('plugin', 100, 1, deployment_id='deleted')
+        evict = self.installer._evict
+
+        def create_deployment_then_evict(dir_name, *args):
+            # the deployment is not in the listed deployment ids
+            self.index.add_reference(dir_name, 'created')
+            return evict(dir_name, *args)
+
+        with patch.object(self.installer, '_evict',
+                          create_deployment_then_evict):
+            self.assertEqual(0, self.installer.collect_garbage(
+                quota=0, deployment_ids=set(['existing'])))
+        self.assertEqual(['plugin'], self._installed())
+
+    def test_used_after_deployments_listed(self):
+        self._install('plugin', 100, 2, deployment_id='created')
+        self.assertEqual(0, self.installer.collect_garbage(
+            quota=0, deployment_ids=set(), deployments_listed_at=2))
+        self.assertEqual(100, self.installer.collect_garbage(
+            quota=0, deployment_ids=set(), deployments_listed_at=3))
+        self.assertEqual([], self._installed())
+
+    def test_installed_before_index(self):
+        for dir_name in ['managed-1.0', 'deleted-plugin', 'existing-plugin']:
+            os.mkdir(os.path.join(self.plugins_dir, dir_name))
+        with open(os.path.join(self.plugins_dir, 'managed-1.0',
+                               'plugin.id'), 'w') as f:
+            f.write('id')
+        self.index.backfill()
+        self.assertEqual(0, self.installer.collect_garbage(quota=0))
+        self.assertEqual(['deleted-plugin', 'existing-plugin', 'managed-1.0'],
+                         self._installed())
+        # source plugins are named after their deployment
+        self.installer.collect_garbage(quota=0,
+                                       deployment_ids=set(['existing']))
+        self.assertEqual(['existing-plugin', 'managed-1.0'],
+                         self._installed())
+
+    def test_never_referenced_kept(self):
+        os.mkdir(os.path.join(self.plugins_dir, 'plugin'))
+        self.index.add('plugin', index.SOURCE, size=100)
+        self.assertEqual(0, self.installer.collect_garbage(
+            quota=0, deployment_ids=set()))
+        self.assertEqual(['plugin'], self._installed())
+
+    def test_quota_configuration(self):
+        self._install('plugin', 100, 1)
+        key = utils.internal.CLOUDIFY_PLUGINS_DISK_QUOTA_KEY
+        with test_utils.env(key, '0'):
+            self.assertEqual(0, self.installer.collect_garbage())
+        with test_utils.env(key, '50'):
+            self.assertEqual(100, self.installer.collect_garbage())
+
+    def test_missing_installations_forgotten(self):
+        self._install('plugin', 100, 1, deployment_id='dep')
+        os.rmdir(os.path.join(self.plugins_dir, 'plugin'))
+        self.installer.collect_garbage(quota=1000)
+        self.assertEqual([], self._installed())
+
+    def test_installation_in_progress_kept(self):
+        self._install('plugin', 100, 1)
+        lock = self.installer._lock(os.path.join(self.plugins_dir, 'plugin'))
+        with lock:
+            self.assertEqual(0, self.installer.collect_garbage(quota=0))
+        self.assertEqual(['plugin'], self._installed())
+
+    def test_get_deployment_ids(self):
+        class Deployments(object):
+            def list(self, _include, _offset, _size):
+                items = [{'id': str(i)}
+                         for i in range(_offset, min(_offset + _size, 5))]
+                return ListResponse(
+                    [Deployment(item) for item in items],
+                    {'pagination': {'offset': _offset,
+                                    'size': _size,
+                                    'total': 5}})
+        client = MockClient([])
+        client.deployments = Deployments()
+        with patch('cloudify_agent.api.plugins.installer.get_rest_client',
+                   lambda: client):
+            self.assertEqual(set(['0', '1', '2', '3', '4']),
+                             installer.get_deployment_ids(page_size=2))
+
 
 @contextmanager
 def _patch_for_install_wagon(package_name, package_version,
@@ -461,13 +818,15 @@ def _patch_for_install_wagon(package_name, package_version,
     with _patch_client([plugin], download_path=download_path) as client:
         with patch('cloudify_agent.api.plugins.installer.get_managed_plugin',
                    lambda p, logger: client.plugins.plugins[0]):
-            yield
+            yield client
 
 
 @contextmanager
 def _patch_client(plugins, download_path=None):
     plugins = [Plugin(p) for p in plugins]
     client = MockClient(plugins, download_path=download_path)
+    # lookups of a previous client must not be used
+    installer.invalidate_managed_plugins()
     with patch('cloudify_agent.api.plugins.installer.get_rest_client',
                lambda: client):
         yield client
@@ -478,12 +837,20 @@ class MockPlugins(object):
         self.plugins = plugins
         self.download_path = download_path
         self.kwargs = None
+        self.downloads = 0
+        self.lists = 0
 
     def list(self, **kwargs):
         self.kwargs = kwargs
+        self.lists += 1
         return self.plugins
 
     def download(self, output_file, **kwargs):
+        if os.path.exists(output_file):
+            # as the rest client does
+            raise OSError("Output file '{0}' already exists"
+                          .format(output_file))
+        self.downloads += 1
         shutil.copy(self.download_path, output_file)
 
 
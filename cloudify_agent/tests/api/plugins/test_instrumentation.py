@@ -0,0 +1,119 @@
+#########
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import os
+import json
+import threading
+
+from cloudify_agent.api import utils
+from cloudify_agent.api.plugins import instrumentation
+from cloudify_agent.tests import BaseTest
+from cloudify_agent.tests import utils as test_utils
+
+
+class InstrumentationTest(BaseTest):
+
+    def setUp(self):
+        super(InstrumentationTest, self).setUp()
+        self.events_path = os.path.join(self.temp_folder, 'events.jsonl')
+        self.hook = instrumentation.JSONLinesInstrumentation(
+            self.events_path)
+        instrumentation.set_instrumentation(None)
+        self.addCleanup(instrumentation.set_instrumentation, None)
+
+    def _events(self):
+        with open(self.events_path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_disabled(self):
+        hook = instrumentation.Instrumentation()
+        with hook.install(plugin='plugin') as install_event:
+            with hook.phase('download') as event:
+                event['bytes'] = 10
+            hook.update(managed=True)
+        self.assertEqual({}, event)
+        self.assertIs(event, install_event)
+
+    def test_events(self):
+        with self.hook.install(plugin='plugin',
+                               version='1.0',
+                               deployment_id='dep'):
+            self.hook.update(managed=True)
+            with self.hook.phase('download') as event:
+                event['bytes'] = 10
+                event['cache_hit'] = False
+        download, install = self._events()
+        self.assertEqual('download', download['phase'])
+        self.assertEqual(10, download['bytes'])
+        self.assertFalse(download['cache_hit'])
+        for event in [download, install]:
+            self.assertEqual('plugin', event['plugin'])
+            self.assertEqual('1.0', event['version'])
+            self.assertEqual('dep', event['deployment_id'])
+            self.assertTrue(event['managed'])
+            self.assertIsNone(event['error'])
+            self.assertGreaterEqual(event['duration'], 0)
+        self.assertEqual('install', install['phase'])
+        self.assertGreaterEqual(install['duration'], download['duration'])
+
+    def test_error(self):
+        def install():
+            with self.hook.install(plugin='plugin'):
+                with self.hook.phase('pip_install'):
+                    raise RuntimeError('pip failed')
+        self.assertRaises(RuntimeError, install)
+        for event in self._events():
+            self.assertEqual('RuntimeError: pip failed', event['error'])
+
+    def test_threads(self):
+        def install(name):
+            with self.hook.install(plugin=name):
+                for _ in range(10):
+                    with self.hook.phase('download'):
+                        pass
+        threads = [threading.Thread(target=install, args=(str(i),))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        events = self._events()
+        self.assertEqual(44, len(events))
+        for name in ['0', '1', '2', '3']:
+            self.assertEqual(11, len([event for event in events
+                                      if event['plugin'] == name]))
+
+    def test_failing_emit(self):
+        hook = instrumentation.JSONLinesInstrumentation(
+            os.path.join(self.temp_folder, 'missing', 'events.jsonl'))
+        with hook.phase('download'):
+            pass
+
+    def test_configuration(self):
+        key = utils.internal.CLOUDIFY_PLUGINS_INSTRUMENTATION_KEY
+        self.assertFalse(instrumentation.get_instrumentation().enabled)
+        instrumentation.set_instrumentation(None)
+        with test_utils.env(key, self.events_path):
+            hook = instrumentation.get_instrumentation()
+            self.assertTrue(hook.enabled)
+            self.assertEqual(self.events_path, hook.path)
+        instrumentation.set_instrumentation(None)
+        with test_utils.env(key, 'true'):
+            with test_utils.env('CELERY_WORK_DIR', self.temp_folder):
+                with test_utils.env(utils.internal.CLOUDIFY_DAEMON_NAME_KEY,
+                                    'agent'):
+                    hook = instrumentation.get_instrumentation()
+        self.assertEqual(os.path.join(self.temp_folder,
+                                      'agent.plugins.jsonl'), hook.path)
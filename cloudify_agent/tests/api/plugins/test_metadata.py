@@ -0,0 +1,106 @@
+#########
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import os
+
+from mock import patch
+
+from cloudify_agent.api import utils
+from cloudify_agent.api.plugins import installer
+from cloudify_agent.api.plugins import metadata
+from cloudify_agent.tests import BaseTest
+
+
+class ReadPackageNameTest(BaseTest):
+
+    def setUp(self):
+        super(ReadPackageNameTest, self).setUp()
+        self.package_dir = os.path.join(self.temp_folder, 'package')
+        os.mkdir(self.package_dir)
+        key = utils.internal.CLOUDIFY_PLUGINS_CACHE_DIRECTORY_KEY
+        os.environ[key] = os.path.join(self.temp_folder, 'cache')
+        self.addCleanup(lambda: os.environ.pop(key, None))
+
+    def _write(self, file_name, content):
+        with open(os.path.join(self.package_dir, file_name), 'w') as f:
+            f.write(content)
+
+    def _read(self):
+        return metadata.read_package_name(self.package_dir)
+
+    def test_pkg_info(self):
+        self._write('PKG-INFO', 'Metadata-Version: 1.1\n'
+                                'Name: from-pkg-info\n'
+                                'Version: 1.0\n')
+        self._write('setup.py', 'from setuptools import setup\n'
+                                'setup(name="from-setup-py")\n')
+        self.assertEqual('from-pkg-info', self._read())
+
+    def test_setup_py(self):
+        self._write('setup.py', 'from setuptools import setup\n'
+                                'setup(name="from-setup-py",\n'
+                                '      version="1.0")\n')
+        self.assertEqual('from-setup-py', self._read())
+
+    def test_setup_py_module_constant(self):
+        self._write('setup.py', 'import setuptools\n'
+                                'NAME = "from-constant"\n'
+                                'setuptools.setup(name=NAME)\n')
+        self.assertEqual('from-constant', self._read())
+
+    def test_setup_cfg_pbr(self):
+        self._write('setup.py', 'import setuptools\n'
+                                'setuptools.setup(setup_requires=["pbr"],\n'
+                                '                 pbr=True)\n')
+        self._write('setup.cfg', '[metadata]\n'
+                                 'name = from-setup-cfg\n')
+        self.assertEqual('from-setup-cfg', self._read())
+
+    def test_pyproject(self):
+        self._write('pyproject.toml', '[build-system]\n'
+                                      'requires = ["setuptools"]\n'
+                                      '\n'
+                                      '[project]\n'
+                                      'name = "from-pyproject"\n')
+        self.assertEqual('from-pyproject', self._read())
+
+    def test_dynamic_name(self):
+        self._write('setup.py', 'from setuptools import setup\n'
+                                'setup(name="dynamic-" + "name")\n')
+        self.assertIsNone(self._read())
+
+    def test_invalid_setup_py(self):
+        self._write('setup.py', 'setup(name=')
+        self.assertIsNone(self._read())
+
+    def test_extract_package_name_fallback(self):
+        self._write('setup.py', 'from setuptools import setup\n'
+                                'setup(name="dynamic-" + "name")\n')
+        self.assertEqual('dynamic-name',
+                         installer.extract_package_name(self.package_dir))
+
+    def test_extract_package_name_cached_by_digest(self):
+        self._write('setup.py', 'from setuptools import setup\n'
+                                'setup(name="cached")\n')
+        self.assertEqual('cached', installer.extract_package_name(
+            self.package_dir, digest='digest'))
+        with patch('cloudify_agent.api.plugins.metadata.read_package_name',
+                   side_effect=AssertionError('should not be called')):
+            self.assertEqual('cached', installer.extract_package_name(
+                self.package_dir, digest='digest'))
+            # cache is persistent
+            metadata._name_caches.clear()
+            self.assertEqual('cached', installer.extract_package_name(
+                self.package_dir, digest='digest'))
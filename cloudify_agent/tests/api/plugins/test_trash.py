@@ -0,0 +1,118 @@
+#########
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import os
+import time
+
+from cloudify_agent.api import utils
+from cloudify_agent.api.plugins import dedup
+from cloudify_agent.api.plugins import trash
+from cloudify_agent.tests import BaseTest
+from cloudify_agent.tests.api.pm import only_os
+from cloudify_agent.tests.api.plugins.test_dedup import _create_prefix
+
+
+def _create_tree(path, files=10):
+    os.makedirs(os.path.join(path, 'package'))
+    for i in range(files):
+        with open(os.path.join(path, 'package', str(i)), 'w') as f:
+            f.write(str(i))
+
+
+# No symlinks and hard links on windows.
+@only_os('posix')
+class TrashTest(BaseTest):
+
+    def setUp(self):
+        super(TrashTest, self).setUp()
+        self.plugins_dir = os.path.join(self.temp_folder, 'plugins')
+        os.mkdir(self.plugins_dir)
+        self.dedup_store = dedup.DedupStore(
+            root=os.path.join(self.plugins_dir, '.dedup'),
+            mode=dedup.HARDLINK,
+            logger=self.logger)
+        self.trash = trash.Trash(
+            root=os.path.join(self.plugins_dir, '.trash'),
+            rate=0,
+            dedup_store=self.dedup_store,
+            logger=self.logger)
+
+    def test_discard(self):
+        path = os.path.join(self.plugins_dir, 'plugin')
+        _create_tree(path)
+        trashed = self.trash.discard(path)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual([trashed], self.trash.entries())
+        self.assertEqual(10, len(os.listdir(os.path.join(trashed,
+                                                         'package'))))
+        self.assertIsNone(self.trash.discard(path))
+
+    def test_empty(self):
+        for name in ['first', 'second']:
+            path = os.path.join(self.plugins_dir, name)
+            _create_tree(path)
+            self.trash.discard(path)
+        self.assertEqual(2, self.trash.empty())
+        self.assertEqual([], self.trash.entries())
+
+    def test_symlinks_not_followed(self):
+        outside = os.path.join(self.temp_folder, 'outside')
+        _create_tree(outside)
+        path = os.path.join(self.plugins_dir, 'plugin')
+        _create_tree(path)
+        os.symlink(outside, os.path.join(path, 'link'))
+        self.trash.discard(path)
+        self.trash.empty()
+        self.assertEqual([], self.trash.entries())
+        self.assertEqual(10, len(os.listdir(os.path.join(outside,
+                                                         'package'))))
+
+    def test_rate(self):
+        self.trash.rate = 500
+        path = os.path.join(self.plugins_dir, 'plugin')
+        _create_tree(path, files=150)
+        self.trash.discard(path)
+        start = time.time()
+        self.trash.empty()
+        self.assertGreaterEqual(time.time() - start, 0.15)
+
+    def test_dedup_gc(self):
+        path = os.path.join(self.plugins_dir, 'plugin')
+        _create_prefix(path)
+        self.dedup_store.ingest(path)
+        self.assertNotEqual([], self.dedup_store._all_objects())
+        self.trash.discard(path)
+        # still linked from the trash
+        self.dedup_store.gc()
+        self.assertNotEqual([], self.dedup_store._all_objects())
+        self.trash.empty()
+        self.assertEqual([], self.dedup_store._all_objects())
+
+    def test_empty_not_blocking(self):
+        lock = utils.PathLock(os.path.join(self.trash.root, '.lock'))
+        with lock:
+            self.assertIsNone(self.trash.empty(blocking=False))
+
+    def test_reaper(self):
+        path = os.path.join(self.plugins_dir, 'plugin')
+        _create_tree(path)
+        self.trash.discard(path)
+        reaper = trash.Reaper(self.trash)
+        reaper.start()
+        reaper.wake()
+        deadline = time.time() + 10
+        while self.trash.entries() and time.time() < deadline:
+            time.sleep(0.1)
+        self.assertEqual([], self.trash.entries())
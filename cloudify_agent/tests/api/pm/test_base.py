@@ -13,11 +13,17 @@
 #  * See the License for the specific language governing permissions and
 #  * limitations under the License.
 
+import os
+import time
 import getpass
-from mock import patch
+from mock import Mock, patch
+
+from cloudify_rest_client.node_instances import NodeInstance
+from cloudify_rest_client.responses import ListResponse
 
 from cloudify_agent.api.pm.base import Daemon
 from cloudify_agent.api import exceptions
+from cloudify_agent.api import utils
 
 from cloudify_agent.tests import BaseTest
 from cloudify_agent.tests import get_storage_directory
@@ -163,3 +169,223 @@ class TestNotImplemented(BaseTest):
 
     def test_delete(self):
         self.assertRaises(NotImplementedError, self.daemon.delete)
+
+
+class _StartableDaemon(Daemon):
+
+    def start_command(self):
+        return 'start'
+
+    def status(self):
+        return True
+
+
+@patch('cloudify_agent.api.utils.internal.get_storage_directory',
+       get_storage_directory)
+class TestDaemonStart(BaseTest):
+
+    def setUp(self):
+        super(TestDaemonStart, self).setUp()
+        self.daemon = _StartableDaemon(
+            rest_host='127.0.0.1',
+            broker_ip='127.0.0.1',
+            file_server_host='127.0.0.1',
+            queue='queue',
+            name='name-{0}'.format(os.path.basename(self.temp_folder)),
+            broker_user='guest',
+            broker_pass='guest',
+        )
+        self.ready_path = utils.get_daemon_ready_path(
+            get_storage_directory(), self.daemon.name)
+        self.addCleanup(self._remove_ready_file)
+
+    def _remove_ready_file(self):
+        if os.path.exists(self.ready_path):
+            os.remove(self.ready_path)
+
+    def test_start_ready(self):
+        with patch.object(self.daemon._runner, 'run',
+                          lambda _: utils.mark_daemon_ready(self.ready_path)):
+            with patch.object(self.daemon, '_is_agent_registered') \
+                    as is_agent_registered:
+                start = time.time()
+                self.daemon.start(interval=10, delete_amqp_queue=False)
+        self.assertLess(time.time() - start, 5)
+        self.assertFalse(is_agent_registered.called)
+
+    def test_start_stale_ready_file(self):
+        utils.mark_daemon_ready(self.ready_path)
+        with patch.object(self.daemon._runner, 'run'):
+            with patch.object(self.daemon, '_is_agent_registered',
+                              return_value=False):
+                self.assertRaises(exceptions.DaemonStartupTimeout,
+                                  self.daemon.start,
+                                  interval=0.1,
+                                  timeout=0.3,
+                                  delete_amqp_queue=False)
+
+    def test_start_fallback(self):
+        with patch.object(self.daemon._runner, 'run'):
+            with patch.object(self.daemon, '_is_agent_registered',
+                              return_value=True) as is_agent_registered:
+                self.daemon.start(interval=0.1, delete_amqp_queue=False)
+        self.assertTrue(is_agent_registered.called)
+
+
+@patch('cloudify_agent.api.utils.internal.get_storage_directory',
+       get_storage_directory)
+class TestDaemonBrokerConnection(BaseTest):
+
+    def test_restart_shares_connection(self):
+        daemon = _StartableDaemon(
+            rest_host='127.0.0.1',
+            broker_ip='127.0.0.1',
+            file_server_host='127.0.0.1',
+            queue='queue',
+            name='name',
+            broker_user='guest',
+            broker_pass='guest',
+        )
+        daemon.stop_command = lambda: 'stop'
+        state = {'running': True}
+        daemon.status = lambda: state['running']
+        connections = []
+
+        def run(command):
+            state['running'] = command == 'start'
+
+        def get_agent_registered(*args, **kwargs):
+            return set(['task']) if state['running'] else None
+
+        with patch.object(daemon._runner, 'run', run):
+            with patch('cloudify_agent.api.utils.get_celery_client') \
+                    as get_celery_client:
+                get_celery_client.return_value.connection.side_effect = \
+                    lambda: connections.append(object()) or Mock()
+                with patch('cloudify_agent.api.utils.get_agent_registered',
+                           get_agent_registered):
+                    daemon.restart(start_interval=0.1)
+        self.assertEqual(1, len(connections))
+
+    def test_stop_deferred_queues_deletion(self):
+        daemon = _StartableDaemon(
+            rest_host='127.0.0.1',
+            broker_ip='127.0.0.1',
+            file_server_host='127.0.0.1',
+            queue='queue',
+            name='name',
+            broker_user='guest',
+            broker_pass='guest',
+        )
+        daemon.stop_command = lambda: 'stop'
+        daemon.status = lambda: False
+        self.assertEqual(['queue', 'celery@name.celery.pidbox'],
+                         daemon.amqp_queues())
+        daemon.defer_amqp_queues_deletion()
+        with patch.object(daemon._runner, 'run'):
+            with patch('cloudify_agent.api.utils.get_celery_client') \
+                    as get_celery_client:
+                with patch('cloudify_agent.api.utils.get_agent_registered',
+                           return_value=None):
+                    daemon.stop(interval=0.1)
+        connection = get_celery_client.return_value.connection.return_value
+        self.assertFalse(connection.channel.called)
+
+
+class _StubNodeInstances(object):
+
+    def __init__(self, node_instances):
+        self.node_instances = node_instances
+        self.list_calls = 0
+        self.get_calls = 0
+
+    def list(self, deployment_id, _include, _offset, _size):
+        self.list_calls += 1
+        items = [node_instance for node_instance in self.node_instances
+                 if node_instance['deployment_id'] == deployment_id]
+        return ListResponse(
+            [NodeInstance(dict((field, item[field]) for field in _include))
+             for item in items[_offset:_offset + _size]],
+            {'pagination': {'offset': _offset,
+                            'size': _size,
+                            'total': len(items)}})
+
+    def get(self, node_instance_id, _include):
+        self.get_calls += 1
+        for node_instance in self.node_instances:
+            if node_instance['id'] == node_instance_id:
+                return NodeInstance(node_instance)
+
+
+class _StubClient(object):
+
+    def __init__(self, node_instances):
+        self.node_instances = _StubNodeInstances(node_instances)
+
+
+def _node_instance(node_instance_id, ip, host_id=None):
+    return {
+        'id': node_instance_id,
+        'host_id': host_id or node_instance_id,
+        'deployment_id': 'dep',
+        'runtime_properties': {
+            'ip': ip,
+            'cloudify_agent': {'name': '{0}-agent'.format(node_instance_id),
+                               'queue': '{0}-queue'.format(node_instance_id)}
+        }
+    }
+
+
+@patch('cloudify_agent.api.utils.internal.get_storage_directory',
+       get_storage_directory)
+@patch('cloudify_agent.api.pm.base.NODE_INSTANCES_PAGE_SIZE', 2)
+class TestDaemonRuntimeProperties(BaseTest):
+
+    def setUp(self):
+        super(TestDaemonRuntimeProperties, self).setUp()
+        self.client = _StubClient(
+            [_node_instance('vm_{0}'.format(i), '10.0.0.{0}'.format(i))
+             for i in range(4)] +
+            [_node_instance('app_1', '10.0.0.1', host_id='vm_1')])
+        client_patch = patch('cloudify_agent.api.utils.get_rest_client',
+                             return_value=self.client)
+        client_patch.start()
+        self.addCleanup(client_patch.stop)
+
+    def _daemon(self, **params):
+        return Daemon(
+            rest_host='127.0.0.1',
+            broker_ip='127.0.0.1',
+            file_server_host='127.0.0.1',
+            deployment_id='dep',
+            broker_user='guest',
+            broker_pass='guest',
+            **params
+        )
+
+    def test_lookup_by_ip(self):
+        daemon = self._daemon(host='10.0.0.1')
+        self.assertEqual('vm_1-agent', daemon.name)
+        self.assertEqual('vm_1-queue', daemon.queue)
+        # 5 node instances in pages of 2, listed once for both
+        self.assertEqual(3, self.client.node_instances.list_calls)
+
+    def test_lookup_by_host_id(self):
+        daemon = self._daemon(host_id='vm_2')
+        self.assertEqual('vm_2-agent', daemon.name)
+        self.assertEqual('vm_2-queue', daemon.queue)
+        self.assertEqual(1, self.client.node_instances.get_calls)
+        self.assertEqual(0, self.client.node_instances.list_calls)
+
+    def test_lookup_not_found(self):
+        self.assertRaises(exceptions.DaemonConfigurationError,
+                          self._daemon, host='10.0.0.9')
+
+    def test_lookup_multiple_found(self):
+        self.client.node_instances.node_instances.append(
+            _node_instance('vm_4', '10.0.0.1'))
+        try:
+            self._daemon(host='10.0.0.1')
+            self.fail('Expected DaemonConfigurationError')
+        except exceptions.DaemonConfigurationError as e:
+            self.assertIn('vm_1,vm_4', str(e))
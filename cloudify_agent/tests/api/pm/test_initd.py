@@ -16,14 +16,17 @@
 import os
 import nose.tools
 import time
+import subprocess
 from mock import patch
 
+from cloudify_agent.api.pm import initd
 from cloudify_agent.api.pm.initd import GenericLinuxDaemon
 
 from cloudify_agent.tests.api.pm import BaseDaemonProcessManagementTest
 from cloudify_agent.tests.api.pm import patch_unless_ci
 from cloudify_agent.tests.api.pm import only_ci
 from cloudify_agent.tests.api.pm import only_os
+from cloudify_agent.tests import BaseTest
 from cloudify_agent.tests import get_storage_directory
 
 
@@ -113,3 +116,90 @@ class TestGenericLinuxDaemon(BaseDaemonProcessManagementTest):
         # sleep the cron delay time and make sure the daemon is still dead
         time.sleep(daemon.cron_respawn_delay * 60 + 5)
         self.assert_daemon_dead(daemon.name)
+
+
+@patch('cloudify_agent.api.utils.internal.get_storage_directory',
+       get_storage_directory)
+@only_os('posix')
+class TestGenericLinuxDaemonStaging(BaseTest):
+
+    def setUp(self):
+        super(TestGenericLinuxDaemonStaging, self).setUp()
+        self.commands = []
+        etc = os.path.join(self.temp_folder, 'etc')
+        for name, directory in [('SCRIPT_DIR', 'init.d'),
+                                ('CONFIG_DIR', 'default')]:
+            dir_patch = patch.object(GenericLinuxDaemon, name,
+                                     os.path.join(etc, directory))
+            dir_patch.start()
+            self.addCleanup(dir_patch.stop)
+
+    def _run(self, command, **_):
+        # privileged commands are run as the current user
+        self.commands.append(command)
+        if command.startswith('sudo '):
+            command = command[len('sudo '):]
+        subprocess.check_call(command, shell=True)
+
+    def _create_daemon(self, **params):
+        daemon = GenericLinuxDaemon(
+            rest_host='127.0.0.1',
+            broker_ip='127.0.0.1',
+            file_server_host='127.0.0.1',
+            workdir=self.temp_folder,
+            name='agent',
+            queue='agent-queue',
+            **params)
+        daemon._runner.run = self._run
+        return daemon
+
+    def _sudo_commands(self):
+        return [command for command in self.commands
+                if command.startswith('sudo ')]
+
+    def test_configure(self):
+        daemon = self._create_daemon(start_on_boot=False)
+        daemon.configure()
+        self.assertEqual(1, len(self._sudo_commands()))
+        self.assertTrue(os.access(daemon.script_path, os.X_OK))
+        self.assertTrue(os.path.isfile(daemon.config_path))
+        staging_script = self._sudo_commands()[0].split()[-1]
+        self.assertFalse(os.path.exists(staging_script))
+
+        self.commands = []
+        daemon.create_script()
+        self.assertEqual(1, len(self._sudo_commands()))
+
+        self.commands = []
+        with patch.object(daemon, '_is_agent_registered',
+                          return_value=False):
+            daemon.delete()
+        self.assertEqual(1, len(self._sudo_commands()))
+        self.assertFalse(os.path.exists(daemon.script_path))
+        self.assertFalse(os.path.exists(daemon.config_path))
+
+    @patch('cloudify_agent.api.pm.initd._distro', 'debian')
+    def test_configure_start_on_boot(self):
+        daemon = self._create_daemon(start_on_boot=True)
+        scripts = []
+
+        def run(command, **_):
+            self.commands.append(command)
+            if command.startswith('sudo '):
+                with open(command.split()[-1]) as f:
+                    scripts.append(f.read())
+        daemon._runner.run = run
+        daemon.configure()
+        self.assertEqual(1, len(self._sudo_commands()))
+        self.assertIn('update-rc.d celeryd-agent defaults', scripts[0])
+        self.assertIn('cp ', scripts[0])
+
+    def test_distro_cached(self):
+        self.addCleanup(setattr, initd, '_distro', initd._distro)
+        initd._distro = None
+        with patch('cloudify_agent.api.pm.initd.find_executable',
+                   side_effect=lambda name: name == 'rpm') as find:
+            for name in ['first', 'second']:
+                handler = initd._StartOnBootHandler(name, runner=None)
+                self.assertEqual('rpm', handler.distro)
+        self.assertEqual(2, find.call_count)
@@ -0,0 +1,205 @@
+#########
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import os
+import socket
+import subprocess
+
+from mock import patch
+
+from cloudify.exceptions import CommandExecutionException
+
+from cloudify_agent import app
+from cloudify_agent.api import utils
+from cloudify_agent.api.factory import DaemonFactory
+from cloudify_agent.api.pm.systemd import SystemDDaemon
+
+from cloudify_agent.tests import BaseTest
+from cloudify_agent.tests import get_storage_directory
+from cloudify_agent.tests.api.pm import only_os
+
+# records its arguments, and reports the service active while a marker
+# file exists
+FAKE_SYSTEMCTL = '''#!/bin/sh
+echo "$@" >> {log}
+case "$1" in
+    start) touch {active} ;;
+    stop) rm -f {active} ;;
+    is-active) test -f {active} ;;
+esac
+'''
+
+
+@patch('cloudify_agent.api.utils.internal.get_storage_directory',
+       get_storage_directory)
+@only_os('posix')
+class TestSystemDDaemon(BaseTest):
+
+    def setUp(self):
+        super(TestSystemDDaemon, self).setUp()
+        etc = os.path.join(self.temp_folder, 'etc')
+        self.systemctl_log = os.path.join(self.temp_folder, 'systemctl.log')
+        self.active = os.path.join(self.temp_folder, 'active')
+        systemctl = os.path.join(self.temp_folder, 'systemctl')
+        with open(systemctl, 'w') as f:
+            f.write(FAKE_SYSTEMCTL.format(log=self.systemctl_log,
+                                          active=self.active))
+        os.chmod(systemctl, 0755)
+        for name, value in [('SCRIPT_DIR', os.path.join(etc, 'systemd')),
+                            ('CONFIG_DIR', os.path.join(etc, 'default')),
+                            ('SYSTEMCTL', systemctl)]:
+            attribute_patch = patch.object(SystemDDaemon, name, value)
+            attribute_patch.start()
+            self.addCleanup(attribute_patch.stop)
+        self.commands = []
+
+    def _run(self, command, **_):
+        # privileged commands are run as the current user
+        self.commands.append(command)
+        if command.startswith('sudo '):
+            command = command[len('sudo '):]
+        code = subprocess.call(command, shell=True)
+        if code != 0:
+            raise CommandExecutionException(command, '', '', code)
+
+    def _create_daemon(self, **params):
+        daemon = SystemDDaemon(
+            rest_host='127.0.0.1',
+            broker_ip='127.0.0.1',
+            file_server_host='127.0.0.1',
+            workdir=self.temp_folder,
+            name='agent',
+            queue='agent-queue',
+            **params)
+        daemon._runner.run = self._run
+        return daemon
+
+    def _systemctl_calls(self):
+        if not os.path.exists(self.systemctl_log):
+            return []
+        with open(self.systemctl_log) as f:
+            return f.read().splitlines()
+
+    def test_configure(self):
+        daemon = self._create_daemon(restart='always',
+                                     cpu_quota='50%',
+                                     memory_max='1G')
+        daemon.configure()
+        self.assertEqual(1, len([command for command in self.commands
+                                 if command.startswith('sudo ')]))
+        self.assertEqual(['daemon-reload',
+                          'enable cloudify-worker-agent'],
+                         self._systemctl_calls())
+        with open(daemon.script_path) as f:
+            unit = f.read()
+        self.assertIn('Type=notify', unit)
+        self.assertIn('Restart=always', unit)
+        self.assertIn('CPUQuota=50%', unit)
+        self.assertIn('MemoryMax=1G', unit)
+        self.assertIn('EnvironmentFile={0}'.format(daemon.config_path), unit)
+        self.assertIn('--hostname=agent', unit)
+        self.assertNotIn('--detach', unit)
+        with open(daemon.config_path) as f:
+            self.assertIn('CLOUDIFY_DAEMON_NAME=agent', f.read())
+
+    def test_configure_without_limits(self):
+        daemon = self._create_daemon(start_on_boot=False)
+        daemon.configure()
+        self.assertEqual(['daemon-reload'], self._systemctl_calls())
+        with open(daemon.script_path) as f:
+            unit = f.read()
+        self.assertIn('Restart=on-failure', unit)
+        self.assertNotIn('CPUQuota', unit)
+        self.assertNotIn('MemoryMax', unit)
+
+    def test_configure_extra_env(self):
+        extra_env_path = utils.env_to_file(
+            env_variables={'EXTRA_KEY': 'extra value'},
+            destination_path=os.path.join(self.temp_folder, 'extra.env'))
+        daemon = self._create_daemon(extra_env_path=extra_env_path)
+        daemon.configure()
+        with open(daemon.script_path) as f:
+            self.assertNotIn(extra_env_path, f.read())
+        with open(daemon.config_path) as f:
+            config = f.read().splitlines()
+        self.assertIn('EXTRA_KEY=extra value', config)
+        self.assertFalse([line for line in config
+                          if line.startswith('export ') or
+                          line.startswith('#!')])
+
+    def test_status(self):
+        daemon = self._create_daemon()
+        daemon.configure()
+        # no pid file, so the worker is not running
+        self.assertFalse(daemon.status())
+        with patch('cloudify_agent.api.utils.probe_process',
+                   return_value=None):
+            self.assertFalse(daemon.status())
+            self._run(daemon.start_command())
+            self.assertTrue(daemon.status())
+            self._run(daemon.stop_command())
+            self.assertFalse(daemon.status())
+
+    def test_delete(self):
+        daemon = self._create_daemon()
+        daemon.configure()
+        os.remove(self.systemctl_log)
+        with patch.object(daemon, '_is_agent_registered',
+                          return_value=False):
+            daemon.delete()
+        self.assertFalse(os.path.exists(daemon.script_path))
+        self.assertFalse(os.path.exists(daemon.config_path))
+        self.assertEqual(['disable cloudify-worker-agent', 'daemon-reload'],
+                         self._systemctl_calls())
+
+    def test_factory(self):
+        daemon = DaemonFactory(storage=self.temp_folder).new(
+            logger=self.logger,
+            process_management='systemd',
+            rest_host='127.0.0.1',
+            broker_ip='127.0.0.1',
+            file_server_host='127.0.0.1',
+            name='agent',
+            queue='agent-queue',
+            memory_max='1G')
+        self.assertIsInstance(daemon, SystemDDaemon)
+        self.assertEqual('1G', daemon.memory_max)
+
+
+@only_os('posix')
+class TestNotify(BaseTest):
+
+    def setUp(self):
+        super(TestNotify, self).setUp()
+        # stands in for the systemd notification socket
+        self.socket_path = os.path.join(self.temp_folder, 'notify')
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(self.socket_path)
+        self.socket.settimeout(5)
+        self.addCleanup(self.socket.close)
+
+    def test_not_run_by_systemd(self):
+        with patch.dict(os.environ):
+            os.environ.pop('NOTIFY_SOCKET', None)
+            self.assertFalse(utils.sd_notify('READY=1'))
+
+    def test_worker_ready(self):
+        with patch.dict(os.environ, {'NOTIFY_SOCKET': self.socket_path}):
+            app.notify_ready(sender=None)
+            self.assertEqual(
+                'READY=1\nMAINPID={0}'.format(os.getpid()),
+                self.socket.recv(1024))
+            app.notify_stopping(sender=None)
+            self.assertEqual('STOPPING=1', self.socket.recv(1024))
@@ -16,6 +16,10 @@
 import uuid
 import os
 import shutil
+import tempfile
+import traceback
+import multiprocessing
+from mock import patch
 
 from cloudify_agent.api import exceptions
 from cloudify_agent.api import utils
@@ -24,6 +28,31 @@ from cloudify_agent.tests.shell import BaseShellTest
 from cloudify_agent.tests import get_storage_directory
 
 
+STRESS_ITERATIONS = 50
+
+
+def _stress_save(storage, name, errors):
+    try:
+        factory = DaemonFactory(storage=storage)
+        daemon = factory.load(name)
+        for i in range(STRESS_ITERATIONS):
+            daemon.queue = 'queue-{0}-{1}'.format(os.getpid(), i)
+            factory.save(daemon)
+    except BaseException:
+        errors.put(traceback.format_exc())
+
+
+def _stress_load(storage, name, errors):
+    try:
+        factory = DaemonFactory(storage=storage)
+        for _ in range(STRESS_ITERATIONS):
+            factory.load(name)
+            if name not in [daemon.name for daemon in factory.load_all()]:
+                raise AssertionError('{0} not loaded'.format(name))
+    except BaseException:
+        errors.put(traceback.format_exc())
+
+
 class TestDaemonFactory(BaseShellTest):
 
     def setUp(self):
@@ -134,3 +163,109 @@ class TestDaemonFactory(BaseShellTest):
                           file_server_host='127.0.0.1',
                           user='user',
                           broker_url='127.0.0.1')
+
+    def _new_daemon(self, name):
+        return self.factory.new(
+            process_management='init.d',
+            name=name,
+            queue='queue',
+            rest_host='127.0.0.1',
+            broker_ip='127.0.0.1',
+            file_server_host='127.0.0.1',
+            user='user',
+            broker_url='127.0.0.1')
+
+    def test_names(self):
+        self.factory.save(self._new_daemon(self.daemon_name))
+        with patch.object(DaemonFactory, 'load') as load:
+            self.assertIn(self.daemon_name, self.factory.names())
+            self.assertTrue(self.factory.exists(self.daemon_name))
+        self.assertFalse(load.called)
+        self.factory.delete(self.daemon_name)
+        self.assertNotIn(self.daemon_name, self.factory.names())
+        self.assertFalse(self.factory.exists(self.daemon_name))
+
+    def test_index_reconciled(self):
+        # e.g. a daemon saved by an agent version not maintaining the index
+        self.factory.save(self._new_daemon(self.daemon_name))
+        daemon_path = os.path.join(get_storage_directory(),
+                                   '{0}.json'.format(self.daemon_name))
+        other_path = os.path.join(get_storage_directory(),
+                                  '{0}-other.json'.format(self.daemon_name))
+        shutil.copy(daemon_path, other_path)
+        os.remove(daemon_path)
+        names = self.factory.names()
+        self.assertNotIn(self.daemon_name, names)
+        self.assertIn('{0}-other'.format(self.daemon_name), names)
+        self.factory.delete('{0}-other'.format(self.daemon_name))
+
+    def test_index_not_rewritten_when_ready(self):
+        self.factory.save(self._new_daemon(self.daemon_name))
+        self.addCleanup(self.factory.delete, self.daemon_name)
+        ready_path = utils.get_daemon_ready_path(get_storage_directory(),
+                                                 self.daemon_name)
+        utils.mark_daemon_ready(ready_path)
+        self.addCleanup(os.remove, ready_path)
+        with patch.object(DaemonFactory, '_update_index') as update_index:
+            self.assertIn(self.daemon_name, self.factory.names())
+        self.assertFalse(update_index.called)
+
+    def test_index_read_only(self):
+        self.factory.save(self._new_daemon(self.daemon_name))
+        self.addCleanup(self.factory.delete, self.daemon_name)
+        daemon_path = os.path.join(get_storage_directory(),
+                                   '{0}.json'.format(self.daemon_name))
+        other_path = os.path.join(get_storage_directory(),
+                                  '{0}-other.json'.format(self.daemon_name))
+        shutil.copy(daemon_path, other_path)
+        self.addCleanup(os.remove, other_path)
+        # e.g. the storage directory of another user
+        with patch('cloudify_agent.api.utils.PathLock.acquire',
+                   side_effect=IOError(13, 'Permission denied')):
+            names = self.factory.names()
+        self.assertIn(self.daemon_name, names)
+        self.assertIn('{0}-other'.format(self.daemon_name), names)
+
+    def test_load_all_lazy(self):
+        self.factory.save(self._new_daemon(self.daemon_name))
+        with patch.object(DaemonFactory, 'load',
+                          wraps=self.factory.load) as load:
+            daemons = dict((daemon.name, daemon) for daemon in
+                           self.factory.load_all(lazy=True))
+            daemon = daemons[self.daemon_name]
+            self.assertFalse(load.called)
+            self.assertEqual('queue', daemon.queue)
+            daemon.queue = 'other'
+            self.assertEqual('other', daemon.queue)
+        self.assertEqual(1, load.call_count)
+        self.factory.delete(self.daemon_name)
+
+    def test_concurrent_save_load(self):
+        storage = tempfile.mkdtemp(prefix='cfy-agent-tests-storage-')
+        self.addCleanup(shutil.rmtree, storage, ignore_errors=True)
+        factory = DaemonFactory(storage=storage)
+        daemon = factory.new(
+            process_management='init.d',
+            name=self.daemon_name,
+            queue='queue',
+            rest_host='127.0.0.1',
+            broker_ip='127.0.0.1',
+            file_server_host='127.0.0.1',
+            user='user',
+            workdir=self.temp_folder)
+        factory.save(daemon)
+        errors = multiprocessing.Queue()
+        processes = [multiprocessing.Process(
+            target=target, args=(storage, self.daemon_name, errors))
+            for target in [_stress_save, _stress_load] * 4]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        failures = []
+        while not errors.empty():
+            failures.append(errors.get())
+        self.assertEqual([], failures)
+        self.assertEqual([self.daemon_name], factory.names())
+        self.assertEqual([], [name for name in os.listdir(storage)
+                              if name.endswith('.tmp')])
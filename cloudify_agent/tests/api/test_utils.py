@@ -14,7 +14,13 @@
 #  * limitations under the License.
 
 import os
+import time
+import socket
 import tempfile
+import threading
+
+from mock import Mock, call, patch
+from amqp.exceptions import ChannelError
 
 from cloudify.utils import setup_logger
 
@@ -25,6 +31,7 @@ from cloudify_agent.api.pm.base import Daemon
 
 from cloudify_agent.tests import utils as test_utils
 from cloudify_agent.tests import BaseTest
+from cloudify_agent.tests.api.pm import only_os
 
 
 class TestUtils(BaseTest):
@@ -103,3 +110,162 @@ class TestUtils(BaseTest):
     def test_generate_agent_name(self):
         name = utils.internal.generate_agent_name()
         self.assertIn(defaults.CLOUDIFY_AGENT_PREFIX, name)
+
+    def test_path_lock_exclusive_across_threads(self):
+        lock_path = os.path.join(self.temp_folder, 'path.lock')
+        holders = []
+        overlaps = []
+
+        def hold():
+            with utils.PathLock(lock_path):
+                holders.append(threading.current_thread())
+                if len(holders) > 1:
+                    overlaps.append(list(holders))
+                time.sleep(0.05)
+                holders.remove(threading.current_thread())
+
+        threads = [threading.Thread(target=hold) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], overlaps)
+
+    def test_daemon_ready(self):
+        path = utils.get_daemon_ready_path(
+            os.path.join(self.temp_folder, 'storage'), 'agent')
+        self.assertIsNone(utils.read_daemon_ready(path))
+        utils.mark_daemon_ready(path)
+        self.assertEqual(os.getpid(), utils.read_daemon_ready(path))
+        utils.mark_daemon_ready(path)
+        self.assertEqual(['agent.ready'],
+                         os.listdir(os.path.dirname(path)))
+
+    @only_os('posix')
+    def test_probe_process(self):
+        pid_file = os.path.join(self.temp_folder, 'agent.pid')
+        self.assertFalse(utils.probe_process(pid_file, 'agent'))
+        with open(pid_file, 'w') as f:
+            f.write(str(os.getpid()))
+        with open('/proc/self/cmdline') as f:
+            name = f.read().split('\0')[0]
+        self.assertTrue(utils.probe_process(pid_file, name))
+        self.assertFalse(utils.probe_process(pid_file, 'not-the-agent'))
+        # arguments are matched exactly
+        self.assertFalse(utils.probe_process(pid_file, name[:-1]))
+        # the pid was reused by a process started after the pid file was
+        # written
+        os.utime(pid_file, (0, 0))
+        self.assertFalse(utils.probe_process(pid_file, name))
+        with open(pid_file, 'w') as f:
+            f.write('invalid')
+        self.assertIsNone(utils.probe_process(pid_file, name))
+
+    def test_probe_process_without_proc(self):
+        pid_file = os.path.join(self.temp_folder, 'agent.pid')
+        with open(pid_file, 'w') as f:
+            f.write(str(os.getpid()))
+        self.assertIsNone(utils.probe_process(
+            pid_file, 'agent', proc=os.path.join(self.temp_folder, 'proc')))
+
+
+class TestBrokerConnection(BaseTest):
+
+    def setUp(self):
+        super(TestBrokerConnection, self).setUp()
+        self.celery_client = Mock()
+        self.celery_client.connection.side_effect = self._connection
+        self.connections = []
+        celery_client_patch = patch(
+            'cloudify_agent.api.utils.get_celery_client',
+            return_value=self.celery_client)
+        celery_client_patch.start()
+        self.addCleanup(celery_client_patch.stop)
+        self.broker = utils.BrokerConnection('amqp://')
+
+    def _connection(self):
+        connection = Mock()
+        connection.connection_errors = (socket.error,)
+        connection.channel_errors = (ChannelError,)
+        self.connections.append(connection)
+        return connection
+
+    def test_shared(self):
+        with self.broker:
+            with self.broker:
+                self.broker.delete_queues(['queue'])
+            self.broker.delete_queues(['queue'])
+            self.assertFalse(self.connections[0].release.called)
+        self.assertEqual(1, len(self.connections))
+        self.connections[0].release.assert_called_once_with()
+        self.celery_client.close.assert_called_once_with()
+
+    def test_closed_when_not_held(self):
+        self.broker.delete_queues(['queue'])
+        self.broker.delete_queues(['queue'])
+        self.assertEqual(2, len(self.connections))
+        for connection in self.connections:
+            connection.release.assert_called_once_with()
+
+    def test_reconnect(self):
+        with self.broker:
+            self.broker._connect().channel().queue_delete.side_effect \
+                = socket.error('connection reset')
+            self.broker.delete_queues(['queue'])
+            self.assertEqual(2, len(self.connections))
+            self.connections[0].release.assert_called_once_with()
+            self.connections[1].channel().queue_delete \
+                .assert_called_once_with('queue')
+
+    def test_delete_queues_pipelined(self):
+        results = self.broker.delete_queues(['q1', 'q2', 'q1', 'q3', 'q4'],
+                                            batch_size=2)
+        self.assertEqual([('q1', None), ('q2', None), ('q3', None),
+                          ('q4', None)], list(results.items()))
+        queue_delete = self.connections[0].channel().queue_delete
+        self.assertEqual([call('q1', nowait=True), call('q2'),
+                          call('q3', nowait=True), call('q4')],
+                         queue_delete.call_args_list)
+
+    def test_delete_queues_failure(self):
+        error = ChannelError('access refused')
+        pending = []
+
+        def queue_delete(queue, nowait=False):
+            # a refused pipelined deletion is only reported once the
+            # channel is waited for
+            if queue == 'q2':
+                pending.append(error)
+            if pending and not nowait:
+                raise pending.pop()
+        connection = self._connection()
+        connection.channel().queue_delete.side_effect = queue_delete
+        self.celery_client.connection.side_effect = None
+        self.celery_client.connection.return_value = connection
+        results = self.broker.delete_queues(['q1', 'q2', 'q3'])
+        self.assertEqual([('q1', None), ('q2', error), ('q3', None)],
+                         list(results.items()))
+        self.assertEqual(4, connection.channel().close.call_count)
+
+    def test_delete_daemons_queues(self):
+        daemons = []
+        for name, broker_url in [('d1', 'amqp://b1'), ('d2', 'amqp://b2'),
+                                 ('d3', 'amqp://b1')]:
+            daemon = Mock(broker_url=broker_url,
+                          broker_ssl_enabled=False,
+                          broker_ssl_cert_path=None)
+            daemon.amqp_queues.return_value = [name]
+            daemons.append(daemon)
+        with patch('cloudify_agent.api.utils.BrokerConnection') as broker:
+            broker.return_value.__enter__.return_value \
+                .delete_queues.side_effect = \
+                lambda queues: dict((queue, None) for queue in queues)
+            results = utils.delete_daemons_queues(daemons)
+        self.assertEqual({'d1': None, 'd2': None, 'd3': None}, results)
+        self.assertEqual([call('amqp://b1', False, None),
+                          call('amqp://b2', False, None)],
+                         broker.call_args_list)
+        delete_queues = broker.return_value.__enter__.return_value \
+            .delete_queues
+        self.assertEqual([call(['d1', 'd3']), call(['d2'])],
+                         delete_queues.call_args_list)
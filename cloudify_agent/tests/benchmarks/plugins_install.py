@@ -0,0 +1,406 @@
+#########
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+Benchmarks of the plugin installation pipeline.
+
+Managed (wagon) and source plugins are installed against in-process
+stand-ins for the manager REST API and file server, and the time spent
+in every phase of `PluginInstaller.install` is reported over a number of
+runs, as collected by the installer instrumentation hook. Source archives
+are extracted while being downloaded, so for source plugins the
+extraction time is part of the download phase. Wagons are extracted by
+wagon itself, so for managed plugins it is part of the pip install phase.
+
+Usage:
+
+    python -m cloudify_agent.tests.benchmarks.plugins_install \\
+        --runs 10 --output results.json --baseline previous-results.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import platform
+import tempfile
+import contextlib
+import collections
+
+import click
+from wagon import wagon
+from wagon import utils as wagon_utils
+
+from cloudify import constants
+from cloudify.utils import setup_logger
+
+from cloudify_agent.api import utils
+from cloudify_agent.api.plugins import constraints
+from cloudify_agent.api.plugins import installer
+from cloudify_agent.api.plugins import instrumentation
+
+from cloudify_agent.tests import utils as test_utils
+
+PLUGIN_DIR_NAME = 'mock-plugin'
+PLUGIN_NAME = 'plugin'
+MANAGED = 'managed'
+SOURCE = 'source'
+KINDS = (MANAGED, SOURCE)
+
+PHASES = ('freeze',
+          'rest_lookup',
+          'download',
+          'name_extraction',
+          'pip_install',
+          'wheel_build',
+          'move',
+          'dedup',
+          'total')
+
+PERCENTILES = (50, 90, 99)
+
+# a phase is considered to have regressed when its median grew by more
+# than this ratio, and by more than the minimal difference (in seconds)
+REGRESSION_RATIO = 0.2
+REGRESSION_MIN_DIFF = 0.05
+
+REST_API_PATH = '/api/v2.1'
+
+
+class PhaseTimings(instrumentation.Instrumentation):
+
+    """
+    An instrumentation hook, accumulating the time spent in every phase
+    per run.
+    """
+
+    enabled = True
+
+    def __init__(self):
+        super(PhaseTimings, self).__init__()
+        self.runs = []
+        self._current = None
+
+    @contextlib.contextmanager
+    def run(self):
+        self._current = collections.defaultdict(float)
+        self._current['events'] = []
+        start = time.time()
+        try:
+            yield
+        finally:
+            self._current['total'] = time.time() - start
+            self.runs.append(dict(self._current))
+            self._current = None
+
+    def emit(self, event):
+        if self._current is None:
+            return
+        self._current['events'].append(event)
+        # the whole installation is timed by the run itself
+        if event['phase'] != 'install':
+            self._current[event['phase']] += event['duration']
+
+    def summary(self):
+        return dict((phase, summarize([run.get(phase, 0.0)
+                                       for run in self.runs]))
+                    for phase in PHASES)
+
+
+def percentile(values, percent):
+
+    """
+    The percentile of a list of values, interpolating between the closest
+    ranks.
+    """
+
+    if not values:
+        return None
+    values = sorted(values)
+    rank = (len(values) - 1) * percent / 100.0
+    lower = int(rank)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+
+def summarize(values):
+    if not values:
+        return {}
+    result = {
+        'min': min(values),
+        'max': max(values),
+        'mean': sum(values) / len(values)
+    }
+    for percent in PERCENTILES:
+        result['p{0}'.format(percent)] = percentile(values, percent)
+    return result
+
+
+def compare(results, baseline):
+
+    """
+    Compare the median phase timings of two benchmark results.
+
+    :return: a list of (kind, phase, baseline median, median, regressed)
+             tuples.
+    """
+
+    comparison = []
+    for kind, result in sorted(results['results'].items()):
+        baseline_result = baseline.get('results', {}).get(kind)
+        if not baseline_result:
+            continue
+        for phase in PHASES:
+            median = result['summary'].get(phase, {}).get('p50')
+            baseline_median = baseline_result['summary'].get(
+                phase, {}).get('p50')
+            if median is None or baseline_median is None:
+                continue
+            diff = median - baseline_median
+            regressed = (diff > REGRESSION_MIN_DIFF and
+                         diff > baseline_median * REGRESSION_RATIO)
+            comparison.append(
+                (kind, phase, baseline_median, median, regressed))
+    return comparison
+
+
+class ManagerStandIn(object):
+
+    """
+    Stand-ins for the manager REST API and file server, serving a single
+    plugin both as a managed plugin wagon and as a source archive.
+    """
+
+    def __init__(self, work_dir):
+        self.work_dir = work_dir
+        self.server = test_utils.HTTPServerStandIn()
+        self.managed_plugin = None
+
+    def start(self):
+        tar_name = test_utils.create_plugin_tar(PLUGIN_DIR_NAME,
+                                                self.work_dir)
+        wagon_path = test_utils.create_plugin_wagon(PLUGIN_DIR_NAME,
+                                                    self.work_dir)
+        wagon_metadata = wagon.Wagon(wagon_path).get_metadata_from_archive()
+        self.managed_plugin = {
+            'id': 'benchmark-{0}'.format(os.getpid()),
+            'package_name': wagon_metadata['package_name'],
+            'package_version': wagon_metadata['package_version'],
+            'supported_platform': 'any'
+        }
+        with open(os.path.join(self.work_dir, tar_name), 'rb') as f:
+            self.server.files['/{0}'.format(tar_name)] = f.read()
+        with open(wagon_path, 'rb') as f:
+            self.server.files['{0}/plugins/{1}/archive'.format(
+                REST_API_PATH, self.managed_plugin['id'])] = f.read()
+        self.server.routes['{0}/plugins'.format(REST_API_PATH)] = \
+            self._list_plugins
+        self.server.start()
+        self.source_url = self.server.url(tar_name)
+
+    def stop(self):
+        self.server.stop()
+
+    def _list_plugins(self, params):
+        plugin = self.managed_plugin
+        items = [plugin] if (
+            params.get('package_name') == plugin['package_name'] and
+            params.get('package_version') == plugin['package_version']) \
+            else []
+        return {
+            'items': items,
+            'metadata': {'pagination': {'offset': 0,
+                                        'size': len(items),
+                                        'total': len(items)}}
+        }
+
+    @contextlib.contextmanager
+    def environment(self):
+        variables = {
+            constants.REST_HOST_KEY: 'localhost',
+            constants.REST_PORT_KEY: str(self.server.port),
+            constants.SECURITY_ENABLED_KEY: 'false'
+        }
+        original = dict((key, os.environ.get(key)) for key in variables)
+        os.environ.update(variables)
+        try:
+            yield
+        finally:
+            for key, value in original.items():
+                if value is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
+
+
+class PluginInstallBenchmark(object):
+
+    def __init__(self, runs=5, kinds=KINDS, warm=False, logger=None):
+
+        """
+        :param runs: the number of installations to run of every kind.
+        :param kinds: the kinds of plugins to install (managed, source).
+        :param warm: whether to keep the plugin caches between runs. By
+                     default, every run starts with empty caches.
+        :param logger: a logger to use.
+        """
+
+        self.runs = runs
+        self.kinds = kinds
+        self.warm = warm
+        self.logger = logger or setup_logger('cloudify_agent.benchmarks')
+
+    def run(self):
+        work_dir = tempfile.mkdtemp(prefix='plugins-benchmark-')
+        manager = ManagerStandIn(work_dir)
+        manager.start()
+        try:
+            with manager.environment():
+                results = dict((kind, self._run_kind(manager, kind,
+                                                     work_dir))
+                               for kind in self.kinds)
+        finally:
+            manager.stop()
+            shutil.rmtree(work_dir, ignore_errors=True)
+        return {
+            'created_at': time.time(),
+            'platform': wagon_utils.get_platform(),
+            'python': platform.python_version(),
+            'runs': self.runs,
+            'warm': self.warm,
+            'results': results
+        }
+
+    def _run_kind(self, manager, kind, work_dir):
+        timings = PhaseTimings()
+        cache_dir = None
+        for run in range(self.runs):
+            if cache_dir is None or not self.warm:
+                cache_dir = tempfile.mkdtemp(prefix='cache-', dir=work_dir)
+                constraints.invalidate()
+            plugin_installer = installer.PluginInstaller(
+                logger=self.logger, instrumentation_hook=timings)
+            if kind == MANAGED:
+                plugin = dict(manager.managed_plugin,
+                              name=PLUGIN_NAME,
+                              executor='host_agent')
+                deployment_id = None
+            else:
+                plugin = {'name': PLUGIN_NAME,
+                          'source': manager.source_url,
+                          'executor': 'host_agent'}
+                deployment_id = 'benchmark-{0}'.format(run)
+            with _cache_dir(cache_dir):
+                with timings.run():
+                    plugin_installer.install(plugin,
+                                             deployment_id=deployment_id)
+                if kind == MANAGED:
+                    plugin_installer.uninstall_wagon(
+                        plugin['package_name'], plugin['package_version'])
+                else:
+                    plugin_installer.uninstall(plugin,
+                                               deployment_id=deployment_id)
+            self.logger.info('{0} plugin installation {1}/{2}: {3:.3f} '
+                             'seconds'.format(kind, run + 1, self.runs,
+                                              timings.runs[-1]['total']))
+        return {'runs': timings.runs, 'summary': timings.summary()}
+
+
+@contextlib.contextmanager
+def _cache_dir(path):
+    key = utils.internal.CLOUDIFY_PLUGINS_CACHE_DIRECTORY_KEY
+    original = os.environ.get(key)
+    os.environ[key] = path
+    try:
+        yield
+    finally:
+        if original is None:
+            os.environ.pop(key, None)
+        else:
+            os.environ[key] = original
+
+
+def format_results(results):
+    lines = []
+    header = '{0:<10} {1:<16}'.format('kind', 'phase') + ''.join(
+        '{0:>10}'.format(name)
+        for name in ['min', 'p50', 'p90', 'p99', 'max'])
+    lines.append(header)
+    for kind, result in sorted(results['results'].items()):
+        for phase in PHASES:
+            summary = result['summary'][phase]
+            lines.append('{0:<10} {1:<16}'.format(kind, phase) + ''.join(
+                '{0:>10.3f}'.format(summary[name])
+                for name in ['min', 'p50', 'p90', 'p99', 'max']))
+    return '\n'.join(lines)
+
+
+def format_comparison(comparison):
+    lines = ['{0:<10} {1:<16}{2:>10}{3:>10}{4:>9}'.format(
+        'kind', 'phase', 'baseline', 'p50', 'change')]
+    for kind, phase, baseline_median, median, regressed in comparison:
+        change = ((median - baseline_median) / baseline_median * 100
+                  if baseline_median else 0.0)
+        lines.append('{0:<10} {1:<16}{2:>10.3f}{3:>10.3f}{4:>8.1f}%{5}'
+                     .format(kind, phase, baseline_median, median, change,
+                             ' REGRESSION' if regressed else ''))
+    return '\n'.join(lines)
+
+
+@click.command()
+@click.option('--runs',
+              help='The number of installations of every kind.',
+              type=int,
+              default=5)
+@click.option('--kind',
+              'kinds',
+              help='The kind of plugins to install, may be repeated. '
+                   'Defaults to all kinds.',
+              type=click.Choice(KINDS),
+              multiple=True)
+@click.option('--warm',
+              help='Keep the plugin caches between runs.',
+              is_flag=True,
+              default=False)
+@click.option('--output',
+              help='A path to save the results (JSON) to.')
+@click.option('--baseline',
+              help='A path to previously saved results, to compare with.',
+              type=click.Path(exists=True))
+def main(runs, kinds, warm, output, baseline):
+    logger = setup_logger('cloudify_agent.benchmarks',
+                          logger_level=logging.INFO)
+    benchmark = PluginInstallBenchmark(runs=runs,
+                                       kinds=kinds or KINDS,
+                                       warm=warm,
+                                       logger=logger)
+    results = benchmark.run()
+    click.echo(format_results(results))
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        click.echo('Results saved to {0}'.format(output))
+    if baseline:
+        with open(baseline) as f:
+            comparison = compare(results, json.load(f))
+        click.echo(format_comparison(comparison))
+        if any(regressed for _, _, _, _, regressed in comparison):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
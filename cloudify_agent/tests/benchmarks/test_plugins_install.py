@@ -0,0 +1,83 @@
+#########
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import time
+
+from cloudify_agent.tests import BaseTest
+from cloudify_agent.tests.benchmarks import plugins_install
+
+
+def _results(**medians):
+    return {'results': {'managed': {'summary': dict(
+        (phase, {'p50': median}) for phase, median in medians.items())}}}
+
+
+class PluginInstallBenchmarkTest(BaseTest):
+
+    def test_percentile(self):
+        values = [4, 1, 3, 2, 5]
+        self.assertEqual(3, plugins_install.percentile(values, 50))
+        self.assertEqual(1, plugins_install.percentile(values, 0))
+        self.assertEqual(5, plugins_install.percentile(values, 100))
+        self.assertAlmostEqual(4.6, plugins_install.percentile(values, 90))
+        self.assertIsNone(plugins_install.percentile([], 50))
+
+    def test_phase_timings(self):
+        timings = plugins_install.PhaseTimings()
+        with timings.phase('download'):
+            pass
+        self.assertEqual([], timings.runs)
+        with timings.run():
+            with timings.install(plugin='plugin'):
+                for _ in range(2):
+                    with timings.phase('download'):
+                        time.sleep(0.01)
+        self.assertEqual(1, len(timings.runs))
+        run = timings.runs[0]
+        self.assertGreaterEqual(run['download'], 0.02)
+        self.assertGreaterEqual(run['total'], run['download'])
+        self.assertEqual(['download', 'download', 'install'],
+                         [event['phase'] for event in run['events']])
+        summary = timings.summary()
+        self.assertEqual(set(plugins_install.PHASES), set(summary))
+        self.assertEqual(0, summary['move']['max'])
+
+    def test_compare(self):
+        comparison = plugins_install.compare(
+            _results(download=1.0, pip_install=1.0, move=0.01),
+            _results(download=0.5, pip_install=0.9, move=0.001))
+        regressions = dict((phase, regressed)
+                           for _, phase, _, _, regressed in comparison)
+        self.assertEqual({'download': True,
+                          'pip_install': False,
+                          'move': False}, regressions)
+
+    def test_managed_benchmark(self):
+        benchmark = plugins_install.PluginInstallBenchmark(
+            runs=1, kinds=[plugins_install.MANAGED], logger=self.logger)
+        results = benchmark.run()
+        result = results['results'][plugins_install.MANAGED]
+        self.assertEqual(1, len(result['runs']))
+        for phase in ['freeze', 'rest_lookup', 'download', 'pip_install',
+                      'move']:
+            self.assertGreater(result['summary'][phase]['p50'], 0, phase)
+        events = result['runs'][0]['events']
+        # whether the plugin is managed is known after the rest lookup
+        self.assertTrue(all(event['managed'] for event in events
+                            if event['phase'] != 'rest_lookup'))
+        download = [event for event in events
+                    if event['phase'] == 'download'][0]
+        self.assertFalse(download['cache_hit'])
+        self.assertGreater(download['bytes'], 0)
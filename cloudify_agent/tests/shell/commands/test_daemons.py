@@ -14,7 +14,7 @@
 #  * limitations under the License.
 
 import os
-from mock import patch
+from mock import ANY, Mock, patch
 
 import cloudify_agent.shell.env as env_constants
 from cloudify_agent.api import utils
@@ -198,6 +198,102 @@ class TestPatchedDaemonCommandLine(BaseCommandLineTestCase):
         daemon = factory_load.return_value
         daemon.restart.assert_called_once_with()
 
+    def _daemons(self, names):
+        daemons = []
+        for name in names:
+            daemon = Mock()
+            daemon.name = name
+            daemons.append(daemon)
+        return daemons
+
+    def test_start_all(self, *factory_methods):
+        factory_load_all = factory_methods[0]
+        factory_load_all.return_value = self._daemons(['name1', 'name2'])
+        with patch('click.echo') as echo:
+            self._run('cfy-agent daemons start --all --interval 5 '
+                      '--timeout 20 --concurrency 2')
+        output = '\n'.join(call[0][0] for call in echo.call_args_list)
+        for daemon in factory_load_all.return_value:
+            daemon.start.assert_called_once_with(
+                interval=5,
+                timeout=20,
+                delete_amqp_queue=True,
+            )
+            self.assertIn('{0}: succeeded'.format(daemon.name), output)
+            daemon.set_broker_connection.assert_called_once_with(ANY)
+        self.assertIn('Total: 2 daemons, 0 failed', output)
+
+    def test_stop_names(self, *factory_methods):
+        factory_load = factory_methods[2]
+        factory_load.side_effect = lambda name, logger: \
+            self._daemons([name])[0]
+        self._run('cfy-agent daemons stop --names=name1,name2')
+        self.assertEqual(['name1', 'name2'],
+                         [call[0][0] for call in factory_load.call_args_list])
+
+    def test_restart_all_failure(self, *factory_methods):
+        factory_load_all = factory_methods[0]
+        daemons = self._daemons(['name1', 'name2'])
+        daemons[0].restart.side_effect = RuntimeError('restart failed')
+        factory_load_all.return_value = daemons
+        with patch('click.echo') as echo:
+            self.assertRaises(SystemExit, self._run,
+                              'cfy-agent daemons restart --all',
+                              raise_system_exit=True)
+        output = '\n'.join(call[0][0] for call in echo.call_args_list)
+        self.assertIn('name1: failed', output)
+        self.assertIn('restart failed', output)
+        self.assertIn('name2: succeeded', output)
+        daemons[1].restart.assert_called_once_with()
+
+    def test_delete_all(self, *factory_methods):
+        factory_load_all = factory_methods[0]
+        factory_delete = factory_methods[1]
+        daemons = self._daemons(['name1', 'name2'])
+        factory_load_all.return_value = daemons
+        with patch('cloudify_agent.shell.commands.daemons.api_utils.'
+                   'delete_daemons_queues') as delete_daemons_queues:
+            delete_daemons_queues.return_value = {'queue1': None,
+                                                  'queue2': None}
+            self._run('cfy-agent daemons delete --all')
+        self.assertEqual(set(['name1', 'name2']),
+                         set(call[0][0] for call in
+                             factory_delete.call_args_list))
+        for daemon in daemons:
+            daemon.defer_amqp_queues_deletion.assert_called_once_with()
+        delete_daemons_queues.assert_called_once_with(ANY)
+        self.assertEqual(set(daemons),
+                         set(delete_daemons_queues.call_args[0][0]))
+
+    def test_delete_all_queues_failure(self, *factory_methods):
+        factory_load_all = factory_methods[0]
+        daemons = self._daemons(['name1', 'name2'])
+        daemons[0].delete.side_effect = RuntimeError('delete failed')
+        factory_load_all.return_value = daemons
+        with patch('cloudify_agent.shell.commands.daemons.api_utils.'
+                   'delete_daemons_queues') as delete_daemons_queues, \
+                patch('click.echo') as echo:
+            delete_daemons_queues.return_value = {
+                'queue1': RuntimeError('access refused'),
+                'queue2': None}
+            self.assertRaises(SystemExit, self._run,
+                              'cfy-agent daemons delete --all',
+                              raise_system_exit=True)
+        # only the queues of deleted daemons are deleted
+        delete_daemons_queues.assert_called_once_with([daemons[1]])
+        output = '\n'.join(call[0][0] for call in echo.call_args_list)
+        self.assertIn('queue1: failed: access refused', output)
+        self.assertIn('queue2: deleted', output)
+
+    def test_lifecycle_requires_selection(self, *_):
+        with patch.dict(os.environ):
+            os.environ.pop(env_constants.CLOUDIFY_DAEMON_NAME, None)
+            try:
+                self._run('cfy-agent daemons stop', raise_system_exit=True)
+                self.fail('Expected a usage error')
+            except SystemExit as e:
+                self.assertNotEqual(0, e.code)
+
     @patch('cloudify_agent.shell.commands.daemons.api_utils'
            '.internal.daemon_to_dict')
     def test_inspect(self, daemon_to_dict, *factory_methods):
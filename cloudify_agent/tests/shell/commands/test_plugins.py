@@ -0,0 +1,107 @@
+#########
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import os
+import json
+
+from mock import patch
+
+from cloudify_agent.api import utils
+from cloudify_agent.api.plugins import cache
+from cloudify_agent.api.plugins import index
+from cloudify_agent.tests.shell.commands import BaseCommandLineTestCase
+
+
+class TestPluginsCommandLine(BaseCommandLineTestCase):
+
+    def setUp(self):
+        super(TestPluginsCommandLine, self).setUp()
+        key = utils.internal.CLOUDIFY_PLUGINS_CACHE_DIRECTORY_KEY
+        os.environ[key] = os.path.join(self.temp_folder, 'cache')
+        self.addCleanup(lambda: os.environ.pop(key, None))
+        self.wheelhouse = cache.Wheelhouse()
+        for name in ['first', 'second']:
+            self.wheelhouse.build(name, self._build, metadata={
+                'package_name': '{0}-plugin'.format(name),
+                'source': 'http://host/{0}.tar.gz'.format(name)})
+
+    @staticmethod
+    def _build(wheels_dir):
+        with open(os.path.join(wheels_dir, 'plugin-1.0-py2-none-any.whl'),
+                  'w') as f:
+            f.write('wheel')
+
+    def _run_and_capture(self, command):
+        with patch('click.echo') as echo:
+            self._run(command, raise_system_exit=True)
+        return '\n'.join(call[0][0] for call in echo.call_args_list)
+
+    def test_list(self):
+        plugins_dir = os.path.join(self.temp_folder, 'plugins')
+        plugin_index = index.PluginIndex(plugins_dir)
+        plugin_index.add('plugin-1.0', index.MANAGED, plugin_id='id',
+                         deployment_id='dep1')
+        plugin_index.add_reference('plugin-1.0', 'dep2')
+        with patch('cloudify_agent.api.plugins.index.PluginIndex',
+                   return_value=plugin_index):
+            output = self._run_and_capture('cfy-agent plugins list')
+        self.assertIn('plugin-1.0 [managed: id, deployments: dep1, dep2',
+                      output)
+        self.assertIn('Total: 1 plugins', output)
+
+    def test_gc(self):
+        with patch('cloudify_agent.api.plugins.installer.PluginInstaller.'
+                   'collect_garbage', return_value=10) as collect_garbage:
+            with patch('cloudify_agent.api.plugins.trash.Trash.empty'):
+                output = self._run_and_capture('cfy-agent plugins gc --all')
+        collect_garbage.assert_called_once_with(
+            quota=0, deployment_ids=None, deployments_listed_at=None)
+        self.assertIn('Reclaimed 10 bytes', output)
+
+    def test_prefetch(self):
+        plugins_file = os.path.join(self.temp_folder, 'plugins.json')
+        with open(plugins_file, 'w') as f:
+            json.dump([{'name': 'plugin', 'source': 'http://host/p.zip'}], f)
+        results = [{'name': 'plugin',
+                    'managed': False,
+                    'path': '/cache/archive',
+                    'error': None}]
+        with patch('cloudify_agent.api.plugins.installer.PluginInstaller.'
+                   'prefetch', return_value=results) as prefetch:
+            output = self._run_and_capture(
+                'cfy-agent plugins prefetch --plugins-file {0} '
+                '--concurrency 2'.format(plugins_file))
+        prefetch.assert_called_once_with(
+            [{'name': 'plugin', 'source': 'http://host/p.zip'}],
+            concurrency=2)
+        self.assertIn('plugin [source]: /cache/archive', output)
+
+    def test_wheelhouse_list(self):
+        output = self._run_and_capture('cfy-agent plugins wheelhouse list')
+        self.assertIn('first-plugin', output)
+        self.assertIn('http://host/second.tar.gz', output)
+
+    def test_wheelhouse_prune(self):
+        _, entry_size, _ = self.wheelhouse.entries()[-1]
+        output = self._run_and_capture(
+            'cfy-agent plugins wheelhouse prune --max-size {0}'
+            .format(entry_size))
+        self.assertIn('Reclaimed', output)
+        self.assertEqual(1, len(self.wheelhouse.entries()))
+
+    def test_wheelhouse_prune_all(self):
+        self._run('cfy-agent plugins wheelhouse prune --all',
+                  raise_system_exit=True)
+        self.assertEqual([], self.wheelhouse.entries())
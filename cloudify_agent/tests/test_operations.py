@@ -16,6 +16,7 @@ import os
 import platform
 import shutil
 import urllib
+import threading
 
 from contextlib import contextmanager
 
@@ -25,12 +26,14 @@ from cloudify import constants
 from cloudify import context
 from cloudify import ctx
 from cloudify import mocks
+from cloudify.exceptions import NonRecoverableError
 
 from cloudify.state import current_ctx
 from cloudify.workflows import local
 
 from cloudify_agent import operations
 from cloudify_agent.api import utils
+from cloudify_agent.api import exceptions
 from cloudify_agent.installer.config import configuration
 
 from cloudify_agent.tests import BaseTest, resources, agent_package
@@ -154,6 +157,84 @@ rest_mock.manager = MagicMock()
 rest_mock.manager.get_version = lambda: '3.3'
 
 
+class TestInstallPlugins(BaseTest):
+
+    def setUp(self):
+        super(TestInstallPlugins, self).setUp()
+        self.ctx = mocks.MockCloudifyContext(deployment_id='deployment',
+                                             blueprint_id='blueprint')
+
+    def _install_plugins(self, install, plugins, **kwargs):
+        with patch('cloudify_agent.operations.PluginInstaller.install',
+                   install):
+            with current_ctx.push(self.ctx):
+                operations.install_plugins(
+                    plugins=[{'name': name} for name in plugins],
+                    **kwargs)
+
+    def test_install_plugins_concurrently(self):
+        barrier = threading.Event()
+        installed = []
+
+        def install(_, plugin, deployment_id, blueprint_id):
+            self.assertEqual('deployment', deployment_id)
+            self.assertEqual('blueprint', blueprint_id)
+            # operation context must be available in the pool threads
+            self.assertEqual('deployment', ctx.deployment.id)
+            installed.append(plugin['name'])
+            if len(installed) == 2:
+                barrier.set()
+            # only returns if both plugins are installed at the same time
+            self.assertTrue(barrier.wait(5))
+
+        self._install_plugins(install, ['a', 'b'], concurrency=2)
+        self.assertEqual(['a', 'b'], sorted(installed))
+
+    def test_install_plugins_sequentially(self):
+        installed = []
+
+        def install(_, plugin, **__):
+            installed.append((plugin['name'], threading.current_thread()))
+
+        self._install_plugins(install, ['a', 'b', 'c'], concurrency=1)
+        self.assertEqual([('a', threading.current_thread()),
+                          ('b', threading.current_thread()),
+                          ('c', threading.current_thread())], installed)
+
+    def test_install_plugins_single_failure(self):
+        def install(_, plugin, **__):
+            if plugin['name'] == 'b':
+                raise exceptions.PluginInstallationError('b failed')
+
+        with self.assertRaises(NonRecoverableError) as c:
+            self._install_plugins(install, ['a', 'b', 'c'])
+        self.assertEqual('b failed', str(c.exception))
+
+    def test_install_plugins_aggregated_failures(self):
+        installed = []
+
+        def install(_, plugin, **__):
+            if plugin['name'] in ['a', 'c']:
+                raise exceptions.PluginInstallationError(
+                    '{0} failed'.format(plugin['name']))
+            installed.append(plugin['name'])
+
+        with patch.object(self.ctx.logger, 'error') as error:
+            with self.assertRaises(NonRecoverableError) as c:
+                self._install_plugins(install, ['a', 'b', 'c'],
+                                      concurrency=3)
+        self.assertEqual(['b'], installed)
+        self.assertIn('Failed installing 2 plugins', str(c.exception))
+        self.assertIn('a: a failed', str(c.exception))
+        self.assertIn('c: c failed', str(c.exception))
+        # every traceback is logged
+        self.assertEqual(2, error.call_count)
+        for call in error.call_args_list:
+            tpe, value, tb = call[1]['exc_info']
+            self.assertIs(exceptions.PluginInstallationError, tpe)
+            self.assertIsNotNone(tb)
+
+
 class TestCreateAgentAmqp(BaseTest):
 
     @patch('cloudify_agent.installer.config.configuration.ctx',
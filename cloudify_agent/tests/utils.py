@@ -13,6 +13,8 @@
 #  * See the License for the specific language governing permissions and
 #  * limitations under the License.
 
+import json
+import hashlib
 import logging
 import platform
 import time
@@ -22,6 +24,10 @@ import os
 import filecmp
 import tarfile
 import uuid
+import urlparse
+import threading
+import SocketServer
+import BaseHTTPServer
 from contextlib import contextmanager
 
 from wagon import wagon
@@ -287,6 +293,114 @@ class FileServer(object):
             return False
 
 
+class HTTPServerStandIn(object):
+
+    """
+    An in-process HTTP server serving in-memory content, used as a stand-in
+    for the manager file server and REST API. Supports range requests, and
+    can simulate connections dropped in the middle of a response. Files
+    are served with an ETag (their sha256 digest), and conditional
+    requests are answered with 304 when the file did not change (or with
+    the whole file, for a range request made if it did not change).
+    """
+
+    def __init__(self, port=0):
+        self.port = port
+        # url path -> content
+        self.files = {}
+        # url path (without query) -> function accepting the query
+        # parameters, returning a json serializable response
+        self.routes = {}
+        # (path, headers) of every request handled
+        self.requests = []
+        self.support_ranges = True
+        # number of responses to drop after sending `drop_after` bytes
+        self.drops = 0
+        self.drop_after = 0
+        # called with the url path after a response is dropped
+        self.on_drop = None
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        stand_in = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                stand_in.requests.append((self.path, dict(self.headers)))
+                url = urlparse.urlparse(self.path)
+                route = stand_in.routes.get(url.path)
+                if route is not None:
+                    body = json.dumps(route(dict(
+                        urlparse.parse_qsl(url.query))))
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                    return
+                content = stand_in.files.get(self.path)
+                if content is None:
+                    self.send_error(404)
+                    return
+                etag = '"{0}"'.format(hashlib.sha256(content).hexdigest())
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+                start = 0
+                range_header = self.headers.get('Range')
+                if_range = self.headers.get('If-Range')
+                if if_range is not None and if_range != etag:
+                    range_header = None
+                if range_header and stand_in.support_ranges:
+                    start = int(range_header.split('=')[1].split('-')[0])
+                    self.send_response(206)
+                    self.send_header('Content-Range', 'bytes {0}-{1}/{2}'
+                                     .format(start, len(content) - 1,
+                                             len(content)))
+                else:
+                    self.send_response(200)
+                body = content[start:]
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if stand_in.drops > 0:
+                    stand_in.drops -= 1
+                    self.wfile.write(body[:stand_in.drop_after])
+                    self.wfile.flush()
+                    self.close_connection = 1
+                    if stand_in.on_drop is not None:
+                        stand_in.on_drop(self.path)
+                    return
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        self._server = Server(('localhost', self.port), Handler)
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+    def url(self, path):
+        return 'http://localhost:{0}/{1}'.format(self.port, path.lstrip('/'))
+
+
 def op_context(task_name,
                task_target='non-empty-value',
                deployment_id=None,
@@ -61,6 +61,8 @@ setup(
             'resources/pm/initd/initd.template',
             'resources/pm/detach/detach.conf.template',
             'resources/pm/detach/detach.template',
+            'resources/pm/systemd/systemd.template',
+            'resources/pm/systemd/systemd.conf.template',
             'resources/pm/nssm/nssm.exe',
             'resources/pm/nssm/nssm.conf.template',
             'resources/script/linux.sh.template',